@@ -1,8 +1,24 @@
+import asyncio
+import concurrent.futures
 import io
+import multiprocessing
+import os
+import resource
+import sys
 import time
+import tracemalloc
+import numpy as np
 from PIL import Image
 
+from watermark.animation.animation import apply_watermark_animated
 from watermark.apply_watermark import apply_watermark, Filetype
+from watermark.color_conversion import color_conversion
+from watermark.chroma_subsample.subsample import (
+  SubsampleFilter, SubsampleOptions, subsample, subsample_plane)
+from watermark.encoder.watermark_encoder import WatermarkEncoder
+from watermark.streaming.strip_encoder import encode_strips
+from watermark.video.video import YuvFrame, encode_frames, write_yuv420p
+from watermark.worker_pool.worker_pool import WatermarkPool
 
 
 """
@@ -52,5 +68,252 @@ def run():
     apply_watermark(img, Filetype.PNG)
 
 
+def run_pool(workers: int = None, repeat: int = 4):
+  """
+  Encode the size sweep `repeat` times through a WatermarkPool and return the
+  throughput in images per second, to compare against different worker counts.
+  """
+  images = [peppers_image_bytes(size) for size in SIZES] * repeat
+
+  async def encode_all():
+    async with WatermarkPool(workers=workers) as pool:
+      start_time = time.time()
+      await asyncio.gather(*[pool.encode(img, Filetype.PNG) for img in images])
+      return time.time() - start_time
+
+  return len(images) / asyncio.run(encode_all())
+
+
+def run_pool_scaling(worker_counts=(1, 2, 4, 8), repeat: int = 4):
+  """
+  Images per second of run_pool and the speedup over one worker, per worker count up to
+  the number of CPUs
+  """
+  counts = [count for count in worker_counts if count <= os.cpu_count()]
+  throughput = {workers: run_pool(workers, repeat) for workers in counts}
+  return {workers: (rate, rate / throughput[counts[0]]) for workers, rate in throughput.items()}
+
+
+def _peak_rss_mb() -> float:
+  """Peak resident set size of this process in MB"""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on macOS
+  return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _encode_rss(img_bytes: bytes, dtype) -> float:
+  """
+  Growth of the peak RSS in MB while decoding img_bytes, encoding it with
+  max_dwt_encode and saving the result to PNG, in a process that did nothing else yet
+  """
+  encoder = WatermarkEncoder(b"SDV2", dtype=dtype)
+  before = _peak_rss_mb()
+  with Image.open(io.BytesIO(img_bytes)) as img:
+    rgb = np.asarray(img.convert('RGB'))
+  encoded = encoder.max_dwt_encode(rgb)
+  Image.fromarray(encoded.astype(np.uint8, copy=False)).save(io.BytesIO(), format="png")
+  return _peak_rss_mb() - before
+
+
+def run_memory(dtypes=(np.float64, np.float32)):
+  """
+  Peak RSS growth of an encode with WatermarkEncoder.max_dwt_encode, in MB, per size and
+  compute dtype. The peak RSS only grows, so every case runs in a new process; unlike
+  tracemalloc it includes Pillow's image buffers.
+  """
+  context = multiprocessing.get_context("spawn")
+  results = {}
+  for size in SIZES:
+    img_bytes = peppers_image_bytes(size)
+
+    for dtype in dtypes:
+      with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        rss = executor.submit(_encode_rss, img_bytes, dtype).result()
+      results[(size, np.dtype(dtype).name)] = rss
+
+  return results
+
+
+def run_pixel_delta(repeat: int = 3):
+  """
+  Seconds per max_dwt_encode call of the full YUV / DWT pipeline and of the
+  pixel_delta pipeline, per size.
+  """
+  results = {}
+  for size in SIZES:
+    with Image.open(io.BytesIO(peppers_image_bytes(size))) as img:
+      rgb = np.asarray(img.convert('RGB'))
+
+    for pixel_delta in [False, True]:
+      encoder = WatermarkEncoder(b"SDV2", pixel_delta=pixel_delta)
+      start_time = time.time()
+      for _ in range(repeat):
+        encoder.max_dwt_encode(rgb)
+      results[(size, pixel_delta)] = (time.time() - start_time) / repeat
+
+  return results
+
+
+def run_striped(sizes=(2048, 2880, 4096), worker_counts=(1, 2, 4, 8), repeat: int = 10):
+  """
+  p50 and p99 seconds per max_dwt_encode call and the p99 speedup over one worker, per
+  size and worker count up to the number of CPUs. Every worker count encodes the same
+  pixels.
+  """
+  counts = [count for count in worker_counts if count <= os.cpu_count()]
+  results = {}
+  for size in sizes:
+    with Image.open(io.BytesIO(peppers_image_bytes(size))) as img:
+      rgb = np.asarray(img.convert('RGB'))
+
+    for workers in counts:
+      encoder = WatermarkEncoder(b"SDV2", workers=workers)
+      # The first call starts the threads
+      encoder.max_dwt_encode(rgb)
+      samples = []
+      for _ in range(repeat):
+        start_time = time.perf_counter()
+        encoder.max_dwt_encode(rgb)
+        samples.append(time.perf_counter() - start_time)
+      p99 = float(np.percentile(samples, 99))
+      results[(size, workers)] = (
+        float(np.percentile(samples, 50)), p99, results.get((size, counts[0]), (0, p99))[1] / p99)
+
+  return results
+
+
+def run_streaming(sizes=(2048, 4096), strip_rows: int = 256):
+  """
+  Peak memory allocated by apply_watermark and by encode_strips to PNG, in MB, per size.
+  Pillow's own image buffers are not reported to tracemalloc.
+  """
+  results = {}
+  for size in sizes:
+    img = peppers_image_bytes(size)
+
+    tracemalloc.start()
+    apply_watermark(img, outputs=[Filetype.PNG])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[(size, "full")] = peak / 2 ** 20
+
+    tracemalloc.start()
+    encode_strips(img, io.BytesIO(), strip_rows=strip_rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[(size, "streaming")] = peak / 2 ** 20
+
+  return results
+
+
+def run_subsample(sizes=(1080, 2048, 4096), repeat: int = 20):
+  """
+  Microseconds per call of chroma subsampling of a uint8 YUV image, per size and mode:
+  subsample returning a copy, and subsample_plane in place on the U channel view
+  """
+  results = {}
+  for size in sizes:
+    yuv = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+
+    modes = {"subsample_copy": lambda: subsample(yuv)}
+    for subsample_type in SubsampleOptions:
+      for subsample_filter in SubsampleFilter:
+        modes[f"{subsample_type.name}_{subsample_filter.name}"] = (
+          lambda subsample_type=subsample_type, subsample_filter=subsample_filter:
+          subsample_plane(yuv[..., 1], subsample_type, subsample_filter))
+
+    for name, fn in modes.items():
+      start_time = time.perf_counter()
+      for _ in range(repeat):
+        fn()
+      results[(size, name)] = (time.perf_counter() - start_time) / repeat * 1e6
+
+  return results
+
+
+def run_color_conversion(sizes=(1080, 2048, 4096), repeat: int = 5):
+  """
+  Milliseconds per call of the float color conversions and of their product table
+  lookups, per size
+  """
+  results = {}
+
+  for size in sizes:
+    rgb = np.asarray(Image.open(io.BytesIO(peppers_image_bytes(size))).convert('RGB'))
+    yuv = color_conversion.rgb_to_yuv_float(rgb).astype(np.int16)
+    # Watermarked U values, a few of them outside of 0-255
+    yuv[..., 1] += np.random.default_rng(0).integers(-8, 9, yuv.shape[:2], dtype=np.int16)
+
+    for name, fn in [
+      ("rgb_to_yuv_float", lambda: color_conversion.rgb_to_yuv_float(rgb)),
+      ("rgb_to_yuv_table", lambda: color_conversion.rgb_to_yuv(rgb)),
+      ("yuv_to_rgb_float", lambda: color_conversion.yuv_to_rgb_float(yuv)),
+      ("yuv_to_rgb_table", lambda: color_conversion.yuv_to_rgb(yuv)),
+    ]:
+      start_time = time.perf_counter()
+      for _ in range(repeat):
+        fn()
+      results[(size, name)] = (time.perf_counter() - start_time) / repeat * 1e3
+
+  return results
+
+
+def run_animated(frame_counts=(1, 8, 32), size=(640, 360), group_sizes=(1, 16),
+                 outputs=(Filetype.GIF, Filetype.WEBP)):
+  """
+  Frames per second of apply_watermark_animated, decode to encoded bytes, per frame
+  count, stack size and output format
+  """
+  with Image.open('../data/peppers.png') as img:
+    img = img.convert('RGB').resize(size)
+
+  results = {}
+  for frame_count in frame_counts:
+    frames = [img.rotate(360 * index / frame_count) for index in range(frame_count)]
+    gif_bytes = io.BytesIO()
+    frames[0].save(gif_bytes, format="gif", save_all=True, append_images=frames[1:],
+                   duration=40, loop=0)
+
+    for max_group_size in group_sizes:
+      for output in outputs:
+        start_time = time.perf_counter()
+        apply_watermark_animated(
+          gif_bytes.getvalue(), output=output, max_group_size=max_group_size)
+        seconds = time.perf_counter() - start_time
+        results[(frame_count, max_group_size, output.value)] = frame_count / seconds
+
+  return results
+
+
+def run_video(frame_counts=(16, 64), size=(1280, 720), workers: int = None):
+  """
+  Frames per second and peak traced memory in MB of encode_frames writing raw yuv420p,
+  per clip length, next to the frames per second of WatermarkEncoder on RGB frames
+  """
+  with Image.open('../data/peppers.png') as img:
+    img = img.convert('RGB').resize(size)
+  frame = YuvFrame.from_image(img)
+  rgb = np.asarray(img)
+
+  results = {}
+  for frame_count in frame_counts:
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with open(os.devnull, "wb") as sink:
+      write_yuv420p(encode_frames((frame for _ in range(frame_count)), workers=workers), sink)
+    seconds = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[(frame_count, "yuv_fps")] = frame_count / seconds
+    results[(frame_count, "yuv_peak_mb")] = peak / 2 ** 20
+
+  wm_encoder = WatermarkEncoder(b"SDV2")
+  start_time = time.perf_counter()
+  for _ in range(frame_counts[0]):
+    wm_encoder.max_dwt_encode(rgb)
+  results["rgb_fps"] = frame_counts[0] / (time.perf_counter() - start_time)
+  return results
+
+
 if __name__ == "__main__":
   run()
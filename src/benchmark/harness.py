@@ -0,0 +1,285 @@
+"""
+Benchmark harness for the watermark pipeline.
+
+Times encode and decode end to end and stage by stage over a grid of sizes, aspect
+ratios and JPEG qualities, and reports p50 / p95 latency, throughput and peak traced
+memory. Inputs are generated before anything is measured.
+
+Results are written as JSON, and a run can be checked against a baseline run:
+
+  cd src/benchmark
+  python harness.py --output baseline.json
+  python harness.py --output current.json --baseline baseline.json --threshold 0.2
+
+exits with status 1 if any p50 latency is more than 20% slower than in baseline.json.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from watermark.apply_watermark import (
+  Filetype, _resize_for_social_media, apply_watermark, decode_watermark,
+  decode_watermark_sampled)
+from watermark.chroma_subsample.subsample import subsample_plane
+from watermark.color_conversion.color_conversion import rgb_to_yuv, yuv_to_rgb
+from watermark.max_dct.max_dct_encoder import EmbedMaxDct
+from watermark.transform.transform import Transform, backend
+
+SIZES = [1080, 2048]
+# width : height
+ASPECTS = {
+  "1:1": (1, 1),
+  "4:3": (4, 3),
+  "16:9": (16, 9),
+  "9:16": (9, 16),
+}
+JPEG_QUALITIES = [75, 95]
+WATERMARK = "SDV2"
+
+
+def source_image(size: int, aspect: str) -> Image.Image:
+  """
+  peppers.png resized so that its longer side is size, with the given aspect ratio
+  """
+  width, height = ASPECTS[aspect]
+  scale = size / max(width, height)
+  with Image.open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               '../data/peppers.png')) as img:
+    return img.convert('RGB').resize(
+      (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2))
+
+
+def image_bytes(img: Image.Image, file_type: Filetype, jpeg_quality: int = 75) -> bytes:
+  img_bytes = io.BytesIO()
+  if file_type == Filetype.JPEG:
+    img.save(img_bytes, format=file_type.value, quality=jpeg_quality)
+  else:
+    img.save(img_bytes, format=file_type.value)
+  return img_bytes.getvalue()
+
+
+class StageTimer(object):
+  """
+  Collects the seconds spent in named stages, one list of samples per stage
+  """
+
+  def __init__(self):
+    self.samples: Dict[str, List[float]] = {}
+
+  @contextmanager
+  def __call__(self, stage: str):
+    start_time = time.perf_counter()
+    yield
+    self.samples.setdefault(stage, []).append(time.perf_counter() - start_time)
+
+
+def encode_stages(img_bytes: bytes, timer: StageTimer, jpeg_quality: int = 75,
+                  resize_for_social_media: bool = False, transform=Transform.HAAR):
+  """
+  apply_watermark split into its stages, the embedding as EmbedMaxDct.encode_rgb does it
+  """
+  with timer("image_decode"):
+    img = Image.open(io.BytesIO(img_bytes))
+    img.load()
+  if resize_for_social_media:
+    with timer("resize_crop"):
+      img = _resize_for_social_media(img)
+  with timer("to_rgb_array"):
+    rgb = np.asarray(img.convert('RGB'))
+
+  watermarks = list(np.unpackbits(np.frombuffer(WATERMARK.encode('utf-8'), dtype=np.uint8)))
+  embed = EmbedMaxDct(watermarks, transform=transform)
+  transform_backend = backend(transform)
+
+  with timer("rgb_to_yuv"):
+    yuv = rgb_to_yuv(rgb)
+  with timer("subsample"):
+    subsample_plane(yuv[..., 1])
+    yuv = yuv.astype(np.int16)
+
+  rows, columns = rgb.shape[0] // 4 * 4, rgb.shape[1] // 4 * 4
+  with timer("dwt"):
+    ca1, (h1, v1, d1) = transform_backend.dwt2(yuv[:rows, :columns, 1].astype(np.float32))
+  with timer("block_embed"):
+    embed.encode_frame(ca1, scale=36)
+  with timer("idwt"):
+    yuv[:rows, :columns, 1] = transform_backend.idwt2((ca1, (v1, h1, d1)))
+
+  with timer("yuv_to_rgb"):
+    encoded = Image.fromarray(yuv_to_rgb(yuv), 'RGB')
+  with timer("jpeg_save"):
+    encoded.save(io.BytesIO(), format="jpeg", quality=jpeg_quality, subsampling=0)
+  with timer("png_save"):
+    encoded.save(io.BytesIO(), format="png")
+
+
+def summarize(samples: Sequence[float], pixels: int = 0) -> dict:
+  samples = np.asarray(samples)
+  summary = {
+    "p50": float(np.percentile(samples, 50)),
+    "p95": float(np.percentile(samples, 95)),
+    "mean": float(samples.mean()),
+    "runs": int(samples.size),
+  }
+  if pixels:
+    summary["megapixels_per_second"] = pixels / 1e6 / summary["p50"]
+  return summary
+
+
+def peak_memory(fn: Callable[[], object]) -> float:
+  """
+  Peak memory in MB traced while running fn once. NumPy reports its buffers to
+  tracemalloc, Pillow's image buffers are not included.
+  """
+  tracemalloc.start()
+  try:
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return peak / 2 ** 20
+
+
+def measure(fn: Callable[[], object], repeat: int, pixels: int, memory: bool = True) -> dict:
+  fn()  # warm up caches and lazy imports
+  samples = []
+  for _ in range(repeat):
+    start_time = time.perf_counter()
+    fn()
+    samples.append(time.perf_counter() - start_time)
+
+  result = summarize(samples, pixels)
+  result["images_per_second"] = 1 / result["p50"]
+  if memory:
+    result["peak_mb"] = peak_memory(fn)
+  return result
+
+
+def run_suite(sizes: Sequence[int] = SIZES, aspects: Sequence[str] = tuple(ASPECTS),
+              jpeg_qualities: Sequence[int] = JPEG_QUALITIES, repeat: int = 5,
+              log=print) -> dict:
+  """
+  Runs every benchmark of the grid and returns the results keyed by name, e.g.
+    encode/png/2048x1152, encode/jpeg75/2048x1152, decode_fast/jpeg95/1080x1080
+  """
+  results = {}
+
+  def record(name: str, result: dict):
+    results[name] = result
+    log(f"{name}: p50 {result['p50'] * 1000:.1f} ms, p95 {result['p95'] * 1000:.1f} ms")
+
+  for size in sizes:
+    for aspect in aspects:
+      img = source_image(size, aspect)
+      pixels = img.size[0] * img.size[1]
+      shape = f"{img.size[0]}x{img.size[1]}"
+
+      inputs = {"png": (image_bytes(img, Filetype.PNG), 75)}
+      for jpeg_quality in jpeg_qualities:
+        inputs[f"jpeg{jpeg_quality}"] = (
+          image_bytes(img, Filetype.JPEG, jpeg_quality), jpeg_quality)
+
+      for input_name, (img_bytes, jpeg_quality) in inputs.items():
+        record(f"encode/{input_name}/{shape}", measure(
+          lambda: apply_watermark(img_bytes, jpeg_quality=jpeg_quality, watermark=WATERMARK),
+          repeat, pixels))
+
+        timer = StageTimer()
+        for _ in range(repeat):
+          encode_stages(img_bytes, timer, jpeg_quality)
+        stages = {stage: summarize(samples) for stage, samples in timer.samples.items()}
+        record(f"encode_stages/{input_name}/{shape}", {
+          "p50": sum(stage["p50"] for stage in stages.values()),
+          "p95": sum(stage["p95"] for stage in stages.values()),
+          "stages": stages,
+        })
+
+      encoded_jpg, encoded_png = apply_watermark(inputs["png"][0], watermark=WATERMARK)
+      encoded = {"png": encoded_png.getvalue(), "jpeg75": encoded_jpg.getvalue()}
+      for input_name, encoded_bytes in encoded.items():
+        for name, decode in [
+          ("decode", lambda: decode_watermark(io.BytesIO(encoded_bytes))),
+          ("decode_fast", lambda: decode_watermark(io.BytesIO(encoded_bytes), fast=True)),
+          ("decode_sampled", lambda: decode_watermark_sampled(io.BytesIO(encoded_bytes))),
+        ]:
+          record(f"{name}/{input_name}/{shape}", measure(decode, repeat, pixels))
+
+      # resize / crop for social media, the 9:16 image gets cropped
+      record(f"resize_crop/{shape}", measure(
+        lambda: _resize_for_social_media(img), repeat, pixels, memory=False))
+
+  return results
+
+
+def environment() -> dict:
+  return {
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpus": os.cpu_count(),
+  }
+
+
+def check_regressions(baseline: dict, current: dict, threshold: float = 0.2) -> List[str]:
+  """
+  Names and slowdowns of the benchmarks whose p50 is more than threshold (a fraction)
+  slower in current than in baseline. Benchmarks missing from either run are ignored.
+  """
+  regressions = []
+  for name, result in current["results"].items():
+    if name not in baseline["results"]:
+      continue
+    before, after = baseline["results"][name]["p50"], result["p50"]
+    if after > before * (1 + threshold):
+      regressions.append(
+        f"{name}: p50 {before * 1000:.1f} ms -> {after * 1000:.1f} ms (+{after / before - 1:.0%})")
+  return regressions
+
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+  parser.add_argument("--aspects", nargs="+", default=list(ASPECTS), choices=list(ASPECTS))
+  parser.add_argument("--jpeg-qualities", type=int, nargs="+", default=JPEG_QUALITIES)
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--output", help="JSON file to write the results to")
+  parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+  parser.add_argument("--threshold", type=float, default=0.2,
+                      help="allowed p50 slowdown against the baseline, as a fraction")
+  args = parser.parse_args(argv)
+
+  current = {
+    "environment": environment(),
+    "results": run_suite(args.sizes, args.aspects, args.jpeg_qualities, args.repeat),
+  }
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(current, f, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = check_regressions(baseline, current, args.threshold)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Import time of the watermark package, measured in fresh interpreters with
+python -X importtime.
+
+  cd src/benchmark
+  python import_time.py --output import_time.json
+
+For every statement, reports the cumulative import time of each top level module,
+the slowest modules and the wall time of the whole process.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+SRC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+STATEMENTS = [
+  "import watermark",
+  "import watermark.apply_watermark",
+  "import watermark; watermark.warm_up()",
+]
+
+
+def import_times(statement: str) -> Dict[str, int]:
+  """
+  Cumulative import time in microseconds of every module imported by statement,
+  keyed by module name, indented as in the -X importtime output
+  """
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", statement], cwd=SRC,
+    capture_output=True, text=True, check=True)
+
+  times = {}
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    _, cumulative, name = line[len("import time:"):].split("|")
+    # Nested imports are indented by two spaces per level
+    times[name[1:].rstrip()] = int(cumulative)
+  return times
+
+
+def wall_time(statement: str, repeat: int = 5) -> float:
+  """
+  Best of repeat wall times in seconds of a fresh interpreter running statement
+  """
+  best = float("inf")
+  for _ in range(repeat):
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], cwd=SRC, check=True)
+    best = min(best, time.perf_counter() - start_time)
+  return best
+
+
+def run(statements: List[str] = STATEMENTS, top: int = 10) -> dict:
+  baseline = wall_time("pass")
+  results = {}
+  for statement in statements:
+    times = import_times(statement)
+    # Only top level imports are not indented
+    top_level = {name: us for name, us in times.items() if not name.startswith(" ")}
+    results[statement] = {
+      "wall_seconds": wall_time(statement) - baseline,
+      "import_us": sum(top_level.values()),
+      "modules": len(times),
+      "slowest": dict(sorted(
+        ((name.strip(), us) for name, us in times.items()),
+        key=lambda item: -item[1])[:top]),
+      "heavy_dependencies": sorted(
+        name.strip() for name in times if name.strip() in ("numpy", "PIL", "pywt", "numba")),
+    }
+  return results
+
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--output", help="JSON file to write the results to")
+  args = parser.parse_args(argv)
+
+  results = run()
+  for statement, result in results.items():
+    print(f"{statement}: {result['wall_seconds'] * 1000:.1f} ms wall, "
+          f"{result['import_us'] / 1000:.1f} ms importing {result['modules']} modules, "
+          f"heavy: {', '.join(result['heavy_dependencies']) or 'none'}")
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,3 +1,46 @@
-import os
-import sys
-sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+"""
+Invisible watermarking of images.
+
+Importing the package has no side effects and loads neither NumPy nor Pillow. The names
+below are imported from their modules on first access:
+
+  import watermark
+  watermark.warm_up()
+  encoded_img = watermark.apply_watermark_lazy(img_bytes)
+
+apply_watermark shares its name with its module, import it from there, which loads
+neither NumPy nor Pillow either:
+
+  from watermark.apply_watermark import apply_watermark
+"""
+import importlib
+
+# Public name -> module it is defined in
+_EXPORTS = {
+  "Filetype": "apply_watermark",
+  "WatermarkedImage": "apply_watermark",
+  "apply_watermark_lazy": "apply_watermark",
+  "apply_watermark_batch": "apply_watermark",
+  "decode_watermark": "apply_watermark",
+  "decode_watermark_sampled": "apply_watermark",
+  "apply_watermark_animated": "animation.animation",
+  "decode_watermark_animated": "animation.animation",
+  "WatermarkEncoder": "encoder.watermark_encoder",
+  "WatermarkDecoder": "encoder.watermark_encoder",
+  "Watermarker": "watermarker",
+  "warm_up": "cold_start",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+  if name not in _EXPORTS:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+  globals()[name] = value
+  return value
+
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,8 @@
+"""
+python -m watermark encode|decode|verify, see cli.cli
+"""
+import sys
+
+from .cli.cli import main
+
+sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Watermarking of animated GIF and WebP images.
+
+apply_watermark only reads the first frame of an animation. apply_watermark_animated
+watermarks every frame, or a subset of them, and writes the animation back with its
+frame durations, GIF disposal methods and loop count.
+
+Frames of an animation share their size, so they are stacked and watermarked up to
+max_group_size frames at a time by one embedder, which computes the bit of every
+block once for all of them.
+"""
+import io
+from typing import Iterable, List, Optional
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from ..apply_watermark import Filetype, MAX_PIXELS, _check_size, _open_image
+from ..encoder.watermark_encoder import WatermarkDecoder
+from ..instrumentation.instrumentation import stage
+from ..max_dct.max_dct_encoder import EmbedMaxDct
+
+# Longest animation accepted by default
+MAX_FRAMES = 1024
+
+# Most pixels of all frames of an animation accepted by default. Frames are held until
+# the animation is saved, this is about 1 GB as RGBA.
+MAX_TOTAL_PIXELS = 2 ** 28
+
+# Pillow format name -> output format of the animation
+_FORMATS = {"GIF": Filetype.GIF, "WEBP": Filetype.WEBP}
+
+
+def apply_watermark_animated(
+  img_buffer: bytes,
+  watermark: str = "SDV2",
+  output: Optional[Filetype] = None,
+  frames: Optional[Iterable[int]] = None,
+  max_group_size: int = 16,
+  workers: int = 1,
+  max_pixels: int = MAX_PIXELS,
+  max_frames: int = MAX_FRAMES,
+  max_total_pixels: int = MAX_TOTAL_PIXELS,
+  webp_quality: int = 80,
+  webp_lossless: bool = False,
+  hooks=None,
+) -> io.BytesIO:
+  """
+  Watermarks the frames of an animated GIF or WebP image and encodes them to output,
+    GIF or WEBP, the input format by default. A still image is a one frame animation.
+  frames: indices of the frames to watermark, all of them by default. The other frames
+    are kept as they are.
+  max_group_size: frames watermarked at once, as one stacked array.
+  workers: number of threads the watermark embedding of every stack is split over.
+  max_pixels: largest accepted frame. max_frames: longest accepted animation.
+  max_total_pixels: most pixels of all frames together, checked from the header.
+  webp_quality, webp_lossless: see WatermarkedImage.
+  hooks: optional instrumentation.Hooks every stage is reported to.
+  """
+  img, info = _open_image(img_buffer, hooks)
+  if output is None:
+    output = _FORMATS.get(info.format, Filetype.UNKNOWN)
+  if output not in _FORMATS.values():
+    raise ValueError(f"Unsupported animation format: {output.value}")
+  _check_size(info.pixels, max_pixels)
+  _check_frames(info.frames, max_frames)
+  if info.pixels * info.frames > max_total_pixels:
+    raise ValueError(
+      f"Animation is too large. Max size is {max_total_pixels:,} pixels over all frames.")
+
+  selected = set(range(info.frames) if frames is None else frames)
+  embed = EmbedMaxDct(
+    list(np.unpackbits(np.frombuffer(watermark.encode('utf-8', 'replace'), dtype=np.uint8))),
+    workers=workers, bit_plans={}, hooks=hooks)
+  scratch = {}
+
+  encoded_frames = []
+  durations = []
+  disposals = []
+  # (index in encoded_frames, RGB array, alpha or None) of frames waiting to be watermarked
+  group = []
+
+  def watermark_group():
+    stacked = np.stack([rgb for _, rgb, _ in group])
+    with stage(hooks, "watermark", stacked.size // 3):
+      encoded = embed.encode_rgb(stacked, scratch=scratch)
+    for (index, _, alpha), encoded_rgb in zip(group, encoded):
+      if alpha is None:
+        encoded_frames[index] = Image.fromarray(encoded_rgb, 'RGB')
+      else:
+        encoded_frames[index] = Image.fromarray(np.dstack((encoded_rgb, alpha)), 'RGBA')
+    group.clear()
+
+  for index, frame in enumerate(ImageSequence.Iterator(img)):
+    durations.append(frame.info.get("duration", 0))
+    disposals.append(getattr(frame, "disposal_method", 0))
+
+    if index not in selected:
+      # Kept in its own mode, the encoder converts it when saving
+      with stage(hooks, "image_decode", info.pixels):
+        encoded_frames.append(frame.copy())
+      continue
+
+    with stage(hooks, "image_decode", info.pixels):
+      # Frame.has_transparency_data needs Pillow 10.1
+      transparent = 'transparency' in frame.info or frame.mode in ('RGBA', 'LA', 'PA')
+      frame = frame.convert('RGBA' if transparent else 'RGB')
+      pixels = np.asarray(frame)
+    # Set once its group is watermarked
+    encoded_frames.append(None)
+    if frame.mode == 'RGBA':
+      group.append((index, pixels[..., :3], pixels[..., 3]))
+    else:
+      group.append((index, pixels, None))
+    if len(group) == max_group_size:
+      watermark_group()
+  if group:
+    watermark_group()
+
+  save_options = {"duration": durations}
+  if "loop" in img.info:
+    save_options["loop"] = img.info["loop"]
+  if output == Filetype.GIF:
+    save_options["disposal"] = disposals
+  else:
+    save_options.update(quality=webp_quality, lossless=webp_lossless)
+  if len(encoded_frames) == 1:
+    # Pillow only takes lists of per frame values for several frames
+    save_options = {
+      name: value[0] if isinstance(value, list) else value
+      for name, value in save_options.items()}
+
+  img_bytes = io.BytesIO()
+  with stage(hooks, f"{output.value}_save", info.pixels * len(encoded_frames)) as saved:
+    encoded_frames[0].save(
+      img_bytes, format=output.value, save_all=True, append_images=encoded_frames[1:],
+      **save_options)
+    saved.bytes_out = img_bytes.tell()
+  img_bytes.seek(0)
+  return img_bytes
+
+
+def decode_watermark_animated(encoded_img_buffer: io.BytesIO, wm_length=32,
+                              frames: Optional[Iterable[int]] = None,
+                              max_frames: int = MAX_FRAMES, hooks=None) -> List[str]:
+  """
+  Watermark of every frame of an animated image, or of the frames at the given indices
+  max_frames: longest accepted animation.
+  """
+  img, info = _open_image(encoded_img_buffer.getvalue(), hooks)
+  _check_size(info.pixels)
+  _check_frames(info.frames, max_frames)
+
+  wm_decoder = WatermarkDecoder(wm_length=wm_length, hooks=hooks)
+  selected = set(range(info.frames) if frames is None else frames)
+  watermarks = []
+  for index, frame in enumerate(ImageSequence.Iterator(img)):
+    if index in selected:
+      with stage(hooks, "image_decode", info.pixels):
+        rgb = np.asarray(frame.convert('RGB'))
+      watermarks.append(wm_decoder.decode(rgb).decode('utf-8', 'replace'))
+  return watermarks
+
+
+def _check_frames(frames: int, max_frames: int):
+  if frames > max_frames:
+    raise ValueError(f"Animation is too long. Max length is {max_frames} frames.")
@@ -0,0 +1,79 @@
+import io
+import unittest
+import numpy as np
+from PIL import Image
+
+from watermark.animation.animation import apply_watermark_animated, decode_watermark_animated
+from watermark.apply_watermark import Filetype
+
+
+WATERMARK = "SDV2"
+DURATIONS = [40, 80, 120, 160]
+
+
+def animated_gif_bytes() -> bytes:
+  with Image.open('../data/original.jpg') as img:
+    img = img.convert('RGB').resize((480, 270))
+  frames = [img.rotate(angle) for angle in range(0, 20, 5)]
+
+  img_bytes = io.BytesIO()
+  frames[0].save(img_bytes, format="gif", save_all=True, append_images=frames[1:],
+                 duration=DURATIONS, loop=2, disposal=2)
+  return img_bytes.getvalue()
+
+
+class TestAnimation(unittest.TestCase):
+  def test_gif(self):
+    encoded = apply_watermark_animated(animated_gif_bytes(), WATERMARK, max_group_size=3)
+
+    img = Image.open(encoded)
+    self.assertEqual(("GIF", 4, 2), (img.format, img.n_frames, img.info["loop"]))
+    for index, duration in enumerate(DURATIONS):
+      img.seek(index)
+      self.assertEqual(duration, img.info["duration"])
+      self.assertEqual(2, img.disposal_method)
+
+    self.assertEqual([WATERMARK] * 4, decode_watermark_animated(encoded, len(WATERMARK) * 8))
+
+  def test_webp_frames(self):
+    gif_bytes = animated_gif_bytes()
+    encoded = apply_watermark_animated(
+      gif_bytes, WATERMARK, output=Filetype.WEBP, frames=[1, 3], webp_lossless=True)
+
+    img = Image.open(encoded)
+    self.assertEqual(("WEBP", 4), (img.format, img.n_frames))
+    self.assertEqual(
+      [WATERMARK] * 2, decode_watermark_animated(encoded, len(WATERMARK) * 8, frames=[1, 3]))
+
+    # Frames that are not watermarked are kept as they are
+    original = Image.open(io.BytesIO(gif_bytes))
+    for index in [0, 2]:
+      img.seek(index)
+      original.seek(index)
+      np.testing.assert_array_equal(
+        np.asarray(original.convert('RGB')), np.asarray(img.convert('RGB')))
+
+  def test_limits(self):
+    with self.assertRaises(ValueError):
+      apply_watermark_animated(animated_gif_bytes(), max_frames=3)
+    with self.assertRaises(ValueError):
+      apply_watermark_animated(animated_gif_bytes(), output=Filetype.PNG)
+    # 4 frames of 480x270
+    with self.assertRaises(ValueError):
+      apply_watermark_animated(animated_gif_bytes(), max_total_pixels=4 * 480 * 270 - 1)
+    with self.assertRaises(ValueError):
+      decode_watermark_animated(io.BytesIO(animated_gif_bytes()), max_frames=3)
+
+  def test_transparency(self):
+    with Image.open('../data/original.jpg') as img:
+      img = img.convert('RGBA').resize((480, 270))
+    alpha = np.full((270, 480), 255, dtype=np.uint8)
+    alpha[:, :100] = 0
+    img.putalpha(Image.fromarray(alpha))
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="webp", save_all=True, append_images=[img.rotate(5)],
+             lossless=True)
+
+    encoded = Image.open(apply_watermark_animated(img_bytes.getvalue(), webp_lossless=True))
+    self.assertEqual('RGBA', encoded.mode)
+    np.testing.assert_array_equal(alpha, np.asarray(encoded)[..., 3])
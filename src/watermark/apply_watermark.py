@@ -1,74 +1,440 @@
+"""
+Watermarking and decoding of image bytes.
+
+Importing this module loads neither NumPy nor Pillow, so that
+  from watermark.apply_watermark import apply_watermark
+is as cheap as importing the package. Each function imports what it needs.
+"""
+from __future__ import annotations
+
 from enum import Enum
-from typing import BinaryIO
-from PIL import Image
-import numpy as np
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple, Union
 import io
-import logging
-import time
+import math
 
-from encoder.watermark_encoder import WatermarkEncoder, WatermarkDecoder
+from .instrumentation.instrumentation import stage
 
-# set logging level to info
-logging.basicConfig(level=logging.INFO)
+if TYPE_CHECKING:
+  import numpy as np
+  from PIL import Image
 
 
 class Filetype(Enum):
   JPEG = "jpeg"
   PNG = "png"
   GIF = "gif"
+  WEBP = "webp"
   UNKNOWN = "unknown"
 
 
+DEFAULT_OUTPUTS = (Filetype.JPEG, Filetype.PNG)
+
+# Largest image accepted by default. streaming.strip_encoder accepts larger ones.
+MAX_PIXELS = 4096 * 4096
+
+# Width of the images resized for social media
+SOCIAL_MEDIA_MIN_WIDTH = 320
+SOCIAL_MEDIA_MAX_WIDTH = 1080
+
+_EXIF_ORIENTATION = 0x0112
+
+
+class ImageInfo(object):
+  """
+  Header fields of an image, read by probe_image without decoding any pixel.
+
+  format: Pillow format name, e.g. "JPEG" or "PNG".
+  orientation: EXIF orientation, 1 if the image has none.
+  frames: number of frames, more than 1 for animated GIF, WebP and PNG.
+  """
+
+  def __init__(self, format: str, width: int, height: int, mode: str,
+               orientation: int = 1, frames: int = 1):
+    self.format = format
+    self.width = width
+    self.height = height
+    self.mode = mode
+    self.orientation = orientation
+    self.frames = frames
+
+  @property
+  def pixels(self) -> int:
+    return self.width * self.height
+
+  @property
+  def animated(self) -> bool:
+    return self.frames > 1
+
+  def __repr__(self):
+    return (f"ImageInfo({self.format}, {self.width}x{self.height}, {self.mode}, "
+            f"orientation={self.orientation}, frames={self.frames})")
+
+
+class WatermarkedImage(object):
+  """
+  A watermarked image whose JPEG / PNG / WebP bytes are only encoded when first
+    accessed, then cached. Each access returns a fresh BytesIO.
+
+  jpeg_quality: 0-100, quality of the JPEG output.
+  png_compress_level: 0-9, zlib level of the PNG output. Lower is faster but bigger.
+  png_optimize: let Pillow search for the smallest PNG encoding, slowest option.
+  webp_quality: 0-100, quality of the WebP output, ignored if webp_lossless.
+  hooks: optional instrumentation.Hooks the encoding durations are reported to.
+  """
+
+  def __init__(
+    self,
+    encoded_img: np.ndarray,
+    jpeg_quality: int = 75,
+    png_compress_level: int = 6,
+    png_optimize: bool = False,
+    webp_quality: int = 80,
+    webp_lossless: bool = False,
+    hooks=None,
+  ):
+    import numpy as np
+    from PIL import Image
+
+    self._hooks = hooks
+    self._img = Image.fromarray(encoded_img.astype(np.uint8, copy=False), 'RGB')
+    self._save_options = {
+      Filetype.JPEG: {"quality": jpeg_quality, "subsampling": 0},
+      Filetype.PNG: {"compress_level": png_compress_level, "optimize": png_optimize},
+      Filetype.WEBP: {"quality": webp_quality, "lossless": webp_lossless},
+    }
+    self._encoded = {}
+
+  @property
+  def image(self) -> Image.Image:
+    return self._img
+
+  @property
+  def jpeg(self) -> io.BytesIO:
+    return self.get(Filetype.JPEG)
+
+  @property
+  def png(self) -> io.BytesIO:
+    return self.get(Filetype.PNG)
+
+  @property
+  def webp(self) -> io.BytesIO:
+    return self.get(Filetype.WEBP)
+
+  def get(self, file_type: Filetype) -> io.BytesIO:
+    if file_type not in self._save_options:
+      raise ValueError(f"Unsupported output format: {file_type.value}")
+
+    if file_type not in self._encoded:
+      width, height = self._img.size
+      with stage(self._hooks, f"{file_type.value}_save", width * height) as saved:
+        img_bytes = io.BytesIO()
+        self._img.save(img_bytes, format=file_type.value,
+                       **self._save_options[file_type])
+        self._encoded[file_type] = img_bytes.getvalue()
+        saved.bytes_out = len(self._encoded[file_type])
+
+    return io.BytesIO(self._encoded[file_type])
+
+
 def apply_watermark(
   img_buffer: bytes,
   file_type: Filetype = Filetype.PNG,
   jpeg_quality: int = 75,
   watermark: str = "SDV2",
   resize_for_social_media: bool = False,
-):
+  workers: int = 1,
+  outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+  hooks=None,
+  resize_filter: Optional[Image.Resampling] = None,
+  **output_options,
+) -> Tuple[io.BytesIO, ...]:
   """
   jpeg_quality: 0-100, will be applied only if file_type is JPEG, otherwise ignored. Determines the 
     quality of the encoded image that is sent back.
+  workers: number of threads the watermark embedding of this one image is split over.
+  outputs: formats to encode the result to, one BytesIO is returned per format, in order.
+    Defaults to (JPEG, PNG).
+  hooks: optional instrumentation.Hooks every stage is reported to, with its duration,
+    pixel count and bytes in / out.
+  resize_filter: resample filter used when resize_for_social_media, BICUBIC by default.
+  output_options: png_compress_level, png_optimize, webp_quality and webp_lossless,
+    see WatermarkedImage.
+  """
+  encoded_img = apply_watermark_lazy(
+    img_buffer, file_type, jpeg_quality, watermark, resize_for_social_media, workers,
+    hooks=hooks, resize_filter=resize_filter, **output_options)
+  return tuple(encoded_img.get(output) for output in outputs)
+
+
+def apply_watermark_lazy(
+  img_buffer: bytes,
+  file_type: Filetype = Filetype.PNG,
+  jpeg_quality: int = 75,
+  watermark: str = "SDV2",
+  resize_for_social_media: bool = False,
+  workers: int = 1,
+  hooks=None,
+  resize_filter: Optional[Image.Resampling] = None,
+  **output_options,
+) -> WatermarkedImage:
+  """
+  Same as apply_watermark, but returns a WatermarkedImage that encodes only the
+    formats that are actually read from it.
   """
+  from .encoder.watermark_encoder import WatermarkEncoder
+
   if jpeg_quality < 0 or jpeg_quality > 100:
     raise ValueError("jpeg_quality must be between 0 and 100")
 
   # Convert image bytes to numpy array
-  img = _bytes_to_nparray(img_buffer, resize_for_social_media)
+  img = _bytes_to_nparray(
+    img_buffer, resize_for_social_media, hooks=hooks, resize_filter=resize_filter)
 
   # Encode watermark into image
-  wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'))
+  wm_encoder = WatermarkEncoder(
+    watermark.encode('utf-8', 'replace'), workers=workers, hooks=hooks)
 
   encoded_img = wm_encoder.max_dwt_encode(img)
-  # Convert numpy array to image bytes
-  encoded_img = Image.fromarray(encoded_img.astype(np.uint8), 'RGB')
+  return WatermarkedImage(
+    encoded_img, jpeg_quality=jpeg_quality, hooks=hooks, **output_options)
+
 
-  encoded_img_bytes_png = io.BytesIO()
-  encoded_img_bytes_jpg = io.BytesIO()
+def apply_watermark_batch(
+  img_buffers: Iterable[bytes],
+  file_type: Filetype = Filetype.PNG,
+  jpeg_quality: int = 75,
+  watermark: str = "SDV2",
+  resize_for_social_media: bool = False,
+  max_group_size: int = 16,
+  outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+  **output_options,
+) -> List[Union[Tuple[io.BytesIO, ...], Exception]]:
+  """
+  Watermark many images with one watermark.
+  Returns one entry per buffer, in input order: the tuple apply_watermark would
+    return, or the exception that image raised, e.g. the size limit ValueError.
+  Same shaped images are stacked, up to max_group_size at a time, so color conversion
+    and the DWT run once per stack instead of once per image.
+  """
+  import numpy as np
+  from .encoder.watermark_encoder import WatermarkEncoder
 
-  encoded_img.save(encoded_img_bytes_jpg, format=Filetype.JPEG.value,
-                   quality=jpeg_quality, subsampling=0)
-  encoded_img.save(encoded_img_bytes_png, format=Filetype.PNG.value)
+  if jpeg_quality < 0 or jpeg_quality > 100:
+    raise ValueError("jpeg_quality must be between 0 and 100")
 
-  return encoded_img_bytes_jpg, encoded_img_bytes_png
+  wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'))
 
+  results = []
+  groups = {}
+  for index, img_buffer in enumerate(img_buffers):
+    results.append(None)
+    try:
+      img = _bytes_to_nparray(img_buffer, resize_for_social_media)
+    except Exception as e:
+      results[index] = e
+      continue
+    groups.setdefault(img.shape, []).append((index, img))
+
+  for members in groups.values():
+    for start in range(0, len(members), max_group_size):
+      group = members[start:start + max_group_size]
+      try:
+        encoded_imgs = wm_encoder.max_dwt_encode(
+          np.stack([img for _, img in group]))
+      except Exception as e:
+        for index, _ in group:
+          results[index] = e
+        continue
+
+      for (index, _), encoded_img in zip(group, encoded_imgs):
+        encoded_img = WatermarkedImage(
+          encoded_img, jpeg_quality=jpeg_quality, **output_options)
+        results[index] = tuple(encoded_img.get(output) for output in outputs)
+
+  return results
+
+
+def decode_watermark(encoded_img_buffer: io.BytesIO, wm_length=32, fast: bool = False,
+                     hooks=None) -> str:
+  """
+  fast: for JPEG input, read the chroma straight from the JPEG decoder instead of
+    converting the image to RGB and back, see _jpeg_approximations.
+    Other formats are always decoded in full.
+  hooks: optional instrumentation.Hooks every stage is reported to.
+  """
+  from .encoder.watermark_encoder import WatermarkDecoder
 
-def decode_watermark(encoded_img_buffer: io.BytesIO, wm_length=32) -> str:
   encoded_img_bytes = encoded_img_buffer.getvalue()
+  wm_decoder = WatermarkDecoder(wm_length=wm_length, hooks=hooks)
 
-  # Convert image bytes to numpy array
-  encoded_img = _bytes_to_nparray(encoded_img_bytes)
+  approximations = None
+  if fast:
+    with stage(hooks, "jpeg_chroma_decode", bytes_in=len(encoded_img_bytes)):
+      approximations = _jpeg_approximations(encoded_img_bytes)
 
-  # Decode watermark from image
-  wm_decoder = WatermarkDecoder(wm_length=wm_length)
-  watermark = wm_decoder.decode(encoded_img)
+  if approximations is not None:
+    watermark = wm_decoder.decode_approximations(approximations)
+  else:
+    # Convert image bytes to numpy array
+    encoded_img = _bytes_to_nparray(encoded_img_bytes, hooks=hooks)
+
+    # Decode watermark from image
+    watermark = wm_decoder.decode(encoded_img)
   decoded = watermark.decode('utf-8', 'replace')
   return decoded
 
 
-def _crop_if_necessary(img: np.array) -> np.ndarray:
-  # Get the original aspect ratio
+def decode_watermark_sampled(encoded_img_buffer: io.BytesIO, wm_length=32,
+                             z_threshold: Optional[float] = None,
+                             hooks=None) -> Tuple[str, np.ndarray]:
+  """
+  Like decode_watermark, but stops reading blocks once the vote rate of every bit is
+    z_threshold standard deviations away from the rate of all votes, see
+    DecodeMaxDct.decode_rgb_sampled.
+  z_threshold: max_dct_encoder.Z_THRESHOLD by default.
+  Returns the watermark and the z-score of every bit, the smallest of which is a
+    detection score for the whole watermark, near 0 for unwatermarked images.
+  """
+  from .encoder.watermark_encoder import WatermarkDecoder
+  from .max_dct.max_dct_encoder import Z_THRESHOLD
+
+  if z_threshold is None:
+    z_threshold = Z_THRESHOLD
+  encoded_img = _bytes_to_nparray(encoded_img_buffer.getvalue(), hooks=hooks)
+
+  wm_decoder = WatermarkDecoder(wm_length=wm_length)
+  with stage(hooks, "sampled_decode", encoded_img.size // 3):
+    watermark, confidence = wm_decoder.decode_sampled(encoded_img, z_threshold)
+  return watermark.decode('utf-8', 'replace'), confidence
+
+
+def _jpeg_approximations(bytes: bytes, block: int = 4) -> Union[List[np.ndarray], None]:
+  """
+  Haar approximation bands of the Y and U channels of a JPEG image, as the decoder
+    computes them from the RGB image, but read from the JPEG YCbCr planes.
+  Only U is watermarked with the default scales, so Y is None.
+
+  The approximation band is a 2x downsampled plane, so the JPEG is decoded in draft mode
+    at half scale, which skips the colour conversion and for 4:2:0 chroma the upsampling
+    and most of the IDCT work. U is a rescaled Cb:
+    U = 0.872 * (Cb - 128) + 127.5
+  Returns None if the image is not a YCbCr JPEG, callers then decode in full.
+  """
+  import numpy as np
+  from PIL import Image
+  from .color_conversion.color_conversion import COMPUTE_DTYPE, RGB_TO_YUV
+
+  img = Image.open(io.BytesIO(bytes))
+  if img.format != 'JPEG' or img.mode != 'RGB':
+    return None
+
   width, height = img.size
+  _check_size(width * height)
+
+  rows = height // block * block // 2
+  columns = width // block * block // 2
+
+  img.draft('YCbCr', (width // 2, height // 2))
+  if img.mode != 'YCbCr':
+    return None
+  cb = np.asarray(img.getchannel('Cb'), dtype=COMPUTE_DTYPE)
+
+  if img.size == (width, height):
+    # Not reduced, sum 2x2 blocks like the Haar transform
+    cb = cb[:2 * rows, :2 * columns]
+    cb = ((cb[0::2, 0::2] + cb[0::2, 1::2]) + (cb[1::2, 0::2] + cb[1::2, 1::2])) / 2
+  else:
+    # Each pixel of the half scale image is the mean of a 2x2 block, the Haar
+    # approximation is twice that
+    cb = cb[:rows, :columns] * 2
+
+  cb_to_u = COMPUTE_DTYPE(RGB_TO_YUV[2, 1] / 0.5)
+  # 2 * (0.872 * (Cb - 128) + 127.5) with Cb already doubled
+  u = (cb - COMPUTE_DTYPE(2 * 128)) * cb_to_u + COMPUTE_DTYPE(2 * 127.5)
+  return [None, u]
+
+
+def probe_image(img_buffer: bytes, hooks=None) -> ImageInfo:
+  """
+  Reads the header of an image, to reject or route it before paying for its decode.
+  Raises PIL.UnidentifiedImageError if the bytes are not an image Pillow can open.
+  """
+  return _open_image(img_buffer, hooks)[1]
+
+
+def _open_image(bytes: bytes, hooks=None) -> Tuple[Image.Image, ImageInfo]:
+  """
+  The lazily decoded image and its ImageInfo
+  """
+  from PIL import Image
+
+  with stage(hooks, "probe", bytes_in=len(bytes)):
+    img = Image.open(io.BytesIO(bytes))
+    width, height = img.size
+    info = ImageInfo(
+      img.format, width, height, img.mode, _orientation(img), getattr(img, "n_frames", 1))
+  return img, info
+
+
+def _orientation(img: Image.Image) -> int:
+  # img.getexif() decodes PNG images to find an EXIF chunk after the pixels,
+  # only the EXIF block read with the header is parsed here
+  exif_bytes = img.info.get("exif")
+  if not exif_bytes:
+    return 1
+  from PIL import Image
+
+  exif = Image.Exif()
+  try:
+    exif.load(exif_bytes)
+  except Exception:
+    return 1
+  return exif.get(_EXIF_ORIENTATION, 1)
+
+
+def _social_media_geometry(width: int,
+                           height: int) -> Tuple[Tuple[float, ...], Tuple[int, int]]:
+  """
+  Source box and output size of _resize_for_social_media for a width x height image.
+  Folds its crop, resize to 320-1080 px wide and second crop, needed when rounding
+    changed the aspect ratio, into a single box for Image.resize.
+  """
+  left, top, right, bottom = _crop_box(width, height)
+  cropped_width, cropped_height = right - left, bottom - top
+
+  # Instagram wants images to have width between 320 and 1080 px
+  if cropped_width < SOCIAL_MEDIA_MIN_WIDTH:
+    size = (SOCIAL_MEDIA_MIN_WIDTH, int(SOCIAL_MEDIA_MIN_WIDTH / cropped_width * cropped_height))
+  elif cropped_width > SOCIAL_MEDIA_MAX_WIDTH:
+    size = (SOCIAL_MEDIA_MAX_WIDTH,
+            int(cropped_height / (cropped_width / SOCIAL_MEDIA_MAX_WIDTH)))
+  else:
+    size = (cropped_width, cropped_height)
+
+  # The second crop, mapped from resized to source coordinates
+  scale_x = cropped_width / size[0]
+  scale_y = cropped_height / size[1]
+  x0, y0, x1, y1 = _crop_box(*size)
+  box = (left + x0 * scale_x, top + y0 * scale_y, left + x1 * scale_x, top + y1 * scale_y)
+  return box, (x1 - x0, y1 - y0)
+
+
+def _social_media_draft_size(width: int, height: int) -> Tuple[int, int]:
+  """
+  Smallest size a width x height image can be decoded at and still be cropped and
+    resized for social media without upscaling
+  """
+  (left, top, right, bottom), size = _social_media_geometry(width, height)
+  scale = max(size[0] / (right - left), size[1] / (bottom - top))
+  if scale >= 1:
+    return width, height
+  return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def _crop_box(width: int, height: int) -> Tuple[int, int, int, int]:
+  """
+  Box of the crop of a width x height image to the aspect ratios Instagram accepts
+  """
   original_aspect = width / height
 
   # These are the minimum and maximum aspect ratios for Instagram
@@ -78,73 +444,92 @@ def _crop_if_necessary(img: np.array) -> np.ndarray:
   # Image is too tall, so we need to crop the top and bottom
   if original_aspect < min_aspect:
     new_height = int(width / min_aspect)
-    left = 0
-    right = width
     top = int((height - new_height) / 2)
     bottom = int((height + new_height) / 2)
-    img = img.crop((left, top, right, bottom))
+    return 0, top, width, bottom
 
   # Image is too wide, so we need to crop the left and right
-  elif original_aspect > max_aspect:
+  if original_aspect > max_aspect:
     new_width = int(height * max_aspect)
     left = int((width - new_width) / 2)
     right = int((width + new_width) / 2)
-    top = 0
-    bottom = height
-    img = img.crop((left, top, right, bottom))
+    return left, 0, right, height
 
-  return img
+  return 0, 0, width, height
 
 
-def _resize_for_social_media(img: np.ndarray) -> np.ndarray:
+def _resize_for_social_media(
+  img: Image.Image,
+  resample: Optional[Image.Resampling] = None,
+  original_size: Tuple[int, int] = None,
+) -> Image.Image:
   """
   Resize image to fit Instagram's aspect ratio requirements.
   Twitter has looser requirements, but we'll use the same ones for now.
   Ignoring Facebook. Fb has very specific requirements on size, so most images uploaded to FB 
     will get resized. We suspect most AI generated images will get resized and lose the watermark
     So intentionally having a watermark on FB may actually get used as a signal that the image is not generated.
+
+  Crops and resizes in a single Image.resize, with the resample filter, BICUBIC by
+    default.
+  original_size: size of the image before a JPEG draft reduced it, the output size is
+    computed from it so it does not depend on the draft scale.
   """
-  img = _crop_if_necessary(img)
-  width, height = img.size
+  width, height = original_size or img.size
+  box, size = _social_media_geometry(width, height)
+
+  scale_x = img.size[0] / width
+  scale_y = img.size[1] / height
+  box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+  unscaled = size == (box[2] - box[0], box[3] - box[1])
+  if unscaled and all(float(edge).is_integer() for edge in box):
+    if size == img.size:
+      return img
+    return img.crop(tuple(int(edge) for edge in box))
+  if resample is None:
+    from PIL import Image
+    resample = Image.Resampling.BICUBIC
+  return img.resize(size, resample, box=box)
+
+
+def _check_size(pixels: int, max_pixels: int = MAX_PIXELS):
+  if pixels > max_pixels:
+    raise ValueError(f"Image is too large. Max size is {max_pixels:,} pixels.")
+  if pixels < 256 * 256:
+    raise ValueError("Image is too small. Should be larger than 256x256 ")
 
-  # Instagram wants images to have width between 320 and 1080 px
-  if width < 320:
-    img = img.resize((320, int(320 / width * height)))
-  elif width > 1080:
-    img = img.resize((1080, int(height / (width / 1080))))
 
-  # In case the aspect ratio is off after resizing rounding, crop again
-  return _crop_if_necessary(img)
+def _bytes_to_nparray(bytes: bytes, resize_for_social_media: bool = False,
+                      max_pixels: int = MAX_PIXELS, hooks=None,
+                      resize_filter: Optional[Image.Resampling] = None) -> np.ndarray:
+  """
+  Decodes an image to a (rows, columns, 3) RGB array, after checking its size from
+    the header. A JPEG resized for social media is decoded at the smallest scale
+    its decoder offers above the resized size, so max_pixels applies to that scale.
+  resize_filter: resample filter of the resize for social media, BICUBIC by default.
+  """
+  import numpy as np
 
+  img, info = _open_image(bytes, hooks)
 
-def _bytes_to_nparray(bytes: bytes, resize_for_social_media: bool = False) -> np.array:
-  start_time = time.time()
-  # Convert image bytes to PIL image object
-  img = Image.open(io.BytesIO(bytes))
+  if resize_for_social_media and info.format == 'JPEG':
+    # Only configures the decoder, nothing is decoded yet
+    img.draft(img.mode, _social_media_draft_size(info.width, info.height))
 
   width, height = img.size
-  # logging.info(
-  #   f"image size: {width} x {height} = {(width * height):,} pixels")
   pixels = width * height
+  _check_size(pixels, max_pixels)
 
-  if resize_for_social_media:
-    img = _resize_for_social_media(img)
+  with stage(hooks, "image_decode", pixels, len(bytes)):
+    img.load()
 
-  if pixels > 4096 * 4096:
-    raise ValueError("Image is too large. Max size is 4096 x 4096 pixels.")
-  if pixels < 256 * 256:
-    raise ValueError("Image is too small. Should be larger than 256x256 ")
-
-  # preprocess_time = time.time()
-  # logging.info(
-  #   f"time to handle pre-processing: {preprocess_time - start_time}")
-
-  # logging.info(f"image mode: {img.mode}")
-  if img.mode != 'RGB':
-    img = img.convert('RGB')
+  if resize_for_social_media:
+    with stage(hooks, "resize_crop", pixels):
+      img = _resize_for_social_media(img, resize_filter, (info.width, info.height))
 
-  # convert_time = time.time()
-  # logging.info(f"time to convert to RGB:  {convert_time - preprocess_time}")
+  with stage(hooks, "to_rgb", pixels):
+    if img.mode != 'RGB':
+      img = img.convert('RGB')
 
-  # Convert PIL image object to numpy array
-  return np.asarray(img)
+    # Convert PIL image object to numpy array
+    return np.asarray(img)
@@ -2,7 +2,7 @@
 Chroma subsampling really messes up DWT approximation coeffecient values
 Causing watermarks to often get lost.
 
-If we pre-chroma subsample an image before we watermark, then the DWT approximation 
+If we pre-chroma subsample an image before we watermark, then the DWT approximation
 coefficients are what they would have been post-subsampling, thus the
 resulting watermark is more robust to chroma subsampling attacks.
 
@@ -17,43 +17,92 @@ class SubsampleOptions(Enum):
   FOUR_TWO_ZERO = 1
 
 
+class SubsampleFilter(Enum):
+  # Every sample of a group takes the value of its first (top left) sample
+  NEAREST = "nearest"
+  # Every sample of a group takes the rounded mean of the group, like JPEG encoders.
+  # Groups cut by an odd image edge are averaged as if the edge was repeated.
+  BOX = "box"
+
+
 def subsample(
     yuv_img: np.ndarray,
     u=True,
     v=False,
     subsample_type: SubsampleOptions = SubsampleOptions.FOUR_TWO_ZERO,
+    subsample_filter: SubsampleFilter = SubsampleFilter.NEAREST,
+    in_place: bool = False,
+  ) -> np.ndarray:
+  """
+  Subsamples the U and / or V channel of a (..., rows, columns, 3) image.
+  in_place: subsample yuv_img itself instead of a copy of it.
+  """
+  first = 1 if u else 2
+  last = 3 if v else 2
+  subsampled_image = yuv_img if in_place else yuv_img.copy()
+  if first < last:
+    # Both channels at once, as a (channels, ..., rows, columns) view
+    subsample_plane(
+      np.moveaxis(subsampled_image[..., first:last], -1, 0), subsample_type, subsample_filter)
+  return subsampled_image
+
+
+def subsample_plane(
+    plane: np.ndarray,
+    subsample_type: SubsampleOptions = SubsampleOptions.FOUR_TWO_ZERO,
+    subsample_filter: SubsampleFilter = SubsampleFilter.NEAREST,
   ):
-  if subsample_type == SubsampleOptions.FOUR_FOUR_TWO:
-    return ValueError("Not yet implemented")
-
-  channels = []
-  if u:
-    channels.append(1)
-  if v:
-    channels.append(2)
-
-  subsampled_image = yuv_img.copy()
-  cols, rows, _ = yuv_img.shape
-  for channel in channels:
-
-    # Horizontal copy
-    print("~~~~ Horizontal ~~~~~")
-    print(subsampled_image[:, :, channel].shape)
-    print(subsampled_image[:, 1:rows // 2 * 2:2, channel].shape)
-    print(subsampled_image[:, ::2, channel].shape)
+  """
+  Subsamples a single (..., rows, columns) channel in place, in groups of 2x2 samples
+  for 4:2:0 and of 1x2 samples for 4:2:2
+  """
+  vertical = subsample_type == SubsampleOptions.FOUR_TWO_ZERO
+  if subsample_filter == SubsampleFilter.BOX:
+    _box_plane(plane, vertical)
+    return
+
+  rows, columns = plane.shape[-2:]
+
+  # Horizontal copy
+  last_source_col = columns // 2 * 2
+  plane[..., :, 1::2] = plane[..., :, :last_source_col:2]
+
+  # Vertical copy
+  if vertical:
     last_source_row = rows // 2 * 2
-    subsampled_image[:, 1::2, channel] = subsampled_image[:,
-                                                          :last_source_row:2, channel]
+    plane[..., 1::2, :] = plane[..., :last_source_row:2, :]
 
-    # if subsample_type == SubsampleOptions.FOUR_FOUR_TWO:
-    #   continue
 
-    # Vertical copy
-    print("~~~~ Vertical ~~~~~")
-    print(subsampled_image[1::2, :, channel].shape)
-    print(subsampled_image[::2, :, channel].shape)
-    last_source_col = cols // 2 * 2
-    subsampled_image[1::2, :,
-                     channel] = subsampled_image[:last_source_col:2, :, channel]
+def _box_plane(plane: np.ndarray, vertical: bool):
+  integer = np.issubdtype(plane.dtype, np.integer)
+  total = plane.astype(np.int32 if integer else plane.dtype)
 
-  return subsampled_image
+  total = _pair_sums(total, -1)
+  count = 2
+  if vertical:
+    total = _pair_sums(total, -2)
+    count = 4
+
+  if integer:
+    total += count // 2
+    total //= count
+  else:
+    total /= count
+
+  rows = [slice(0, None, 2), slice(1, None, 2)] if vertical else [slice(None)]
+  for row in rows:
+    for column in [slice(0, None, 2), slice(1, None, 2)]:
+      target = plane[..., row, column]
+      target[...] = total[..., :target.shape[-2], :target.shape[-1]]
+
+
+def _pair_sums(values: np.ndarray, axis: int) -> np.ndarray:
+  """
+  Sums of the pairs of consecutive values along axis, a last unpaired value is doubled
+  """
+  values = np.moveaxis(values, axis, -1)
+  sums = values[..., 0::2].copy()
+  sums[..., :values.shape[-1] // 2] += values[..., 1::2]
+  if values.shape[-1] % 2:
+    sums[..., -1] *= 2
+  return np.moveaxis(sums, -1, axis)
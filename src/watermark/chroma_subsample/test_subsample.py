@@ -0,0 +1,52 @@
+import contextlib
+import io
+import unittest
+import numpy as np
+
+from watermark.chroma_subsample.subsample import (
+  SubsampleFilter, SubsampleOptions, subsample, subsample_plane)
+
+
+def plane_test_data():
+  # Odd number of rows and columns, so the edges are not whole groups
+  return np.arange(15, dtype=np.uint8).reshape(3, 5)
+
+
+class TestSubsample(unittest.TestCase):
+  def test_subsample_plane(self):
+    for subsample_type, subsample_filter, expected in [
+      (SubsampleOptions.FOUR_TWO_ZERO, SubsampleFilter.NEAREST,
+       [[0, 0, 2, 2, 4], [0, 0, 2, 2, 4], [10, 10, 12, 12, 14]]),
+      (SubsampleOptions.FOUR_FOUR_TWO, SubsampleFilter.NEAREST,
+       [[0, 0, 2, 2, 4], [5, 5, 7, 7, 9], [10, 10, 12, 12, 14]]),
+      (SubsampleOptions.FOUR_TWO_ZERO, SubsampleFilter.BOX,
+       [[3, 3, 5, 5, 7], [3, 3, 5, 5, 7], [11, 11, 13, 13, 14]]),
+      (SubsampleOptions.FOUR_FOUR_TWO, SubsampleFilter.BOX,
+       [[1, 1, 3, 3, 4], [6, 6, 8, 8, 9], [11, 11, 13, 13, 14]]),
+    ]:
+      plane = plane_test_data()
+      subsample_plane(plane, subsample_type, subsample_filter)
+      np.testing.assert_array_equal(
+        expected, plane, f"{subsample_type.name} {subsample_filter.name}")
+
+    plane = plane_test_data().astype(np.float32)
+    subsample_plane(plane, subsample_filter=SubsampleFilter.BOX)
+    self.assertEqual(10.5, plane[2, 0])
+
+  def test_subsample(self):
+    rng = np.random.default_rng(0)
+    yuv = rng.integers(0, 256, (2, 5, 7, 3), dtype=np.uint8)
+
+    expected = yuv.copy()
+    subsample_plane(expected[..., 1])
+    subsample_plane(expected[..., 2])
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      subsampled = subsample(yuv, u=True, v=True)
+    self.assertEqual("", output.getvalue())
+    np.testing.assert_array_equal(expected, subsampled)
+    self.assertFalse(np.shares_memory(yuv, subsampled))
+
+    self.assertIs(yuv, subsample(yuv, u=True, v=True, in_place=True))
+    np.testing.assert_array_equal(expected, yuv)
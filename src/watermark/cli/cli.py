@@ -0,0 +1,394 @@
+"""
+Bulk watermark, decode and verify jobs over directories of images, on a process pool.
+
+  cd src
+  python -m watermark encode photos/ --output-dir watermarked/ --watermark SDV2
+  find photos -name '*.jpg' | python -m watermark decode - > watermarks.jsonl
+  python -m watermark verify watermarked/ --watermark SDV2 --checkpoint verify.done
+
+Inputs are directories, walked for files with an image extension, image files, or - to
+read one path per line from stdin. Every file is reported as one JSON line on stdout
+with its path, size, seconds and result: the output written by encode, the decoded
+watermark, or the error it raised. Throughput and ETA are printed to stderr.
+
+encode writes every input to its path relative to --root under --output-dir, with the
+output extension appended, e.g. a/img.jpg to a/img.jpg.png. --root defaults to the
+deepest directory all inputs are in.
+
+Workers memory-map the files they read and write each output to a temporary file that
+is synced and renamed over the output path, so an interrupted job leaves no partial
+outputs. With --checkpoint, the path of every file processed without error is appended
+to a file and files listed there are skipped when the job is run again with the same
+arguments.
+"""
+import argparse
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+import numpy as np
+
+from ..apply_watermark import (
+  Filetype, apply_watermark_lazy, decode_watermark, decode_watermark_sampled)
+from ..max_dct.max_dct_encoder import Z_THRESHOLD
+
+# Extensions of the files picked up when walking a directory
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+
+# Output formats of encode
+_OUTPUTS = {
+  file_type.value: file_type for file_type in (Filetype.PNG, Filetype.JPEG, Filetype.WEBP)}
+
+
+class Checkpoint(object):
+  """
+  Append-only file of the paths of the files done, one JSON string per line, after a
+    first line with the job the paths were done for, as a JSON object.
+  A last line cut short by an interruption is ignored.
+  Raises ValueError if the file was written for another job.
+  """
+
+  def __init__(self, path: str, job: dict):
+    self._done = set()
+    written_job = None
+    terminated = True
+    if os.path.exists(path):
+      with open(path, encoding='utf-8') as f:
+        for line in f:
+          terminated = line.endswith("\n")
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue
+          if isinstance(entry, dict):
+            written_job = entry
+          else:
+            self._done.add(entry)
+    if written_job is not None and written_job != job:
+      raise ValueError(f"{path} was written for another job: {json.dumps(written_job)}")
+
+    self._file = open(path, "a", encoding='utf-8')
+    if not terminated:
+      self._file.write("\n")
+    if written_job is None:
+      self._file.write(json.dumps(job, sort_keys=True) + "\n")
+
+  def __contains__(self, path: str) -> bool:
+    return path in self._done
+
+  def __len__(self) -> int:
+    return len(self._done)
+
+  def add(self, path: str):
+    self._done.add(path)
+    self._file.write(json.dumps(path) + "\n")
+    self._file.flush()
+
+  def close(self):
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._file.close()
+
+
+class Progress(object):
+  """
+  Counts the files and bytes done and prints throughput and ETA to stream, at most once
+    every interval seconds.
+  """
+
+  def __init__(self, total: int, stream: Optional[TextIO] = None, interval: float = 5.0,
+               clock=time.monotonic):
+    self.total = total
+    self.done = 0
+    self.failed = 0
+    self.bytes = 0
+    self._stream = stream or sys.stderr
+    self._interval = interval
+    self._clock = clock
+    self._start = clock()
+    self._last_report = self._start
+
+  def update(self, record: dict):
+    self.done += 1
+    self.failed += _failed(record)
+    self.bytes += record.get("bytes", 0)
+    now = self._clock()
+    if now - self._last_report >= self._interval:
+      self._last_report = now
+      print(self.status(), file=self._stream, flush=True)
+
+  def status(self) -> str:
+    elapsed = max(self._clock() - self._start, 1e-9)
+    rate = self.done / elapsed
+    status = (f"{self.done}/{self.total} files, {self.failed} failed, {rate:.1f} files/s, "
+              f"{self.bytes / elapsed / 2 ** 20:.1f} MiB/s")
+    if self.done < self.total and rate > 0:
+      status += f", ETA {_duration((self.total - self.done) / rate)}"
+    elif self.done == self.total:
+      status += f", {_duration(elapsed)} elapsed"
+    return status
+
+
+def list_files(inputs: Sequence[str], extensions: Sequence[str] = EXTENSIONS,
+               stdin: Optional[TextIO] = None) -> Iterator[str]:
+  """
+  Path of every input file, in directory order
+  """
+  extensions = tuple(extension.lower() for extension in extensions)
+  for input in inputs:
+    if input == "-":
+      for line in stdin or sys.stdin:
+        path = line.rstrip("\n")
+        if path:
+          yield path
+    elif os.path.isdir(input):
+      for directory, subdirectories, files in os.walk(input):
+        subdirectories.sort()
+        for name in sorted(files):
+          if name.lower().endswith(extensions):
+            yield os.path.join(directory, name)
+    else:
+      yield input
+
+
+def output_paths(paths: Sequence[str], output_dir: str, extension: str,
+                 root: Optional[str] = None) -> List[str]:
+  """
+  Output path of every input path: its path relative to root under output_dir, with
+    extension appended. root defaults to the deepest directory all paths are in.
+  Raises ValueError for a path outside of root, or if two paths have the same output.
+  """
+  paths = [os.path.abspath(path) for path in paths]
+  if root is None:
+    root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else "."
+  root = os.path.abspath(root)
+
+  outputs = []
+  seen = {}
+  for path in paths:
+    relative = os.path.relpath(path, root)
+    if relative.startswith(os.pardir + os.sep):
+      raise ValueError(f"{path} is not under the root {root}")
+    output = os.path.join(output_dir, f"{relative}.{extension}")
+    key = os.path.normcase(os.path.normpath(output))
+    if key in seen:
+      raise ValueError(f"{seen[key]} and {path} would both be written to {output}")
+    seen[key] = path
+    outputs.append(output)
+  return outputs
+
+
+def _duration(seconds: float) -> str:
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def _failed(record: dict) -> bool:
+  return "error" in record or record.get("match") is False
+
+
+def _read(path: str) -> mmap.mmap:
+  # Pages come straight from the page cache, nothing is read up front
+  with open(path, 'rb') as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _file_mode() -> int:
+  # Mode open() creates files with, mkstemp creates them readable by their owner only
+  umask = os.umask(0)
+  os.umask(umask)
+  return 0o666 & ~umask
+
+
+def _write_atomically(path: str, data: bytes):
+  """
+  Writes data to path through a synced temporary file renamed over it, so path holds
+    either its previous content or all of data, also after a crash
+  """
+  directory = os.path.dirname(path) or "."
+  os.makedirs(directory, exist_ok=True)
+  fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      os.fchmod(f.fileno(), _file_mode())
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temporary, path)
+  except BaseException:
+    os.unlink(temporary)
+    raise
+
+  # The rename is only durable once the directory is synced
+  directory_fd = os.open(directory, os.O_RDONLY)
+  try:
+    os.fsync(directory_fd)
+  finally:
+    os.close(directory_fd)
+
+
+def _encode_file(data: mmap.mmap, output: str, file_type: Filetype, options: dict) -> dict:
+  encoded = apply_watermark_lazy(data, **options).get(file_type)
+  _write_atomically(output, encoded.getbuffer())
+  return {"output": output}
+
+
+def _decode_file(data: mmap.mmap, wm_length: int, fast: bool) -> dict:
+  return {"watermark": decode_watermark(io.BytesIO(data), wm_length, fast)}
+
+
+def _verify_file(data: mmap.mmap, watermark: str, z_threshold: float) -> dict:
+  wm_length = len(watermark.encode('utf-8', 'replace')) * 8
+  decoded, confidence = decode_watermark_sampled(io.BytesIO(data), wm_length, z_threshold)
+  return {"watermark": decoded, "match": decoded == watermark,
+          "z": round(float(np.abs(confidence).min()), 3)}
+
+
+def _run(task, path: str, *args) -> dict:
+  """
+  Runs task on the memory-mapped file in a worker, the errors it raises are reported
+    in the record
+  """
+  start = time.perf_counter()
+  record = {"path": path}
+  try:
+    with _read(path) as data:
+      record["bytes"] = len(data)
+      record.update(task(data, *args))
+  except Exception as e:
+    record["error"] = f"{type(e).__name__}: {e}"
+  record["seconds"] = round(time.perf_counter() - start, 6)
+  return record
+
+
+def run_jobs(task, jobs: Iterable[Tuple[str, tuple]], workers: int, progress: Progress,
+             checkpoint: Optional[Checkpoint] = None, out: Optional[TextIO] = None) -> int:
+  """
+  Runs task(data, *args) for every (path, args) of jobs on a pool of workers, at most
+    2 * workers files in flight, and writes the record of every file to out as it is done.
+  Returns the number of failed files.
+  """
+  out = out or sys.stdout
+  executor = ProcessPoolExecutor(
+    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+  def finish(futures):
+    for future in futures:
+      record = future.result()
+      # The record is written before the checkpoint, a file is never marked done
+      # without its record
+      out.write(json.dumps(record) + "\n")
+      out.flush()
+      # Failed files are retried and reported again on the next run
+      if checkpoint is not None and not _failed(record):
+        checkpoint.add(record["path"])
+      progress.update(record)
+
+  try:
+    pending = set()
+    for path, args in jobs:
+      if len(pending) >= 2 * workers:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        finish(done)
+      pending.add(executor.submit(_run, task, path, *args))
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      finish(done)
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+  return progress.failed
+
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(prog="watermark", description=__doc__.split("\n\n")[0])
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  common = argparse.ArgumentParser(add_help=False)
+  common.add_argument("inputs", nargs="+",
+                      help="directories, image files, or - to read paths from stdin")
+  common.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                      help="worker processes, defaults to the number of CPUs")
+  common.add_argument("--checkpoint",
+                      help="file listing the files done, which are skipped on the next run")
+  common.add_argument("--extensions", nargs="+", default=list(EXTENSIONS),
+                      help="extensions of the files picked up in directories")
+  common.add_argument("--progress-interval", type=float, default=5.0,
+                      help="seconds between throughput and ETA reports")
+
+  encode = commands.add_parser("encode", parents=[common], help="watermark images")
+  encode.add_argument("--output-dir", required=True)
+  encode.add_argument("--root",
+                      help="directory the outputs mirror the inputs' paths from, defaults "
+                           "to the deepest directory all inputs are in")
+  encode.add_argument("--watermark", default="SDV2")
+  encode.add_argument("--format", default=Filetype.PNG.value, choices=list(_OUTPUTS))
+  encode.add_argument("--jpeg-quality", type=int, default=75)
+  encode.add_argument("--resize-for-social-media", action="store_true")
+
+  decode = commands.add_parser("decode", parents=[common], help="decode watermarks")
+  decode.add_argument("--wm-length", type=int, default=32, help="watermark length in bits")
+  decode.add_argument("--fast", action="store_true",
+                      help="read JPEG chroma from the decoder, see decode_watermark")
+
+  verify = commands.add_parser("verify", parents=[common],
+                               help="check images carry a watermark, exits with 1 if not")
+  verify.add_argument("--watermark", default="SDV2")
+  verify.add_argument("--z-threshold", type=float, default=Z_THRESHOLD)
+  args = parser.parse_args(argv)
+
+  # Listed up front for the ETA, and so outputs written under an input directory
+  # are not picked up as inputs
+  paths = list(dict.fromkeys(
+    os.path.abspath(path) for path in list_files(args.inputs, args.extensions)))
+
+  # Everything that changes the result of a file, a checkpoint is only resumed with it
+  job = {"command": args.command}
+  if args.command == "encode":
+    file_type = _OUTPUTS[args.format]
+    options = {"watermark": args.watermark, "jpeg_quality": args.jpeg_quality,
+               "resize_for_social_media": args.resize_for_social_media}
+    job.update(options, output_dir=os.path.abspath(args.output_dir), format=args.format)
+    try:
+      outputs = output_paths(paths, args.output_dir, file_type.value, args.root)
+    except ValueError as e:
+      parser.error(str(e))
+    task = _encode_file
+    arguments = [(output, file_type, options) for output in outputs]
+  elif args.command == "decode":
+    job.update(wm_length=args.wm_length, fast=args.fast)
+    task = _decode_file
+    arguments = [(args.wm_length, args.fast)] * len(paths)
+  else:
+    job.update(watermark=args.watermark, z_threshold=args.z_threshold)
+    task = _verify_file
+    arguments = [(args.watermark, args.z_threshold)] * len(paths)
+
+  checkpoint = None
+  if args.checkpoint:
+    try:
+      checkpoint = Checkpoint(args.checkpoint, job)
+    except ValueError as e:
+      parser.error(str(e))
+  try:
+    jobs: List[Tuple[str, tuple]] = [
+      (path, path_arguments) for path, path_arguments in zip(paths, arguments)
+      if checkpoint is None or path not in checkpoint]
+    progress = Progress(len(jobs), interval=args.progress_interval)
+    try:
+      failed = run_jobs(task, jobs, max(args.workers, 1), progress, checkpoint)
+    except KeyboardInterrupt:
+      print(f"Interrupted: {progress.status()}", file=sys.stderr)
+      return 130
+    print(progress.status(), file=sys.stderr)
+  finally:
+    if checkpoint is not None:
+      checkpoint.close()
+  return 1 if failed else 0
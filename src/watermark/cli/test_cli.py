@@ -0,0 +1,149 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from PIL import Image
+
+from watermark.cli.cli import Checkpoint, Progress, list_files, main, output_paths
+
+
+def run(argv):
+  """Return status and JSON records of a CLI run"""
+  out = io.StringIO()
+  with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+    status = main(argv + ["--workers", "1"])
+  return status, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+class TestCli(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.inputs = os.path.join(self.directory.name, "inputs")
+    os.makedirs(os.path.join(self.inputs, "nested"))
+    with Image.open('../data/original.jpg') as img:
+      img = img.convert('RGB').resize((384, 320))
+    img.save(os.path.join(self.inputs, "a.jpg"))
+    img.rotate(90).save(os.path.join(self.inputs, "nested", "b.png"))
+    with open(os.path.join(self.inputs, "broken.jpg"), "wb") as f:
+      f.write(b"not an image")
+    with open(os.path.join(self.inputs, "notes.txt"), "w") as f:
+      f.write("skipped")
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def test_encode_decode_verify(self):
+    outputs = os.path.join(self.directory.name, "outputs")
+    checkpoint = os.path.join(self.directory.name, "encode.done")
+    encode = ["encode", self.inputs, "--output-dir", outputs, "--checkpoint", checkpoint]
+
+    status, records = run(encode)
+    self.assertEqual(1, status)
+    self.assertEqual(3, len(records))
+    errors = [record["path"] for record in records if "error" in record]
+    self.assertEqual([os.path.join(self.inputs, "broken.jpg")], errors)
+    written = sorted(
+      os.path.relpath(os.path.join(directory, name), outputs)
+      for directory, _, names in os.walk(outputs) for name in names)
+    self.assertEqual(["a.jpg.png", os.path.join("nested", "b.png.png")], written)
+    # Same mode as a file created with open()
+    umask = os.umask(0)
+    os.umask(umask)
+    self.assertEqual(0o666 & ~umask, os.stat(os.path.join(outputs, "a.jpg.png")).st_mode & 0o777)
+
+    # Resuming only retries the file that failed
+    status, records = run(encode)
+    self.assertEqual((1, 1), (status, len(records)))
+    # The checkpoint belongs to the job it was written for
+    with self.assertRaises(SystemExit):
+      run(encode[:-2] + ["--format", "jpeg", "--checkpoint", checkpoint])
+    with self.assertRaises(SystemExit):
+      run(["decode", self.inputs, "--checkpoint", checkpoint])
+
+    status, records = run(["decode", outputs])
+    self.assertEqual(0, status)
+    self.assertEqual(["SDV2", "SDV2"], [record["watermark"] for record in records])
+    self.assertTrue(all(record["seconds"] > 0 and record["bytes"] > 0 for record in records))
+
+    self.assertEqual(0, run(["verify", outputs, "--watermark", "SDV2"])[0])
+    status, records = run(["verify", outputs, "--watermark", "ABCD"])
+    self.assertEqual(1, status)
+    self.assertEqual([False, False], [record["match"] for record in records])
+
+  def test_resume_verify(self):
+    outputs = os.path.join(self.directory.name, "outputs")
+    run(["encode", os.path.join(self.inputs, "a.jpg"), "--output-dir", outputs])
+    # Not watermarked
+    os.rename(os.path.join(self.inputs, "nested", "b.png"), os.path.join(outputs, "b.png"))
+    checkpoint = os.path.join(self.directory.name, "verify.done")
+    verify = ["verify", outputs, "--watermark", "SDV2", "--checkpoint", checkpoint]
+
+    # Interrupted after the first file
+    with mock.patch("watermark.cli.cli.Progress.update", side_effect=[None, KeyboardInterrupt]):
+      self.assertEqual(130, run(verify)[0])
+    status, records = run(verify)
+    self.assertEqual(1, status)
+    self.assertEqual([os.path.join(outputs, "b.png")], [record["path"] for record in records])
+    self.assertFalse(records[0]["match"])
+
+    # A mismatch is never marked done
+    status, records = run(verify)
+    self.assertEqual((1, 1), (status, len(records)))
+
+  def test_list_files(self):
+    a = os.path.join(self.inputs, "a.jpg")
+    b = os.path.join(self.inputs, "nested", "b.png")
+    self.assertEqual(
+      [a, os.path.join(self.inputs, "broken.jpg"), b], list(list_files([self.inputs])))
+    self.assertEqual([a, b], list(list_files(["-"], stdin=io.StringIO(f"{a}\n\n{b}\n"))))
+
+  def test_output_paths(self):
+    paths = [os.path.join(self.inputs, "a", "img.jpg"), os.path.join(self.inputs, "b", "img.png")]
+    self.assertEqual(
+      [os.path.join("out", "a", "img.jpg.png"), os.path.join("out", "b", "img.png.png")],
+      output_paths(paths, "out", "png"))
+    self.assertEqual(
+      [os.path.join("out", "inputs", "a", "img.jpg.jpeg"),
+       os.path.join("out", "inputs", "b", "img.png.jpeg")],
+      output_paths(paths, "out", "jpeg", root=self.directory.name))
+
+    with self.assertRaises(ValueError):
+      output_paths(paths, "out", "png", root=os.path.join(self.inputs, "a"))
+    with self.assertRaises(ValueError):
+      output_paths(paths + paths[:1], "out", "png")
+
+  def test_checkpoint(self):
+    path = os.path.join(self.directory.name, "checkpoint")
+    job = {"command": "decode", "wm_length": 32}
+    checkpoint = Checkpoint(path, job)
+    checkpoint.add("a")
+    checkpoint.close()
+    # Interrupted while writing a line
+    with open(path, "a") as f:
+      f.write('"b')
+
+    checkpoint = Checkpoint(path, job)
+    checkpoint.add("c")
+    checkpoint.close()
+    checkpoint = Checkpoint(path, job)
+    self.assertEqual((True, False, True), ("a" in checkpoint, "b" in checkpoint, "c" in checkpoint))
+    checkpoint.close()
+
+    with self.assertRaises(ValueError):
+      Checkpoint(path, {"command": "decode", "wm_length": 64})
+
+  def test_progress(self):
+    stream = io.StringIO()
+    clock = mock.Mock(return_value=0.0)
+    progress = Progress(4, stream, interval=10, clock=clock)
+    clock.return_value = 20.0
+    progress.update({"bytes": 2 ** 20})
+    # Reported at most once every interval
+    progress.update({"error": "OSError"})
+    self.assertEqual(
+      "1/4 files, 0 failed, 0.1 files/s, 0.1 MiB/s, ETA 1m00s\n", stream.getvalue())
+    self.assertEqual(
+      "2/4 files, 1 failed, 0.1 files/s, 0.1 MiB/s, ETA 0m20s", progress.status())
@@ -0,0 +1,50 @@
+"""
+Warm up for short lived workers, run before the first request is accepted.
+"""
+import io
+import time
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from .apply_watermark import DEFAULT_OUTPUTS, Filetype, WatermarkedImage, decode_watermark
+from .encoder.watermark_encoder import WatermarkEncoder
+from .max_dct.max_dct_encoder import Engine
+from .transform.transform import Transform
+
+
+def warm_up(
+  shapes: Sequence[Tuple[int, int]] = ((512, 512),),
+  engine: Engine = Engine.VECTORIZED,
+  transform: Transform = Transform.HAAR,
+  outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+  watermark: str = "SDV2",
+  watermarker=None,
+) -> float:
+  """
+  Encodes and decodes a synthetic image per (rows, columns) shape, so the first request
+    does not pay for loading Pillow's codecs and NumPy's routines, compiling the Numba
+    kernel of the FUSED engine or importing PyWavelets for the PYWT transform.
+  watermarker: optional Watermarker whose bit plans and scratch buffers for these shapes
+    are filled as well.
+  Returns the seconds it took.
+  """
+  start_time = time.perf_counter()
+  encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'), engine=engine,
+                             transform=transform)
+  rng = np.random.default_rng(0)
+  for rows, columns in shapes:
+    rgb = rng.integers(0, 256, (rows, columns, 3), dtype=np.uint8)
+
+    encoded_img = WatermarkedImage(encoder.max_dwt_encode(rgb))
+    if watermarker is not None:
+      watermarker.encode(rgb, watermark)
+
+    for output in outputs:
+      encoded_bytes = encoded_img.get(output)
+      decode_watermark(encoded_bytes, wm_length=encoder.get_length())
+      if output == Filetype.JPEG:
+        decode_watermark(
+          io.BytesIO(encoded_bytes.getvalue()), wm_length=encoder.get_length(), fast=True)
+
+  return time.perf_counter() - start_time
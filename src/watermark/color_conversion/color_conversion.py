@@ -1,30 +1,158 @@
+from functools import lru_cache
+
 import numpy as np
 
+from . import lookup_table
+
+# Default dtype the conversions are computed in. Results are stored as uint8.
+COMPUTE_DTYPE = np.float32
+
+# Range of the YUV values yuv_to_rgb looks up products for, watermarked values can leave
+# 0-255. Pixels with values outside of it are converted in the compute dtype.
+YUV_TABLE_LOW, YUV_TABLE_HIGH = -256, 512
+
+RGB_TO_YUV = np.array([
+    [0.29900, -0.14713, 0.615],
+    [0.58700, -0.28886, -0.51499],
+    [0.11400, 0.436, -0.10001]
+  ])
+
+YUV_TO_RGB = np.array([
+    [1.000, 1.000, 1.000],
+    [0.000, -0.39465, 2.03211],
+    [1.13983, -0.58060, 0.000],
+  ])
+
+
+def rgb_to_yuv(rgb: np.ndarray, dtype=COMPUTE_DTYPE, out=None, scratch=None,
+               lookup_scratch=None) -> np.ndarray:
+  """
+  Same result as rgb_to_yuv_float, adding looked up products for uint8 RGB,
+    see lookup_table
+  lookup_scratch: optional scratch arrays of lookup_table.add_products.
+  """
+  if rgb.dtype != np.uint8:
+    return rgb_to_yuv_float(rgb, dtype, out=out, scratch=scratch)
+
+  yuv, weighted = scratch if scratch is not None else (
+    np.empty(rgb.shape, dtype), np.empty(rgb.shape, dtype))
+  lookup_table.add_products(rgb, _product_tables("rgb_to_yuv", np.dtype(dtype)), 0,
+                            yuv, weighted, lookup_scratch)
+  # Adding 0 leaves Y as it is, and is faster than adding to the U and V slice
+  yuv += np.array([0, 127.5, 127.5], dtype=dtype)
+  return _to_uint8(yuv, out)
+
+
+def rgb_to_yuv_float(rgb: np.ndarray, dtype=COMPUTE_DTYPE, out=None,
+                     scratch=None) -> np.ndarray:
+  """
+  Converts (..., 3) RGB to uint8 YUV, computed in dtype as
+    (R * m[0] + G * m[1]) + B * m[2]
+  out: optional uint8 array to write the result to.
+  scratch: optional pair of dtype arrays shaped like rgb, used instead of allocating
+    the intermediate results.
+  """
+  m = RGB_TO_YUV.astype(dtype)
+  yuv, weighted = scratch if scratch is not None else (None, None)
+
+  yuv = np.multiply(rgb[..., 0, None], m[0], out=yuv, dtype=dtype)
+  if weighted is None:
+    weighted = np.empty_like(yuv)
+  for channel in range(1, 3):
+    np.multiply(rgb[..., channel, None], m[channel], out=weighted, dtype=dtype)
+    yuv += weighted
+  del weighted
+
+  yuv[..., 1:] += m.dtype.type(127.5)
+  return _to_uint8(yuv, out)
+
+
+def rgb_to_yuv_plane(rgb: np.ndarray, channel: int, dtype=COMPUTE_DTYPE) -> np.ndarray:
+  """
+  A single channel (0 Y, 1 U, 2 V) of rgb_to_yuv, before clipping and rounding.
+  Computed the same way, so rint(clip(plane, 0, 255)) equals rgb_to_yuv(rgb)[..., channel]
+  """
+  m = RGB_TO_YUV[:, channel].astype(dtype)
+
+  plane = np.multiply(rgb[..., 0], m[0], dtype=dtype)
+  weighted = np.empty_like(plane)
+  for rgb_channel in range(1, 3):
+    np.multiply(rgb[..., rgb_channel], m[rgb_channel], out=weighted, dtype=dtype)
+    plane += weighted
+
+  if channel > 0:
+    plane += m.dtype.type(127.5)
+  return plane
+
+
+def yuv_to_rgb(yuv: np.ndarray, dtype=COMPUTE_DTYPE, out=None, scratch=None,
+               lookup_scratch=None) -> np.ndarray:
+  """
+  Same result as yuv_to_rgb_float, adding looked up products for integer YUV,
+    see lookup_table. Pixels with values outside of YUV_TABLE_LOW to YUV_TABLE_HIGH are
+    converted in dtype.
+  lookup_scratch: optional scratch arrays of lookup_table.add_products.
+  """
+  if not np.issubdtype(yuv.dtype, np.integer):
+    return yuv_to_rgb_float(yuv, dtype, out=out, scratch=scratch)
+
+  rgb, weighted = scratch[1:] if scratch is not None else (
+    np.empty(yuv.shape, dtype), np.empty(yuv.shape, dtype))
+  outside = lookup_table.add_products(
+    yuv, _product_tables("yuv_to_rgb", np.dtype(dtype)), YUV_TABLE_LOW, rgb, weighted,
+    lookup_scratch)
+  rgb = _to_uint8(rgb, out)
+  if outside.any():
+    rgb[outside] = yuv_to_rgb_float(yuv[outside], dtype)
+  return rgb
+
+
+def yuv_to_rgb_float(yuv: np.ndarray, dtype=COMPUTE_DTYPE, out=None,
+                     scratch=None) -> np.ndarray:
+  """
+  Converts (..., 3) YUV, which may be outside of 0-255 after watermarking,
+    to uint8 RGB, computed in dtype as
+    (Y * m[0] + (U - 127.5) * m[1]) + (V - 127.5) * m[2]
+  out: optional uint8 array to write the result to.
+  scratch: optional triple of dtype arrays shaped like yuv, used instead of allocating
+    the intermediate results.
+  """
+  m = YUV_TO_RGB.astype(dtype)
+
+  if scratch is None:
+    yuv = yuv.astype(dtype)
+    rgb, weighted = None, None
+  else:
+    np.copyto(scratch[0], yuv)
+    yuv, rgb, weighted = scratch
+  yuv[..., 1:] -= m.dtype.type(127.5)
+
+  rgb = np.multiply(yuv[..., 0, None], m[0], out=rgb)
+  if weighted is None:
+    weighted = np.empty_like(rgb)
+  for channel in range(1, 3):
+    np.multiply(yuv[..., channel, None], m[channel], out=weighted)
+    rgb += weighted
+  del weighted, yuv
+
+  return _to_uint8(rgb, out)
+
+
+@lru_cache(maxsize=None)
+def _product_tables(conversion: str, dtype: np.dtype):
+  if conversion == "rgb_to_yuv":
+    return lookup_table.product_tables(RGB_TO_YUV, (0, 0, 0), 0, 256, dtype)
+  return lookup_table.product_tables(
+    YUV_TO_RGB, (0, 127.5, 127.5), YUV_TABLE_LOW, YUV_TABLE_HIGH, dtype)
+
 
-def rgb_to_yuv(rgb: np.ndarray) -> np.ndarray:
-  m = np.array([
-      [0.29900, -0.14713, 0.615],
-      [0.58700, -0.28886, -0.51499],
-      [0.11400, 0.436, -0.10001]
-    ])
-
-  # rgb = rgb.astype(float)
-  yuv = np.dot(rgb, m)
-  yuv[:, :, 1:] += 127.5
-  yuv = np.clip(yuv, 0, 255)
-  # return yuv
-  return np.round(yuv).astype(int)
-
-
-def yuv_to_rgb(yuv: np.ndarray) -> np.ndarray:
-  yuv = yuv.astype(float)
-  m = np.array([
-      [1.000, 1.000, 1.000],
-      [0.000, -0.39465, 2.03211],
-      [1.13983, -0.58060, 0.000],
-    ])
-
-  yuv[:, :, 1:] -= 127.5
-  rgb = np.dot(yuv, m)
-  rgb = np.clip(rgb, 0, 255)
-  return np.round(rgb).astype(int)
+def _to_uint8(values: np.ndarray, out=None) -> np.ndarray:
+  """
+  Clips values to 0-255 in place and rounds them to uint8, into out if given
+  """
+  np.clip(values, 0, 255, out=values)
+  np.rint(values, out=values)
+  if out is None:
+    return values.astype(np.uint8)
+  np.copyto(out, values, casting='unsafe')
+  return out
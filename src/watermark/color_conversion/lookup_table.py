@@ -0,0 +1,66 @@
+"""
+Product tables of the color conversions.
+
+rgb_to_yuv_float and yuv_to_rgb_float compute one product per input channel in the
+compute dtype and add the three products in a fixed order. A table holding the products
+of every value a channel can take gives the same products, so adding looked up
+products in the same order gives identical results, without the int to float casts and
+the multiplications. The tables of a conversion take a few kilobytes.
+"""
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def product_tables(matrix: np.ndarray, offsets: Sequence[float], low: int, high: int,
+                   dtype) -> List[np.ndarray]:
+  """
+  One table per input channel c, of the products (v - offsets[c]) * matrix[c] of the
+  values v from low to high, computed in dtype as the float conversions compute them.
+  The 3 products of a value are a single void item, so looking them up is one copy.
+  """
+  m = matrix.astype(dtype)
+  values = np.arange(low, high).astype(dtype)
+  tables = []
+  for channel in range(3):
+    shifted = values - m.dtype.type(offsets[channel]) if offsets[channel] else values
+    products = np.multiply(shifted[:, None], m[channel])
+    tables.append(products.view(f"V{3 * products.itemsize}")[:, 0])
+  return tables
+
+
+def add_products(pixels: np.ndarray, tables: Sequence[np.ndarray], low: int,
+                 out: np.ndarray, weighted: np.ndarray, scratch=None) -> Optional[np.ndarray]:
+  """
+  Adds the products of the channels of (..., 3) integer pixels looked up in tables into
+  out, in channel order like the float conversions.
+  out, weighted: C contiguous arrays of the tables' dtype, shaped like pixels.
+  scratch: optional triple of an intp and two bool arrays shaped like a channel of
+    pixels, used instead of allocating the indices and the mask.
+  Returns the mask of the pixels with a value outside of the tables' range, whose
+  products are arbitrary, or None if uint8 pixels cannot have one.
+  """
+  item = tables[0].dtype
+  size = tables[0].size
+  checked = not (pixels.dtype == np.uint8 and low == 0 and size >= 256)
+  if scratch is not None:
+    index, outside, mask = scratch
+  else:
+    shape = pixels.shape[:-1]
+    # np.take converts other indices to intp itself
+    index = np.empty(shape, dtype=np.intp)
+    outside = np.empty(shape, dtype=bool) if checked else None
+    mask = np.empty(shape, dtype=bool) if checked else None
+  if checked:
+    outside[...] = False
+  for channel in range(3):
+    np.subtract(pixels[..., channel], low, out=index, dtype=np.intp)
+    if checked:
+      # Values below the range are negative, so at least size once read as unsigned
+      np.greater_equal(index.view(np.uintp), size, out=mask)
+      outside |= mask
+    target = out if channel == 0 else weighted
+    np.take(tables[channel], index, out=target.view(item)[..., 0], mode='clip')
+    if channel > 0:
+      out += weighted
+  return outside if checked else None
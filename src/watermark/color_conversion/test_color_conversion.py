@@ -3,7 +3,7 @@ import numpy as np
 from PIL import Image
 import cv2
 
-from color_conversion import color_conversion
+from watermark.color_conversion import color_conversion
 
 
 def original_image():
@@ -34,7 +34,7 @@ class TestColorConversion(unittest.TestCase):
       Image.fromarray(np.uint8(yuv_expected)).save("yuv_expected.png")
       Image.fromarray(np.uint8(yuv_actual)).save("yuv_actual.png")
 
-      diff = yuv_expected - yuv_actual
+      diff = yuv_expected.astype(int) - yuv_actual
       big_diff = np.where(abs(diff) > 1)
 
       print(diff[big_diff])
@@ -47,7 +47,7 @@ class TestColorConversion(unittest.TestCase):
       Image.fromarray(np.uint8(rgb_expected)).save("rgb_expected.png")
       Image.fromarray(np.uint8(rgb_actual)).save("rgb_actual.png")
 
-      diff = rgb_expected - rgb_actual
+      diff = rgb_expected.astype(int) - rgb_actual
       big_diff = np.where(abs(diff) > 2)
 
       print(diff[big_diff])
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+
+from watermark.color_conversion import color_conversion
+from watermark.color_conversion.lookup_table import add_products, product_tables
+
+
+class TestLookupTable(unittest.TestCase):
+  def test_add_products(self):
+    matrix = np.arange(9, dtype=np.float64).reshape(3, 3)
+    tables = product_tables(matrix, (0, 1, 2), -4, 8, np.float32)
+    pixels = np.array([[[-4, 0, 7], [1, 2, 3]]], dtype=np.int16)
+
+    out = np.empty(pixels.shape, np.float32)
+    outside = add_products(pixels, tables, -4, out, np.empty_like(out))
+    np.testing.assert_array_equal([[False, False]], outside)
+    expected = pixels[..., 0, None] * matrix[0] + (pixels[..., 1, None] - 1) * matrix[1]
+    expected += (pixels[..., 2, None] - 2) * matrix[2]
+    np.testing.assert_array_equal(expected, out)
+
+    pixels[0, 1, 1] = 8
+    outside = add_products(pixels, tables, -4, out, np.empty_like(out))
+    np.testing.assert_array_equal([[False, True]], outside)
+    self.assertIsNone(add_products(
+      np.zeros((2, 3), np.uint8), product_tables(matrix, (0, 0, 0), 0, 256, np.float32),
+      0, np.empty((2, 3), np.float32), np.empty((2, 3), np.float32)))
+
+  def test_same_as_float(self):
+    # Every 8-bit color, 2^18 at a time to keep the float64 arrays small
+    chunk = 2 ** 18
+    for start in range(0, 2 ** 24, chunk):
+      colors = np.arange(start, start + chunk, dtype=np.uint32)
+      rgb = np.stack([colors >> 16, colors >> 8, colors], axis=-1).astype(np.uint8)
+      for dtype in [np.float32, np.float64]:
+        np.testing.assert_array_equal(
+          color_conversion.rgb_to_yuv_float(rgb, dtype), color_conversion.rgb_to_yuv(rgb, dtype))
+
+    # Watermarked YUV, partly outside of 0-255 and of the tables' range
+    rng = np.random.default_rng(0)
+    yuv = rng.integers(-40, 300, (64, 48, 3)).astype(np.int16)
+    yuv[0, :3] = [[-300, 0, 0], [0, 600, 0], [255, 255, color_conversion.YUV_TABLE_HIGH]]
+    expected = color_conversion.yuv_to_rgb_float(yuv)
+    np.testing.assert_array_equal(expected, color_conversion.yuv_to_rgb(yuv))
+
+    out = np.zeros((3, 64, 48), dtype=np.uint8)
+    color_conversion.yuv_to_rgb(yuv, out=np.moveaxis(out, 0, -1))
+    np.testing.assert_array_equal(expected, np.moveaxis(out, 0, -1))
@@ -3,7 +3,7 @@ import numpy as np
 import cv2
 from PIL import Image
 
-from encoder.watermark_encoder import WatermarkEncoder, WatermarkDecoder
+from watermark.encoder.watermark_encoder import WatermarkEncoder, WatermarkDecoder
 
 
 def original_image():
@@ -52,3 +52,19 @@ class TestMaxDctEncode(unittest.TestCase):
       # encoded_img = cv2.cvtColor(np.uint8(encoded_img), cv2.COLOR_RGB2BGR)
       # cv2.imwrite(
       #   f"../data/expected_encoded/encoded_{name}.{file_code}", encoded_img)
+
+  def test_compute_dtype_keeps_decoded_bits(self):
+    content = b"SDV2"
+    for image in [original_image(), peppers_image()]:
+      decoded = set()
+      for encode_dtype in [np.float64, np.float32]:
+        encoder = WatermarkEncoder(content=content, dtype=encode_dtype)
+        encoded_img = encoder.max_dwt_encode(image)
+        self.assertEqual(np.uint8, encoded_img.dtype)
+
+        for decode_dtype in [np.float64, np.float32]:
+          decoder = WatermarkDecoder(
+            wm_length=encoder.get_length(), dtype=decode_dtype)
+          decoded.add(decoder.decode(encoded_img))
+
+      self.assertEqual({content}, decoded)
@@ -1,32 +1,61 @@
 
-from max_dct.max_dct_encoder import EmbedMaxDct, DecodeMaxDct
+from ..max_dct.max_dct_encoder import EmbedMaxDct, DecodeMaxDct, Engine, Z_THRESHOLD
+from ..color_conversion.color_conversion import COMPUTE_DTYPE
+from ..instrumentation.instrumentation import stage
+from ..transform.transform import Transform
 import struct
 import numpy as np
 
 
 class WatermarkEncoder(object):
-  def __init__(self, content=b''):
+  def __init__(self, content=b'', engine: Engine = Engine.VECTORIZED, workers: int = 1,
+               dtype=COMPUTE_DTYPE, pixel_delta: bool = False,
+               transform: Transform = Transform.HAAR, hooks=None):
+    """
+    hooks: optional instrumentation.Hooks the stage durations are reported to
+    """
     seq = np.array([n for n in content], dtype=np.uint8)
     self._watermarks = list(np.unpackbits(seq))
     self._wmLen = len(self._watermarks)
+    self._engine = engine
+    self._workers = workers
+    self._dtype = dtype
+    self._pixel_delta = pixel_delta
+    self._transform = transform
+    self._hooks = hooks
+    # Created on first use, then kept with its thread pool
+    self._embed = None
 
   def get_length(self):
     return self._wmLen
 
   def max_dwt_encode(self, rgb: np.ndarray) -> np.ndarray:
-    rows, columns, _ = rgb.shape
+    """
+    rgb is a (rows, columns, 3) image or a stack (..., rows, columns, 3) of
+    same shaped images
+    """
+    rows, columns, _ = rgb.shape[-3:]
 
     if rows * columns < 256 * 256:
       raise RuntimeError(
           'image too small, should be larger than 256x256')
 
-    embed = EmbedMaxDct(self._watermarks)
-    return embed.encode_rgb(rgb)
+    if self._embed is None:
+      self._embed = EmbedMaxDct(
+          self._watermarks, engine=self._engine, workers=self._workers, dtype=self._dtype,
+          pixel_delta=self._pixel_delta, transform=self._transform, hooks=self._hooks)
+    with stage(self._hooks, "watermark", rgb.size // 3):
+      return self._embed.encode_rgb(rgb)
 
 
 class WatermarkDecoder(object):
-  def __init__(self, wm_length=0):
+  def __init__(self, wm_length=0, engine: Engine = Engine.VECTORIZED, dtype=COMPUTE_DTYPE,
+               transform: Transform = Transform.HAAR, hooks=None):
     self._wmLen = wm_length
+    self._engine = engine
+    self._dtype = dtype
+    self._transform = transform
+    self._hooks = hooks
 
   def _reconstruct_bytes(self, bits):
     nums = np.packbits(bits)
@@ -42,6 +71,35 @@ class WatermarkDecoder(object):
           'image too small, should be larger than 256x256')
 
     bits = []
-    embed = DecodeMaxDct(wm_length=self._wmLen)
+    embed = DecodeMaxDct(
+        wm_length=self._wmLen, engine=self._engine, dtype=self._dtype,
+        transform=self._transform, hooks=self._hooks)
     bits = embed.decode_rgb(rgb)
     return self._reconstruct_bytes(bits)
+
+  def decode_sampled(self, rgb, z_threshold: float = Z_THRESHOLD, seed: int = 0):
+    """
+    Decodes from a random sample of blocks until every bit reaches z_threshold, see
+    DecodeMaxDct.decode_rgb_sampled. Returns the bytes and the z-score of every bit.
+    """
+    rows, columns, _ = rgb.shape
+    if rows * columns < 256 * 256:
+      raise RuntimeError(
+          'image too small, should be larger than 256x256')
+
+    embed = DecodeMaxDct(
+        wm_length=self._wmLen, engine=self._engine, dtype=self._dtype,
+        transform=self._transform, hooks=self._hooks)
+    bits, confidence = embed.decode_rgb_sampled(rgb, z_threshold, seed=seed)
+    return self._reconstruct_bytes(bits), confidence
+
+  def decode_approximations(self, approximations) -> bytes:
+    """
+    Decodes from the Haar approximation band of each channel, see
+    DecodeMaxDct.decode_approximations
+    """
+    embed = DecodeMaxDct(
+        wm_length=self._wmLen, engine=self._engine, dtype=self._dtype,
+        transform=self._transform, hooks=self._hooks)
+    bits = embed.decode_approximations(approximations)
+    return self._reconstruct_bytes(bits)
@@ -0,0 +1,40 @@
+"""
+Optional fused RGB -> watermarked RGB kernel, compiled with Numba when it is installed.
+
+With Haar and block x block DCT blocks, every watermark block only depends on a
+2 * block square pixel tile. The kernel converts a tile to YUV, subsamples the chroma,
+takes the Haar transform, embeds the bit and converts back in one pass, instead of the
+six or so full image passes of EmbedMaxDct.encode_rgb.
+
+Every float operation is done in float32 and in the same order as the NumPy / PyWavelets
+path, so the output is identical to EmbedMaxDct.encode_rgb with float32 compute dtype.
+Numba is imported and the kernel compiled on first use, compiled kernels are cached on disk.
+"""
+import importlib.util
+import numpy as np
+
+from ..color_conversion.color_conversion import RGB_TO_YUV, YUV_TO_RGB
+
+
+def available() -> bool:
+  return importlib.util.find_spec("numba") is not None
+
+
+def encode_rgb(rgb: np.ndarray, watermarks, scales, block: int, out=None) -> np.ndarray:
+  """
+  Same result as EmbedMaxDct(watermarks, scales, block).encode_rgb(rgb) computed in
+  float32, for a (rows, columns, 3) image or a stack (..., rows, columns, 3).
+  out: optional C contiguous uint8 array to write the result to
+  """
+  # Importing the kernels module imports Numba, the kernels compile on their first call
+  from . import kernels
+
+  rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+  encoded = np.empty_like(rgb) if out is None else out
+  bits = np.asarray(watermarks, dtype=np.float64)
+  scales = np.asarray(scales[:2], dtype=np.float32)
+  for index in np.ndindex(rgb.shape[:-3]):
+    kernels.encode_tiles(
+      rgb[index], encoded[index], bits, scales, RGB_TO_YUV.astype(np.float32),
+      YUV_TO_RGB.astype(np.float32), kernels.CONSTANTS, block)
+  return encoded
@@ -0,0 +1,161 @@
+"""
+Numba kernels of the fused encoder, imported on first use only.
+"""
+import numba
+import numpy as np
+
+# float32 constants, so nothing in the kernels gets promoted to float64
+_ZERO, _MAX, _OFFSET, _QUARTER, _HAAR = range(5)
+CONSTANTS = np.array(
+  [0, 255, 127.5, 0.25, 0.7071067811865476], dtype=np.float32)
+
+
+@numba.njit(cache=True, nogil=True)
+def _to_yuv(rgb, m, c, channel):
+  """
+  rint(clip(RGB -> YUV channel)), as color_conversion.rgb_to_yuv
+  """
+  value = np.float32(rgb[0]) * m[0, channel]
+  value += np.float32(rgb[1]) * m[1, channel]
+  value += np.float32(rgb[2]) * m[2, channel]
+  if channel > 0:
+    value += c[_OFFSET]
+  return np.rint(min(max(value, c[_ZERO]), c[_MAX]))
+
+
+@numba.njit(cache=True, nogil=True)
+def _to_rgb(yuv, out, m, c):
+  """
+  YUV -> uint8 RGB, as color_conversion.yuv_to_rgb
+  """
+  y = yuv[0]
+  u = yuv[1] - c[_OFFSET]
+  v = yuv[2] - c[_OFFSET]
+  for channel in range(3):
+    value = y * m[0, channel]
+    value += u * m[1, channel]
+    value += v * m[2, channel]
+    out[channel] = np.uint8(np.rint(min(max(value, c[_ZERO]), c[_MAX])))
+
+
+@numba.njit(cache=True, nogil=True)
+def _forward(x, ca, cv, ch, cd, i, j, c):
+  """
+  pywt.dwt2(x, 'haar') of the 2x2 pixel group (i, j), axis 0 first
+  """
+  s = c[_HAAR]
+  lo0 = s * x[2 * i + 1, 2 * j] + s * x[2 * i, 2 * j]
+  lo1 = s * x[2 * i + 1, 2 * j + 1] + s * x[2 * i, 2 * j + 1]
+  hi0 = -s * x[2 * i + 1, 2 * j] + s * x[2 * i, 2 * j]
+  hi1 = -s * x[2 * i + 1, 2 * j + 1] + s * x[2 * i, 2 * j + 1]
+  ca[i, j] = s * lo1 + s * lo0
+  cv[i, j] = -s * lo1 + s * lo0
+  ch[i, j] = s * hi1 + s * hi0
+  cd[i, j] = -s * hi1 + s * hi0
+
+
+@numba.njit(cache=True, nogil=True)
+def _inverse(x, ca, cv, ch, cd, i, j, c):
+  """
+  pywt.idwt2((ca, (cv, ch, cd)), 'haar') of the 2x2 pixel group (i, j), last axis
+  first, truncated to integers like the int16 YUV image of the encoder
+  """
+  s = c[_HAAR]
+  a0 = s * ca[i, j] + s * ch[i, j]
+  a1 = s * ca[i, j] + -s * ch[i, j]
+  d0 = s * cv[i, j] + s * cd[i, j]
+  d1 = s * cv[i, j] + -s * cd[i, j]
+  x[2 * i, 2 * j] = np.float32(int(s * a0 + s * d0))
+  x[2 * i, 2 * j + 1] = np.float32(int(s * a1 + s * d1))
+  x[2 * i + 1, 2 * j] = np.float32(int(s * a0 + -s * d0))
+  x[2 * i + 1, 2 * j + 1] = np.float32(int(s * a1 + -s * d1))
+
+
+@numba.njit(cache=True, nogil=True)
+def _embed(ca, bit, scale, c):
+  """
+  EmbedMaxDct.diffuse_dct_matrix of one block
+  """
+  block = ca.shape[0]
+  pos = 1
+  largest = abs(ca[0, 1])
+  for k in range(2, block * block):
+    if abs(ca[k // block, k % block]) > largest:
+      largest = abs(ca[k // block, k % block])
+      pos = k
+
+  i, j = pos // block, pos % block
+  val = ca[i, j]
+  quantized = (np.float64(abs(val) // scale + c[_QUARTER]) + 0.5 * bit) * np.float64(scale)
+  if val >= 0:
+    ca[i, j] = np.float32(quantized)
+  else:
+    ca[i, j] = np.float32(-quantized)
+
+
+@numba.njit(cache=True, nogil=True)
+def encode_tiles(rgb, out, bits, scales, m, m_inverse, c, block):
+  """
+  Watermarks rgb (rows, columns, 3) into out, tile by tile
+  """
+  rows, columns = rgb.shape[0], rgb.shape[1]
+  last_processed_row = rows // block * block
+  last_processed_col = columns // block * block
+  half_rows, half_cols = last_processed_row // 2, last_processed_col // 2
+  blocks_per_row = half_cols // block
+  wm_len = bits.shape[0]
+
+  tile = np.empty((3, 2 * block, 2 * block), dtype=np.float32)
+  ca = np.empty((block, block), dtype=np.float32)
+  cv = np.empty_like(ca)
+  ch = np.empty_like(ca)
+  cd = np.empty_like(ca)
+  yuv = np.empty(3, dtype=np.float32)
+
+  for ty in range((half_rows + block - 1) // block):
+    for tx in range((half_cols + block - 1) // block):
+      # Number of 2x2 pixel groups of this tile, smaller than block at the edges
+      h = min(block, half_rows - ty * block)
+      w = min(block, half_cols - tx * block)
+      y0, x0 = 2 * block * ty, 2 * block * tx
+
+      for i in range(2 * h):
+        for j in range(2 * w):
+          pixel = rgb[y0 + i, x0 + j]
+          tile[0, i, j] = _to_yuv(pixel, m, c, 0)
+          tile[2, i, j] = _to_yuv(pixel, m, c, 2)
+          # 4:2:0 subsampling keeps the top left U of every 2x2 group
+          if i % 2 == 0 and j % 2 == 0:
+            tile[1, i, j] = _to_yuv(pixel, m, c, 1)
+          else:
+            tile[1, i, j] = tile[1, i - i % 2, j - j % 2]
+
+      for channel in range(2):
+        if scales[channel] <= 0:
+          continue
+        for i in range(h):
+          for j in range(w):
+            _forward(tile[channel], ca, cv, ch, cd, i, j, c)
+        if h == block and w == block:
+          num = ty * blocks_per_row + tx
+          _embed(ca, bits[num % wm_len], scales[channel], c)
+        for i in range(h):
+          for j in range(w):
+            _inverse(tile[channel], ca, cv, ch, cd, i, j, c)
+
+      for i in range(2 * h):
+        for j in range(2 * w):
+          yuv[0] = tile[0, i, j]
+          yuv[1] = tile[1, i, j]
+          yuv[2] = tile[2, i, j]
+          _to_rgb(yuv, out[y0 + i, x0 + j], m_inverse, c)
+
+  # Pixels right of or below the transformed region only get subsampled
+  for y in range(rows):
+    for x in range(columns):
+      if y < last_processed_row and x < last_processed_col:
+        continue
+      yuv[0] = _to_yuv(rgb[y, x], m, c, 0)
+      yuv[1] = _to_yuv(rgb[y - y % 2, x - x % 2], m, c, 1)
+      yuv[2] = _to_yuv(rgb[y, x], m, c, 2)
+      _to_rgb(yuv, out[y, x], m_inverse, c)
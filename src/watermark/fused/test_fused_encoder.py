@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+import cv2
+
+from watermark.fused import fused_encoder
+from watermark.max_dct import max_dct_encoder
+
+
+def original_image():
+  img = cv2.imread("../data/original.jpg")
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def peppers_image():
+  img = cv2.imread("../data/peppers.png")
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def SDV2_watermark():
+  wm = "SDV2".encode("utf-8")
+  seq = np.array([n for n in wm], dtype=np.uint8)
+  return list(np.unpackbits(seq))
+
+
+@unittest.skipUnless(fused_encoder.available(), "numba is not installed")
+class TestFusedEncoder(unittest.TestCase):
+  def test_matches_max_dct_encoder(self):
+    rng = np.random.default_rng(0)
+    for scales in [[0, 36, 36], [20, 36, 36]]:
+      vectorized = max_dct_encoder.EmbedMaxDct(
+        watermarks=SDV2_watermark(), scales=scales)
+      fused = max_dct_encoder.EmbedMaxDct(
+        watermarks=SDV2_watermark(), scales=scales, engine=max_dct_encoder.Engine.FUSED)
+
+      for image in [
+        original_image(),
+        peppers_image(),
+        # Odd sizes leave pixels outside of the transformed region
+        rng.integers(0, 256, (301, 259, 3), dtype=np.uint8),
+        # Stack of images
+        rng.integers(0, 256, (2, 262, 270, 3), dtype=np.uint8),
+      ]:
+        self.assertTrue(np.array_equal(
+          vectorized.encode_rgb(image), fused.encode_rgb(image)))
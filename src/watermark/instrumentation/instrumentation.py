@@ -0,0 +1,142 @@
+"""
+Hooks reporting how long each stage of the watermark pipeline takes.
+
+apply_watermark, decode_watermark, WatermarkEncoder / WatermarkDecoder and
+EmbedMaxDct / DecodeMaxDct take an optional hooks object and report every stage to
+its record method:
+
+  hooks.record(stage, seconds, pixels=0, bytes_in=0, bytes_out=0)
+
+Stages nest, e.g. block_embed is part of transform, which is part of watermark.
+Without hooks, stage() returns a shared no-op context manager and nothing is timed.
+"""
+import bisect
+import threading
+import time
+
+
+class Hooks(object):
+  """
+  Base class for hooks, ignores everything
+  """
+
+  def record(self, stage: str, seconds: float, pixels: int = 0, bytes_in: int = 0,
+             bytes_out: int = 0):
+    pass
+
+
+class _Stage(object):
+  __slots__ = ("_hooks", "_name", "_start", "pixels", "bytes_in", "bytes_out")
+
+  def __init__(self, hooks, name: str, pixels: int, bytes_in: int):
+    self._hooks = hooks
+    self._name = name
+    self.pixels = pixels
+    self.bytes_in = bytes_in
+    self.bytes_out = 0
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self._hooks.record(
+      self._name, time.perf_counter() - self._start, self.pixels, self.bytes_in,
+      self.bytes_out)
+
+
+class _NullStage(object):
+  """
+  Stage used without hooks. Counts set on it, e.g. bytes_out, are dropped.
+  """
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    pass
+
+  def __setattr__(self, name, value):
+    pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(hooks, name: str, pixels: int = 0, bytes_in: int = 0):
+  """
+  Context manager timing the stage name and reporting it to hooks when it ends.
+  Counts only known at the end can be set on the object it returns:
+
+    with stage(hooks, "png_save", pixels) as saved:
+      ...
+      saved.bytes_out = len(png_bytes)
+  """
+  if hooks is None:
+    return _NULL_STAGE
+  return _Stage(hooks, name, pixels, bytes_in)
+
+
+# Upper bounds, in seconds, of the histogram buckets: 100us to ~100s, 4 per decade
+DEFAULT_BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-16, 9))
+
+
+class HistogramHooks(Hooks):
+  """
+  Aggregates durations into a histogram per stage, with totals of the counts.
+  Safe to share between threads.
+  """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self._buckets = tuple(buckets)
+    self._stages = {}
+    self._lock = threading.Lock()
+
+  def record(self, stage: str, seconds: float, pixels: int = 0, bytes_in: int = 0,
+             bytes_out: int = 0):
+    with self._lock:
+      summary = self._stages.get(stage)
+      if summary is None:
+        summary = self._stages[stage] = {
+          "count": 0, "seconds": 0.0, "pixels": 0, "bytes_in": 0, "bytes_out": 0,
+          # The last bucket counts durations above the largest bound
+          "buckets": [0] * (len(self._buckets) + 1),
+        }
+      summary["count"] += 1
+      summary["seconds"] += seconds
+      summary["pixels"] += pixels
+      summary["bytes_in"] += bytes_in
+      summary["bytes_out"] += bytes_out
+      summary["buckets"][bisect.bisect_left(self._buckets, seconds)] += 1
+
+  @property
+  def buckets(self):
+    return self._buckets
+
+  def snapshot(self) -> dict:
+    """
+    Copy of the summary of every stage
+    """
+    with self._lock:
+      return {
+        stage: dict(summary, buckets=list(summary["buckets"]))
+        for stage, summary in self._stages.items()}
+
+  def percentile(self, stage: str, q: float) -> float:
+    """
+    Upper bound of the bucket holding the q-th percentile (0-100) of stage,
+    inf if it is in the overflow bucket
+    """
+    with self._lock:
+      summary = self._stages[stage]
+      rank = q / 100 * summary["count"]
+      seen = 0
+      for bound, count in zip(self._buckets + (float("inf"),), summary["buckets"]):
+        seen += count
+        if seen >= rank and seen > 0:
+          return bound
+      return float("inf")
+
+  def reset(self):
+    with self._lock:
+      self._stages = {}
@@ -0,0 +1,54 @@
+import io
+import unittest
+
+from watermark.apply_watermark import apply_watermark, decode_watermark
+from watermark.instrumentation.instrumentation import HistogramHooks, stage
+
+
+WATERMARK = "SDV2"
+
+
+def peppers_image_bytes() -> bytes:
+  with open('../data/peppers.png', 'rb') as f:
+    return f.read()
+
+
+class TestInstrumentation(unittest.TestCase):
+  def test_encode_decode_stages(self):
+    img_bytes = peppers_image_bytes()
+    hooks = HistogramHooks()
+    encoded_jpg, encoded_png = apply_watermark(img_bytes, watermark=WATERMARK, hooks=hooks)
+
+    stages = hooks.snapshot()
+    for name in ["image_decode", "to_rgb", "watermark", "rgb_to_yuv", "subsample",
+                 "transform", "block_embed", "yuv_to_rgb", "jpeg_save", "png_save"]:
+      self.assertEqual(1, stages[name]["count"], name)
+    self.assertEqual(len(img_bytes), stages["image_decode"]["bytes_in"])
+    self.assertEqual(600 * 600, stages["image_decode"]["pixels"])
+    self.assertEqual(len(encoded_png.getvalue()), stages["png_save"]["bytes_out"])
+    self.assertEqual(len(encoded_jpg.getvalue()), stages["jpeg_save"]["bytes_out"])
+
+    hooks.reset()
+    self.assertEqual(WATERMARK, decode_watermark(encoded_png, hooks=hooks))
+    self.assertEqual(WATERMARK, decode_watermark(encoded_jpg, fast=True, hooks=hooks))
+    stages = hooks.snapshot()
+    for name in ["image_decode", "rgb_to_yuv", "transform", "jpeg_chroma_decode"]:
+      self.assertEqual(1, stages[name]["count"], name)
+    self.assertEqual(2, stages["block_decode"]["count"])
+
+  def test_histogram(self):
+    hooks = HistogramHooks(buckets=[0.001, 0.01, 0.1])
+    for seconds in [0.0005, 0.005, 0.005, 0.05, 5]:
+      hooks.record("stage", seconds, pixels=10)
+
+    summary = hooks.snapshot()["stage"]
+    self.assertEqual([1, 2, 1, 1], summary["buckets"])
+    self.assertEqual(50, summary["pixels"])
+    self.assertEqual(0.01, hooks.percentile("stage", 50))
+    self.assertEqual(float("inf"), hooks.percentile("stage", 100))
+
+  def test_without_hooks(self):
+    # Nothing is timed, the counts set on the stage are dropped
+    with stage(None, "save") as saved:
+      saved.bytes_out = 10
+    self.assertIs(stage(None, "save"), stage(None, "other"))
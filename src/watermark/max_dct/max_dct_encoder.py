@@ -1,53 +1,384 @@
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import partial
 import numpy as np
-import pywt
 
-from color_conversion import color_conversion
-from chroma_subsample.subsample import subsample
+from ..color_conversion import color_conversion
+from ..chroma_subsample.subsample import subsample_plane
+from ..fused import fused_encoder
+from ..instrumentation.instrumentation import stage
+from ..transform import transform as transforms
+from ..transform.transform import Transform
+
+
+class Engine(Enum):
+  LOOP = "loop"
+  VECTORIZED = "vectorized"
+  # Single pass Numba kernel for encode_rgb, VECTORIZED when Numba is not installed
+  FUSED = "fused"
+
+
+def _max_ac_coefficients(frame: np.ndarray, block: int):
+  """
+  Locate the largest magnitude AC coefficient of every block x block tile of frame.
+
+  Returns the (rows, cols) indices of those coefficients in frame, in the same
+  row-major block order the loop engine walks the frame in.
+  """
+  (row, col) = frame.shape
+  block_rows, block_cols = row // block, col // block
+
+  tiles = frame[:block_rows * block, :block_cols * block].reshape(
+      block_rows, block, block_cols, block).swapaxes(1, 2).reshape(
+      block_rows * block_cols, block * block)
+
+  # argmax returns the first maximum, matching the per block np.argmax
+  pos = np.argmax(np.abs(tiles[:, 1:]), axis=1) + 1
+
+  block_index = np.arange(block_rows * block_cols)
+  rows = (block_index // block_cols) * block + pos // block
+  cols = (block_index % block_cols) * block + pos % block
+  return rows, cols
+
+
+def _scratch_array(scratch: dict, name: str, shape, dtype) -> np.ndarray:
+  array = scratch.get(name)
+  if array is None or array.shape != shape or array.dtype != dtype:
+    array = scratch[name] = np.empty(shape, dtype=dtype)
+  return array
+
+
+def _scratch_arrays(scratch: dict, name: str, shape, dtype, count: int):
+  return tuple(
+    _scratch_array(scratch, f"{name}{i}", shape, dtype) for i in range(count))
+
+
+def _lookup_scratch(scratch: dict, shape):
+  """
+  Scratch arrays of lookup_table.add_products for images of shape
+  """
+  shape = shape[:-1]
+  return (_scratch_array(scratch, "index", shape, np.intp),
+          *_scratch_arrays(scratch, "mask", shape, np.bool_, 2))
+
+
+# Distance, in standard deviations, of the vote rate of every bit from the vote rate of
+# all bits that sampled decoding needs before it stops
+Z_THRESHOLD = 4.0
+
+# Votes every bit needs before sampled decoding may stop
+MIN_VOTES = 64
+
+
+def vote_z_scores(sums: np.ndarray, counts: np.ndarray) -> np.ndarray:
+  """
+  z-score of the vote rate of every bit against the rate of all votes, 0 for bits
+  without votes or if all votes agree, see DecodeMaxDct.decode_rgb_sampled
+  """
+  rate = sums.sum() / max(counts.sum(), 1)
+  deviation = np.sqrt(rate * (1 - rate) * counts)
+  z = np.zeros(sums.shape)
+  np.divide(sums - rate * counts, deviation, out=z, where=deviation > 0)
+  return z
 
 
 class EmbedMaxDct(object):
-  def __init__(self, watermarks=[], scales=[0, 36, 36], block=4):
+  def __init__(self, watermarks=[], scales=[0, 36, 36], block=4,
+               engine: Engine = Engine.VECTORIZED, workers: int = 1,
+               dtype=color_conversion.COMPUTE_DTYPE, pixel_delta: bool = False,
+               bit_plans=None, transform=Transform.HAAR, hooks=None, executor=None):
+    """
+    workers: split every image into that many horizontal stripes of whole blocks,
+      which are converted, transformed and embedded on a thread pool, see
+      _encode_rgb_striped. encode_frame splits frames the same way.
+    dtype: float dtype color conversion and the DWT are computed in
+    pixel_delta: compute only the watermarked planes and apply the watermark
+      as a pixel domain change, see _encode_rgb_delta
+    bit_plans: optional mapping, e.g. an LRU cache shared between embedders, that
+      keeps the watermark bit of every block per (watermark, band shape)
+    transform: Transform, or a backend object, the Haar DWT is computed with
+    hooks: optional instrumentation.Hooks the stage durations are reported to
+    executor: optional concurrent.futures.Executor the stripes run on. By default the
+      embedder keeps a thread pool of workers threads for all its calls.
+    """
     self._watermarks = watermarks
     self._wmLen = len(watermarks)
     self._scales = scales
     self._block = block
+    self._engine = engine
+    self._workers = workers
+    self._dtype = dtype
+    self._pixel_delta = pixel_delta
+    self._bit_plans = bit_plans
+    self._bit_plans_key = bytes(np.asarray(watermarks, dtype=np.uint8))
+    self._transform = transforms.backend(transform)
+    self._hooks = hooks
+    if executor is None and workers > 1:
+      # Threads are only started by the first submitted stripe
+      executor = ThreadPoolExecutor(max_workers=workers)
+    self._executor = executor
+
+  def encode_rgb(self, rgb: np.ndarray, out=None, scratch=None) -> np.ndarray:
+    """
+    out: optional uint8 array shaped like rgb to write the result to.
+    scratch: optional dict the intermediate arrays are kept in and reused from, for
+      callers that encode many images of the same shape.
+    """
+    pixels = rgb.size // 3
+    if self._pixel_delta:
+      with stage(self._hooks, "pixel_delta", pixels):
+        return self._encode_rgb_delta(rgb)
+    if (self._engine == Engine.FUSED and fused_encoder.available()
+        and np.dtype(self._dtype) == np.float32):
+      with stage(self._hooks, "fused", pixels):
+        return fused_encoder.encode_rgb(
+            rgb, self._watermarks, self._scales, self._block, out=out)
+
+    if self._workers > 1:
+      return self._encode_rgb_striped(rgb, out, scratch)
+    return self._encode_rgb_stripe(rgb, out, scratch)
+
+  def _encode_rgb_striped(self, rgb: np.ndarray, out=None, scratch=None) -> np.ndarray:
+    """
+    The color conversion and subsampling are per pixel or per 2x2 group, the Haar
+    transform per 2x2 group and every block of the approximation band covers a
+    2 * block square of pixels. So stripes of whole 2 * block rows are encoded
+    independently, each embedding from the index of its first block, with the same
+    result as encoding the image at once.
+    """
+    rows, columns, _ = rgb.shape[-3:]
+    tile = 2 * self._block
+    if out is None:
+      out = np.empty(rgb.shape, dtype=np.uint8)
+
+    tile_rows = rows // tile
+    bounds = list(np.linspace(
+        0, tile_rows, max(min(self._workers, tile_rows), 1) + 1).astype(int) * tile)
+    bounds[-1] = rows
+    processed_rows = rows // self._block * self._block
+    # Width of the approximation band, divided into blocks
+    blocks_per_row = (columns // self._block * self._block + 1) // 2 // self._block
+
+    stripes = [
+      self._executor.submit(
+        self._encode_rgb_stripe,
+        rgb[..., top:bottom, :, :],
+        out[..., top:bottom, :, :],
+        None if scratch is None else scratch.setdefault(f"stripe{index}", {}),
+        min(bottom, processed_rows) - top,
+        top // tile * blocks_per_row)
+      for index, (top, bottom) in enumerate(zip(bounds[:-1], bounds[1:]))
+    ]
+    for stripe in stripes:
+      stripe.result()
+    return out
+
+  def _encode_rgb_stripe(self, rgb: np.ndarray, out=None, scratch=None,
+                         processed_rows=None, first_block=0) -> np.ndarray:
+    """
+    encode_rgb of a whole image, or of a stripe of one, see _encode_yuv
+    """
+    pixels = rgb.size // 3
+    with stage(self._hooks, "rgb_to_yuv", pixels):
+      if scratch is None:
+        yuv = color_conversion.rgb_to_yuv(rgb, self._dtype)
+      else:
+        yuv = color_conversion.rgb_to_yuv(
+            rgb, self._dtype, out=_scratch_array(scratch, "yuv", rgb.shape, np.uint8),
+            scratch=_scratch_arrays(scratch, "float", rgb.shape, self._dtype, 2),
+            lookup_scratch=_lookup_scratch(scratch, rgb.shape))
+    with stage(self._hooks, "subsample", pixels):
+      # Same as subsample(yuv), without copying
+      subsample_plane(yuv[..., 1])
+
+      # Watermarked values can leave 0-255, so they are stored as int16
+      if scratch is None:
+        yuv = yuv.astype(np.int16)
+      else:
+        yuv16 = _scratch_array(scratch, "yuv16", rgb.shape, np.int16)
+        np.copyto(yuv16, yuv)
+        yuv = yuv16
+
+    encoded = self._encode_yuv(yuv, scratch, processed_rows, first_block)
+    with stage(self._hooks, "yuv_to_rgb", pixels):
+      if scratch is None:
+        return color_conversion.yuv_to_rgb(encoded, self._dtype, out=out)
+      return color_conversion.yuv_to_rgb(
+          encoded, self._dtype, out=out,
+          scratch=_scratch_arrays(scratch, "float", rgb.shape, self._dtype, 3),
+          lookup_scratch=_lookup_scratch(scratch, rgb.shape))
+
+  def _encode_rgb_delta(self, rgb: np.ndarray) -> np.ndarray:
+    """
+    Same watermark as encode_rgb without computing the full YUV image.
+
+    YUV_TO_RGB is the inverse of RGB_TO_YUV, so changing one plane by d changes RGB
+    by d * YUV_TO_RGB[channel] and leaves the other planes alone. Only the watermarked
+    planes are converted and transformed, with the same arithmetic and truncation as
+    _encode_yuv, so their blocks quantize the same. The result differs from
+    encode_rgb by the rounding of the untouched planes, at most 1 per channel, and
+    where encode_rgb clips those planes to 0-255.
+    """
+    rows, columns, _ = rgb.shape[-3:]
+    last_processed_row = rows // self._block * self._block
+    last_processed_col = columns // self._block * self._block
+    inverse = color_conversion.YUV_TO_RGB.astype(self._dtype)
 
-  def encode_rgb(self, rgb: np.ndarray) -> np.ndarray:
-    yuv = color_conversion.rgb_to_yuv(rgb)
-    yuv = subsample(yuv) 
-    encoded = self._encode_yuv(yuv)
-    return color_conversion.yuv_to_rgb(encoded)
+    encoded = rgb.astype(self._dtype)
+    for channel in range(2):
+      if self._scales[channel] <= 0:
+        continue
 
-  def _encode_yuv(self, yuv: np.ndarray) -> np.ndarray:
-    rows, columns, _ = yuv.shape
+      exact = color_conversion.rgb_to_yuv_plane(rgb, channel, self._dtype)
+      plane = np.clip(exact, 0, 255)
+      np.rint(plane, out=plane)
+      if channel == 1:
+        subsample_plane(plane)
+
+      region = plane[..., :last_processed_row, :last_processed_col]
+      with stage(self._hooks, "transform", region.size):
+        region[...] = self._transform.transform_approximation(
+            region, partial(self._embed_band, scale=self._scales[channel]),
+            swap_details=True)
+      # _encode_yuv stores the result as int16
+      np.trunc(region, out=region)
+
+      # plane now holds the change from the original, unrounded channel
+      plane -= exact
+      encoded += plane[..., None] * inverse[channel]
+
+    np.clip(encoded, 0, 255, out=encoded)
+    np.rint(encoded, out=encoded)
+    return encoded.astype(np.uint8)
+
+  def _encode_yuv(self, yuv: np.ndarray, scratch=None, processed_rows=None,
+                  first_block=0) -> np.ndarray:
+    """
+    yuv is a (rows, columns, 3) image or a stack (..., rows, columns, 3) of
+    same shaped images, each of which gets the full watermark
+    scratch: optional dict the transformed planes are kept in, see encode_rgb
+    processed_rows, first_block: for a stripe of an image, the rows of the stripe
+      the image's transform covers and the index of the stripe's first block
+    """
+    rows, columns, _ = yuv.shape[-3:]
 
     for channel in range(2):
       if self._scales[channel] <= 0:
         continue
 
-      last_processed_row = rows // self._block * self._block
+      last_processed_row = (
+          rows // self._block * self._block if processed_rows is None else processed_rows)
       last_processed_col = columns // self._block * self._block
 
-      ca1, (h1, v1, d1) = pywt.dwt2(
-          yuv[:last_processed_row, :last_processed_col, channel], 'haar')
-
-      self.encode_frame(ca1, scale=self._scales[channel])
-
-      yuv[:last_processed_row, :last_processed_col, channel, ] = pywt.idwt2(
-          (ca1, (v1, h1, d1)), 'haar')
+      region = yuv[..., :last_processed_row, :last_processed_col, channel]
+      if scratch is None:
+        plane = region.astype(self._dtype)
+        transform_scratch = {}
+      else:
+        plane = _scratch_array(scratch, "plane", region.shape, self._dtype)
+        np.copyto(plane, region)
+        transform_scratch = {"scratch": _scratch_array(
+          scratch, "transform", (region.size // 2,), self._dtype)}
+      # The details have always been put back with horizontal and vertical swapped.
+      # They are 0 for the subsampled U plane, so only a watermarked Y is affected
+      with stage(self._hooks, "transform", region.size):
+        yuv[..., :last_processed_row, :last_processed_col, channel, ] = (
+            self._transform.transform_approximation(
+                plane, partial(
+                    self._embed_band, scale=self._scales[channel],
+                    first_block=first_block, striped=processed_rows is None),
+                swap_details=True, **transform_scratch))
 
     return yuv
 
-  def encode_frame(self, frame, scale):
+  def _embed_band(self, frame, scale, first_block=0, striped=True):
+    with stage(self._hooks, "block_embed", frame.size):
+      self.encode_frame(frame, scale, first_block, striped)
+
+  def encode_frame(self, frame, scale, first_block=0, striped=True):
     '''
     frame is a matrix (M, N)
 
     we get K (watermark bits size) blocks (self._block x self._block)
 
     For i-th block, we encode watermark[i] bit into it
+
+    A stack of frames (..., M, N) gets every frame encoded separately
+
+    first_block: index of the first block of frame, for a stripe of a larger frame.
+    striped: with workers, split frame into stripes on the thread pool. Stripes
+      running on that pool must not wait for it again.
     '''
+    if frame.ndim > 2:
+      for index in np.ndindex(frame.shape[:-2]):
+        self.encode_frame(frame[index], scale, first_block, striped)
+      return
+
+    if self._engine == Engine.LOOP:
+      return self._encode_frame_loop(frame, scale, first_block)
+    if striped and self._workers > 1:
+      return self._encode_frame_striped(frame, scale, first_block)
+    return self._encode_frame_vectorized(frame, scale, self._bit_plan(frame, first_block))
+
+  def _bit_plan(self, frame, first_block=0):
+    """
+    Watermark bit of every block of frame, in block order, starting at the bit of
+    block first_block
+    """
+    block_rows = frame.shape[0] // self._block
+    block_cols = frame.shape[1] // self._block
+    first_bit = first_block % max(self._wmLen, 1)
+    key = (self._bit_plans_key, block_rows, block_cols, first_bit)
+
+    if self._bit_plans is not None and key in self._bit_plans:
+      return self._bit_plans[key]
+
+    wmBits = np.asarray(self._watermarks)[
+        (first_bit + np.arange(block_rows * block_cols)) % self._wmLen]
+    if self._bit_plans is not None:
+      self._bit_plans[key] = wmBits
+    return wmBits
+
+  def _encode_frame_striped(self, frame, scale, first_block=0):
+    """
+    Every block only depends on its own coefficients and its index, so stripes of
+    whole block rows are embedded independently, each starting at the index of
+    its first block
+    """
+    block_rows = frame.shape[0] // self._block
+    blocks_per_row = frame.shape[1] // self._block
+    bounds = np.linspace(
+        0, block_rows, min(self._workers, block_rows) + 1).astype(int)
+    wmBits = self._bit_plan(frame, first_block)
+
+    stripes = [
+      self._executor.submit(
+        self._encode_frame_vectorized,
+        frame[start * self._block:end * self._block],
+        scale,
+        wmBits[start * blocks_per_row:end * blocks_per_row])
+      for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    for stripe in stripes:
+      stripe.result()
+
+  def _encode_frame_vectorized(self, frame, scale, wmBits):
+    """
+    Same embedding as _encode_frame_loop, done for every block at once.
+    wmBits is the bit of every block of frame, see _bit_plan
+    """
+    rows, cols = _max_ac_coefficients(frame, self._block)
+    if rows.size == 0:
+      return
+
+    val = frame[rows, cols]
+    sign = np.where(val >= 0.0, 1.0, -1.0)
+    frame[rows, cols] = sign * \
+        ((np.abs(val) // scale + 0.25 + (0.5 * wmBits)) * scale)
+
+  def _encode_frame_loop(self, frame, scale, first_block=0):
     (row, col) = frame.shape
-    num = 0
+    num = first_block
 
     for i in range(row // self._block):
       for j in range(col // self._block):
@@ -81,34 +412,151 @@ class EmbedMaxDct(object):
 
 
 class DecodeMaxDct(object):
-  def __init__(self, wm_length, scales=[0, 36, 36], block=4):
+  def __init__(self, wm_length, scales=[0, 36, 36], block=4,
+               engine: Engine = Engine.VECTORIZED,
+               dtype=color_conversion.COMPUTE_DTYPE, transform=Transform.HAAR,
+               hooks=None):
     self._wmLen = wm_length
     self._scales = scales
     self._block = block
+    self._engine = engine
+    self._dtype = dtype
+    self._transform = transforms.backend(transform)
+    self._hooks = hooks
 
   def decode_rgb(self, rgb: np.ndarray) -> np.ndarray:
     rows, columns, __name__ = rgb.shape
 
-    yuv = color_conversion.rgb_to_yuv(rgb)
+    with stage(self._hooks, "rgb_to_yuv", rows * columns):
+      yuv = color_conversion.rgb_to_yuv(rgb, self._dtype)
 
-    scores = [[] for i in range(self._wmLen)]
+    approximations = []
     for channel in range(2):
       if self._scales[channel] <= 0:
+        approximations.append(None)
         continue
 
       last_processed_row = rows // self._block * self._block
       last_processed_col = columns // self._block * self._block
 
-      ca1, (_, _, _) = pywt.dwt2(
-          yuv[:last_processed_row, :last_processed_col, channel], 'haar')
+      with stage(self._hooks, "transform", last_processed_row * last_processed_col):
+        approximations.append(self._transform.approximation(
+            yuv[:last_processed_row, :last_processed_col, channel].astype(self._dtype)))
 
-      scores = self.decode_frame(ca1, self._scales[channel], scores)
+    return self.decode_approximations(approximations)
 
-    avgScores = list(map(lambda l: np.array(l).mean(), scores))
+  def decode_approximations(self, approximations) -> np.ndarray:
+    """
+    Decodes from the Haar approximation band of each channel, approximations[channel],
+    e.g. when a cheaper source than the DWT of the full image is available.
+    Channels with a scale of 0 are skipped and may be None.
+    """
+    if self._engine != Engine.LOOP:
+      sums = np.zeros(self._wmLen)
+      counts = np.zeros(self._wmLen, dtype=np.int64)
+      self.vote_approximations(approximations, sums, counts)
+      avgScores = np.full(self._wmLen, np.nan)
+      np.divide(sums, counts, out=avgScores, where=counts > 0)
+    else:
+      scores = [[] for i in range(self._wmLen)]
+      for channel in range(2):
+        if self._scales[channel] <= 0:
+          continue
+        ca1 = approximations[channel]
+        with stage(self._hooks, "block_decode", ca1.size):
+          scores = self.decode_frame(ca1, self._scales[channel], scores)
+      avgScores = list(map(lambda l: np.array(l).mean(), scores))
 
     bits = (np.array(avgScores) * 255 > 127)
     return bits
 
+  def vote_approximations(self, approximations, sums, counts):
+    """
+    Adds the votes of the blocks of approximations, as in decode_approximations, to the
+    per bit vote sums and counts arrays, e.g. to decode from several frames at once
+    """
+    for channel in range(2):
+      if self._scales[channel] <= 0:
+        continue
+
+      ca1 = approximations[channel]
+      with stage(self._hooks, "block_decode", ca1.size):
+        self._decode_frame_vectorized(ca1, self._scales[channel], sums, counts)
+
+  def decode_rgb_sampled(self, rgb: np.ndarray, z_threshold: float = Z_THRESHOLD,
+                         blocks_per_bit: int = 16, seed: int = 0,
+                         min_votes: int = MIN_VOTES):
+    """
+    Decodes from blocks visited in random order, blocks_per_bit * wm_length of them at
+    a time, and stops once every bit has min_votes votes and a z-score of at least
+    z_threshold.
+
+    Every block covers a 2 * block square pixel tile, so only the visited tiles are
+    converted and transformed. Blocks of unwatermarked content do not vote as fair coins,
+    a flat image votes 0 for every bit, but they vote alike for every bit. The null
+    hypothesis is that the vote rate of every bit is the rate p of all votes, and
+      z = (ones - p * votes) / sqrt(p * (1 - p) * votes)
+    A watermark whose bits are all equal cannot be told from content this way, it gets
+    a z-score of 0.
+    Returns the bits and the |z| of every bit. If the threshold is never reached all
+    blocks are visited and the bits are the same as decode_rgb's.
+    """
+    rows, columns, _ = rgb.shape
+    tile = 2 * self._block
+    block_rows = rows // self._block * self._block // 2 // self._block
+    block_cols = columns // self._block * self._block // 2 // self._block
+
+    order = np.random.default_rng(seed).permutation(block_rows * block_cols)
+    offsets = np.arange(tile)
+    sums = np.zeros(self._wmLen)
+    counts = np.zeros(self._wmLen, dtype=np.int64)
+    z = np.zeros(self._wmLen)
+    for start in range(0, order.size, blocks_per_bit * self._wmLen):
+      index = order[start:start + blocks_per_bit * self._wmLen]
+      tile_rows = (index // block_cols * tile)[:, None] + offsets
+      tile_cols = (index % block_cols * tile)[:, None] + offsets
+      tiles = rgb[tile_rows[:, :, None], tile_cols[:, None, :]]
+
+      for channel in range(2):
+        if self._scales[channel] <= 0:
+          continue
+
+        # Same values as rgb_to_yuv(rgb)[..., channel]
+        plane = color_conversion.rgb_to_yuv_plane(tiles, channel, self._dtype)
+        np.clip(plane, 0, 255, out=plane)
+        np.rint(plane, out=plane)
+        ca1 = self._transform.approximation(plane).reshape(index.size, -1)
+
+        pos = np.argmax(np.abs(ca1[:, 1:]), axis=1) + 1
+        val = np.abs(ca1[np.arange(index.size), pos])
+        votes = (val % self._scales[channel]) > 0.5 * self._scales[channel]
+
+        wmBits = index % self._wmLen
+        sums += np.bincount(wmBits, weights=votes, minlength=self._wmLen)
+        counts += np.bincount(wmBits, minlength=self._wmLen)
+
+      z = np.abs(vote_z_scores(sums, counts))
+      if counts.min() >= min_votes and np.all(z >= z_threshold):
+        break
+
+    avgScores = np.full(self._wmLen, np.nan)
+    np.divide(sums, counts, out=avgScores, where=counts > 0)
+    return avgScores * 255 > 127, z
+
+  def _decode_frame_vectorized(self, frame, scale, sums, counts):
+    """
+    Same votes as decode_frame, accumulated in place into the per bit
+    vote sums and counts arrays instead of lists of scores
+    """
+    rows, cols = _max_ac_coefficients(frame, self._block)
+
+    val = np.abs(frame[rows, cols])
+    votes = (val % scale) > 0.5 * scale
+
+    wmBits = np.arange(rows.size) % self._wmLen
+    sums += np.bincount(wmBits, weights=votes, minlength=self._wmLen)
+    counts += np.bincount(wmBits, minlength=self._wmLen)
+
   def decode_frame(self, frame, scale, scores):
     (row, col) = frame.shape
     num = 0
@@ -1,9 +1,11 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from PIL import Image
 
-from max_dct import max_dct_encoder
+from watermark.color_conversion import color_conversion
+from watermark.max_dct import max_dct_encoder
 
 
 def bits_to_utf8(bits):
@@ -54,10 +56,37 @@ def SDV2_embedder():
   return max_dct_encoder.EmbedMaxDct(watermarks=watermark)
 
 
+def SDV2_loop_embedder():
+  wm = "SDV2".encode("utf-8")
+  seq = np.array([n for n in wm], dtype=np.uint8)
+  watermark = list(np.unpackbits(seq))
+  return max_dct_encoder.EmbedMaxDct(
+    watermarks=watermark, engine=max_dct_encoder.Engine.LOOP)
+
+
+def SDV2_striped_embedder(workers, **kwargs):
+  wm = "SDV2".encode("utf-8")
+  seq = np.array([n for n in wm], dtype=np.uint8)
+  watermark = list(np.unpackbits(seq))
+  return max_dct_encoder.EmbedMaxDct(watermarks=watermark, workers=workers, **kwargs)
+
+
+def SDV2_pixel_delta_embedder():
+  wm = "SDV2".encode("utf-8")
+  seq = np.array([n for n in wm], dtype=np.uint8)
+  watermark = list(np.unpackbits(seq))
+  return max_dct_encoder.EmbedMaxDct(watermarks=watermark, pixel_delta=True)
+
+
 def SDV2_decoder():
   return max_dct_encoder.DecodeMaxDct(wm_length=32)
 
 
+def SDV2_loop_decoder():
+  return max_dct_encoder.DecodeMaxDct(
+    wm_length=32, engine=max_dct_encoder.Engine.LOOP)
+
+
 class TestMaxDctEncode(unittest.TestCase):
   def test_encode_frame_with_one(self):
     encoder = one_embedder()
@@ -103,3 +132,157 @@ class TestMaxDctEncode(unittest.TestCase):
 
       decoded = decoder.decode_rgb(encoded)
       self.assertEqual("SDV2", bits_to_utf8(decoded))
+
+  def test_vectorized_engine_matches_loop(self):
+    vectorized = SDV2_embedder()
+    loop = SDV2_loop_embedder()
+
+    rng = np.random.default_rng(0)
+    for frame in [
+      rng.normal(0, 200, (130, 97)),
+      rng.integers(-500, 500, (64, 64)),
+      np.zeros((16, 16)),
+    ]:
+      expected = frame.copy()
+      actual = frame.copy()
+      loop.encode_frame(expected, scale=36)
+      vectorized.encode_frame(actual, scale=36)
+      self.assertTrue(np.array_equal(expected, actual))
+
+    for image in [
+      original_image(),
+      peppers_image(),
+    ]:
+      self.assertTrue(np.array_equal(
+        loop.encode_rgb(image), vectorized.encode_rgb(image)))
+
+  def test_vectorized_decoder_matches_loop(self):
+    encoder = SDV2_embedder()
+    vectorized = SDV2_decoder()
+    loop = SDV2_loop_decoder()
+
+    rng = np.random.default_rng(0)
+    for image in [
+      original_image(),
+      peppers_image(),
+      rng.integers(0, 256, (300, 257, 3)),
+    ]:
+      for rgb in [image, encoder.encode_rgb(image)]:
+        self.assertTrue(np.array_equal(
+          loop.decode_rgb(rgb), vectorized.decode_rgb(rgb)))
+
+  def test_striped_encoding_matches_single_stripe(self):
+    single = SDV2_embedder()
+
+    rng = np.random.default_rng(0)
+    for workers in [2, 3, 64]:
+      striped = SDV2_striped_embedder(workers)
+      for frame in [
+        rng.normal(0, 200, (130, 97)),
+        rng.normal(0, 200, (8, 64)),
+      ]:
+        expected = frame.copy()
+        actual = frame.copy()
+        single.encode_frame(expected, scale=36)
+        striped.encode_frame(actual, scale=36)
+        self.assertTrue(np.array_equal(expected, actual))
+
+    # The whole pipeline is striped, images of any size give the same pixels
+    noise = rng.integers(0, 256, (2, 300, 257, 3), dtype=np.uint8)
+    for image in [peppers_image(), noise[0], noise, noise[0, :7, :9]]:
+      expected = single.encode_rgb(image)
+      for workers in [2, 3, 64]:
+        striped = SDV2_striped_embedder(workers)
+        self.assertTrue(np.array_equal(expected, striped.encode_rgb(image)))
+        scratch = {}
+        for _ in range(2):
+          self.assertTrue(np.array_equal(expected, striped.encode_rgb(image, scratch=scratch)))
+      loop = SDV2_striped_embedder(3, engine=max_dct_encoder.Engine.LOOP)
+      self.assertTrue(np.array_equal(expected, loop.encode_rgb(image)))
+
+    # Stripes run on the given pool
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      striped = SDV2_striped_embedder(4, executor=executor)
+      self.assertIs(executor, striped._executor)
+      self.assertTrue(np.array_equal(
+        single.encode_rgb(noise[0]), striped.encode_rgb(noise[0])))
+
+  def test_pixel_delta_encoder(self):
+    encoder = SDV2_embedder()
+    pixel_delta_encoder = SDV2_pixel_delta_embedder()
+    decoder = SDV2_decoder()
+    for image in [
+      original_image(),
+      peppers_image(),
+    ]:
+      encoded = pixel_delta_encoder.encode_rgb(image)
+      self.assertEqual("SDV2", bits_to_utf8(decoder.decode_rgb(encoded)))
+
+      # Only the rounding of the planes that are not watermarked differs, no block
+      # quantizes differently
+      diff = np.abs(encoder.encode_rgb(image).astype(int) - encoded)
+      self.assertLessEqual(diff.max(), 1)
+
+    # encode_rgb also clips the planes that are not watermarked to 0-255
+    image = np.random.default_rng(0).integers(0, 256, (300, 257, 3), dtype=np.uint8)
+    clipped = np.zeros(image.shape[:2], dtype=bool)
+    for channel in [0, 2]:
+      plane = color_conversion.rgb_to_yuv_plane(image, channel)
+      clipped |= (plane < -0.5) | (plane > 255.5)
+    diff = np.abs(encoder.encode_rgb(image).astype(int) - pixel_delta_encoder.encode_rgb(image))
+    self.assertTrue(clipped.any())
+    self.assertLessEqual(diff[~clipped].max(), 1)
+
+  def test_sampled_decoder(self):
+    encoder = SDV2_embedder()
+    decoder = SDV2_decoder()
+
+    rng = np.random.default_rng(0)
+    for image in [
+      original_image(),
+      peppers_image(),
+      rng.integers(0, 256, (300, 257, 3)),
+    ]:
+      for rgb in [image, encoder.encode_rgb(image)]:
+        # Never confident enough, so every block is visited
+        bits, confidence = decoder.decode_rgb_sampled(rgb, z_threshold=np.inf)
+        self.assertTrue(np.array_equal(decoder.decode_rgb(rgb), bits))
+        self.assertEqual((32,), confidence.shape)
+
+    encoded = encoder.encode_rgb(original_image())
+    bits, confidence = decoder.decode_rgb_sampled(encoded)
+    self.assertEqual("SDV2", bits_to_utf8(bits))
+    self.assertGreaterEqual(confidence.min(), max_dct_encoder.Z_THRESHOLD)
+
+  def test_sampled_decoder_unwatermarked(self):
+    decoder = SDV2_decoder()
+    gradient = np.linspace(0, 255, 512)[None, :, None].repeat(512, axis=0).repeat(3, axis=2)
+    for image in [
+      original_image(),
+      peppers_image(),
+      np.full((512, 512, 3), 128),
+      gradient,
+      np.random.default_rng(0).integers(0, 256, (512, 512, 3)),
+    ]:
+      _, confidence = decoder.decode_rgb_sampled(image)
+      self.assertLess(confidence.min(), max_dct_encoder.Z_THRESHOLD)
+
+  def test_transform_backends_match(self):
+    watermark = list(np.unpackbits(np.frombuffer(b"SDV2", dtype=np.uint8)))
+    rng = np.random.default_rng(0)
+    for scales in [[0, 36, 36], [36, 36, 36]]:
+      encoders = [
+        max_dct_encoder.EmbedMaxDct(watermark, scales=scales, transform=transform)
+        for transform in max_dct_encoder.Transform]
+      decoders = [
+        max_dct_encoder.DecodeMaxDct(32, scales=scales, transform=transform)
+        for transform in max_dct_encoder.Transform]
+
+      for image in [
+        peppers_image(),
+        rng.integers(0, 256, (300, 257, 3)),
+      ]:
+        pywt_encoded, haar_encoded = [encoder.encode_rgb(image) for encoder in encoders]
+        self.assertTrue(np.array_equal(pywt_encoded, haar_encoded))
+        self.assertTrue(np.array_equal(
+          decoders[0].decode_rgb(pywt_encoded), decoders[1].decode_rgb(pywt_encoded)))
@@ -0,0 +1,232 @@
+"""
+Cache of apply_watermark results, keyed by a hash of the input bytes and the options.
+
+Re-uploads of the same image with the same options are served from a store instead of
+being decoded, watermarked and encoded again. Stores map a key to the tuple of encoded
+outputs, MemoryStore keeps them in process and DiskStore in a directory shared between
+processes.
+"""
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+from PIL import Image
+
+from ..apply_watermark import DEFAULT_OUTPUTS, Filetype, apply_watermark
+
+
+class MemoryStore(object):
+  """
+  In process LRU store that drops its least recently used results beyond max_bytes
+  """
+
+  def __init__(self, max_bytes: int = 256 * 2 ** 20):
+    self._max_bytes = max_bytes
+    self._results = OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+
+  @property
+  def size(self) -> int:
+    return self._size
+
+  def get(self, key: str) -> Optional[Tuple[bytes, ...]]:
+    with self._lock:
+      result = self._results.get(key)
+      if result is not None:
+        self._results.move_to_end(key)
+      return result
+
+  def put(self, key: str, result: Tuple[bytes, ...]):
+    nbytes = sum(len(output) for output in result)
+    if nbytes > self._max_bytes:
+      return
+
+    with self._lock:
+      if key in self._results:
+        self._size -= sum(len(output) for output in self._results.pop(key))
+      self._results[key] = result
+      self._size += nbytes
+      while self._size > self._max_bytes:
+        _, dropped = self._results.popitem(last=False)
+        self._size -= sum(len(output) for output in dropped)
+
+
+class DiskStore(object):
+  """
+  Store keeping one file per result in directory. Beyond max_bytes the least recently
+    used files are deleted, reads touch the file modification time.
+  Files are written to a temporary name and renamed, so several processes can share
+    the directory.
+  """
+
+  def __init__(self, directory: str, max_bytes: int = 4 * 2 ** 30):
+    self._directory = directory
+    self._max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+    self._size = sum(entry.stat().st_size for entry in self._entries())
+    self._lock = threading.Lock()
+
+  @property
+  def size(self) -> int:
+    return self._size
+
+  def get(self, key: str) -> Optional[Tuple[bytes, ...]]:
+    path = os.path.join(self._directory, key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+
+    try:
+      count, = struct.unpack_from('>I', data)
+      lengths = struct.unpack_from(f'>{count}Q', data, 4)
+    except struct.error:
+      lengths = None
+    offset = 4 + 8 * len(lengths or ())
+    if lengths is None or offset + sum(lengths) != len(data):
+      # Truncated or corrupt, e.g. by a full disk, it is written again by the next put
+      self._remove(path, len(data))
+      return None
+
+    result = []
+    for length in lengths:
+      result.append(data[offset:offset + length])
+      offset += length
+    return tuple(result)
+
+  def _remove(self, path: str, size: int):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      return
+    with self._lock:
+      self._size -= size
+
+  def put(self, key: str, result: Tuple[bytes, ...]):
+    header = struct.pack(f'>I{len(result)}Q', len(result), *map(len, result))
+    nbytes = len(header) + sum(len(output) for output in result)
+    if nbytes > self._max_bytes:
+      return
+
+    path = os.path.join(self._directory, key)
+    fd, temporary = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        for output in result:
+          f.write(output)
+      try:
+        replaced = os.stat(path).st_size
+      except FileNotFoundError:
+        replaced = 0
+      os.replace(temporary, path)
+    except BaseException:
+      os.unlink(temporary)
+      raise
+
+    with self._lock:
+      self._size += nbytes - replaced
+      if self._size > self._max_bytes:
+        self._evict()
+
+  def _entries(self):
+    return [entry for entry in os.scandir(self._directory)
+            if entry.is_file() and not entry.name.endswith('.tmp')]
+
+  def _evict(self):
+    # Other processes write to the directory too, so the size is taken from the files
+    entries = []
+    for entry in self._entries():
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    self._size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if self._size <= self._max_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      self._size -= size
+
+
+class ResultCache(object):
+  """
+  apply_watermark with its results kept in store, a MemoryStore by default.
+  hits and misses count the calls served from and not found in the store.
+  """
+
+  def __init__(self, store=None):
+    self.store = store if store is not None else MemoryStore()
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def apply_watermark(
+    self,
+    img_buffer: bytes,
+    file_type: Filetype = Filetype.PNG,
+    jpeg_quality: int = 75,
+    watermark: str = "SDV2",
+    resize_for_social_media: bool = False,
+    workers: int = 1,
+    outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+    hooks=None,
+    resize_filter: Optional[Image.Resampling] = None,
+    **output_options,
+  ) -> Tuple[io.BytesIO, ...]:
+    """
+    Same arguments and result as apply_watermark. hooks only see the stages of misses.
+    """
+    key = self.key(
+      img_buffer, jpeg_quality, watermark, resize_for_social_media, outputs,
+      resize_filter, **output_options)
+    result = self.store.get(key)
+    if result is not None:
+      with self._lock:
+        self.hits += 1
+      return tuple(io.BytesIO(output) for output in result)
+
+    with self._lock:
+      self.misses += 1
+    encoded = apply_watermark(
+      img_buffer, file_type, jpeg_quality, watermark, resize_for_social_media, workers,
+      outputs, hooks=hooks, resize_filter=resize_filter, **output_options)
+    self.store.put(key, tuple(output.getvalue() for output in encoded))
+    return encoded
+
+  @staticmethod
+  def key(
+    img_buffer: bytes,
+    jpeg_quality: int = 75,
+    watermark: str = "SDV2",
+    resize_for_social_media: bool = False,
+    outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+    resize_filter: Optional[Image.Resampling] = None,
+    **output_options,
+  ) -> str:
+    """
+    Hex digest of the input bytes and every option that changes the result. The
+      file type, workers and hooks do not, so they are not arguments.
+    """
+    options = (
+      jpeg_quality, watermark, resize_for_social_media,
+      tuple(output.value for output in outputs),
+      resize_filter if resize_for_social_media else None, sorted(output_options.items()))
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(options).encode('utf-8'))
+    digest.update(img_buffer)
+    return digest.hexdigest()
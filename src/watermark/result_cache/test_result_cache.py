@@ -0,0 +1,120 @@
+import concurrent.futures
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from watermark.apply_watermark import apply_watermark, Filetype
+from watermark.instrumentation.instrumentation import HistogramHooks
+from watermark.result_cache.result_cache import DiskStore, MemoryStore, ResultCache
+
+
+WATERMARK = "SDV2"
+
+
+def peppers_image_bytes() -> bytes:
+  with open('../data/peppers.png', 'rb') as f:
+    return f.read()
+
+
+class TestResultCache(unittest.TestCase):
+  def test_hit(self):
+    img_bytes = peppers_image_bytes()
+    expected = [output.getvalue() for output in apply_watermark(img_bytes, watermark=WATERMARK)]
+
+    cache = ResultCache()
+    for _ in range(3):
+      encoded = cache.apply_watermark(img_bytes, watermark=WATERMARK)
+      self.assertEqual(expected, [output.getvalue() for output in encoded])
+    self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    # Any option that changes the result is part of the key
+    cache.apply_watermark(img_bytes, watermark="SDV1")
+    cache.apply_watermark(img_bytes, watermark=WATERMARK, jpeg_quality=90)
+    cache.apply_watermark(img_bytes, watermark=WATERMARK, outputs=[Filetype.PNG])
+    cache.apply_watermark(img_bytes, watermark=WATERMARK, png_compress_level=1)
+    self.assertEqual((2, 5), (cache.hits, cache.misses))
+
+    # Hooks, workers and the filter of images that are not resized do not
+    cache.apply_watermark(
+      img_bytes, watermark=WATERMARK, workers=2, hooks=HistogramHooks(),
+      resize_filter=Image.Resampling.LANCZOS)
+    self.assertEqual((3, 5), (cache.hits, cache.misses))
+
+  def test_memory_store_budget(self):
+    store = MemoryStore(max_bytes=10)
+    store.put("a", (b"1234", b"5"))
+    store.put("b", (b"1234",))
+    self.assertEqual((b"1234", b"5"), store.get("a"))
+
+    # b is the least recently used
+    store.put("c", (b"12345",))
+    self.assertIsNone(store.get("b"))
+    self.assertEqual(10, store.size)
+
+    store.put("d", (b"too large to keep",))
+    self.assertIsNone(store.get("d"))
+
+  def test_disk_store(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = DiskStore(directory)
+      store.put("a", (b"jpeg", b"", b"png"))
+      self.assertIsNone(store.get("b"))
+
+      # Results outlive the store object
+      self.assertEqual((b"jpeg", b"", b"png"), DiskStore(directory).get("a"))
+
+      store = DiskStore(directory, max_bytes=64)
+      store.put("b", (b"x" * 40,))
+      self.assertIsNone(store.get("a"))
+      self.assertEqual((b"x" * 40,), store.get("b"))
+      self.assertLessEqual(store.size, 64)
+
+  def test_disk_store_corrupt(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = DiskStore(directory)
+      store.put("a", (b"jpeg", b"png"))
+      store.put("b", (b"jpeg",))
+      size = store.size
+      path = os.path.join(directory, "a")
+      with open(path, 'rb') as f:
+        data = f.read()
+      for data in [b"", b"\0\0", data[:-1]]:
+        with open(path, 'wb') as f:
+          f.write(data)
+        store = DiskStore(directory)
+
+        # A truncated result is a miss, and is deleted
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(["b"], os.listdir(directory))
+        self.assertEqual(os.path.getsize(os.path.join(directory, "b")), store.size)
+        store.put("a", (b"jpeg", b"png"))
+        self.assertEqual((b"jpeg", b"png"), store.get("a"))
+        self.assertEqual(size, store.size)
+
+  def test_disk_store_put(self):
+    with tempfile.TemporaryDirectory() as directory:
+      store = DiskStore(directory)
+      store.put("a", (b"jpeg", b"png"))
+      size = store.size
+      # Replacing a result counts its size once
+      store.put("a", (b"jpeg", b"png"))
+      self.assertEqual(size, store.size)
+
+      # A failed write leaves neither a temporary file nor a partial result
+      with mock.patch("os.replace", side_effect=OSError):
+        with self.assertRaises(OSError):
+          store.put("b", (b"jpeg",))
+      self.assertEqual(["a"], os.listdir(directory))
+      self.assertEqual(size, store.size)
+
+  def test_counters_threads(self):
+    cache = ResultCache()
+    img_bytes = peppers_image_bytes()
+    cache.apply_watermark(img_bytes, watermark=WATERMARK)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+      for _ in range(64):
+        executor.submit(cache.apply_watermark, img_bytes, watermark=WATERMARK)
+    self.assertEqual((64, 1), (cache.hits, cache.misses))
@@ -0,0 +1,176 @@
+"""
+Memory bounded encode of large images, strip by strip.
+
+The Haar transform works on 2x2 pixel groups and every watermark block covers a
+2 * block square pixel tile, so strips of whole tile rows are watermarked independently.
+A strip starting at block index n gets the watermark bits rotated by n, which gives the
+same block to bit mapping as encoding the whole image.
+
+Strips are converted to RGB and watermarked one at a time and handed to a writer, so
+the float intermediate arrays of EmbedMaxDct.encode_rgb are the size of a strip.
+PNG rows are compressed as they arrive, so with PNG output and no resize the memory
+beyond the decoded input is bounded by the strip size.
+
+What is not bounded: Pillow decodes the input image as a whole, 3 or 4 bytes per pixel.
+A JPEG resized for social media is decoded at the draft scale apply_watermark uses, and
+the resized image is held as a whole too. Pillow has no incremental JPEG or WebP
+encoder, so those outputs are assembled as a uint8 image and saved at the end.
+"""
+import struct
+import zlib
+from typing import BinaryIO
+
+import numpy as np
+from PIL import Image
+
+from ..apply_watermark import (
+  Filetype, MAX_PIXELS, _check_size, _open_image, _resize_for_social_media,
+  _social_media_draft_size)
+from ..max_dct.max_dct_encoder import EmbedMaxDct, Engine
+
+# Rows per strip, a multiple of the 8 pixel rows of a 4x4 block
+STRIP_ROWS = 256
+
+
+class PngStripWriter(object):
+  """
+  Writes an 8 bit RGB PNG to file, compressing rows as they are written.
+  Rows are Paeth filtered, the filter that suits photos best in most cases.
+  """
+
+  def __init__(self, file: BinaryIO, width: int, height: int, compress_level: int = 6):
+    self._file = file
+    self._compressor = zlib.compressobj(compress_level)
+    # The row above the next written row, zeros above the first one
+    self._previous = np.zeros(width * 3, dtype=np.int16)
+
+    self._file.write(b'\x89PNG\r\n\x1a\n')
+    self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+  def write(self, rows: np.ndarray):
+    """
+    rows: uint8 (n, width, 3)
+    """
+    raw = rows.reshape(rows.shape[0], -1).astype(np.int16)
+    up = np.concatenate([self._previous[None], raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, 3:] = raw[:, :-3]
+    up_left = np.zeros_like(raw)
+    up_left[:, 3:] = up[:, :-3]
+
+    distance_left = np.abs(up - up_left)
+    distance_up = np.abs(left - up_left)
+    distance_up_left = np.abs(left + up - 2 * up_left)
+    predicted = np.where(
+      (distance_left <= distance_up) & (distance_left <= distance_up_left), left,
+      np.where(distance_up <= distance_up_left, up, up_left))
+
+    filtered = np.empty((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 4
+    filtered[:, 1:] = (raw - predicted) & 0xff
+    self._previous = raw[-1]
+
+    self._chunk(b'IDAT', self._compressor.compress(filtered.tobytes()))
+
+  def close(self):
+    self._chunk(b'IDAT', self._compressor.flush())
+    self._chunk(b'IEND', b'')
+
+  def _chunk(self, kind: bytes, data: bytes):
+    if kind == b'IDAT' and not data:
+      return
+    self._file.write(struct.pack('>I', len(data)))
+    self._file.write(kind)
+    self._file.write(data)
+    self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+
+class ImageStripWriter(object):
+  """
+  Collects rows in a uint8 image and saves it with Pillow on close, for the formats
+  Pillow cannot write incrementally
+  """
+
+  def __init__(self, file: BinaryIO, width: int, height: int, file_type: Filetype,
+               **save_options):
+    self._file = file
+    self._file_type = file_type
+    self._save_options = save_options
+    self._img = Image.new('RGB', (width, height))
+    self._row = 0
+
+  def write(self, rows: np.ndarray):
+    self._img.paste(Image.fromarray(rows, 'RGB'), (0, self._row))
+    self._row += rows.shape[0]
+
+  def close(self):
+    self._img.save(self._file, format=self._file_type.value, **self._save_options)
+
+
+def encode_strips(
+  img_buffer: bytes,
+  out: BinaryIO,
+  output: Filetype = Filetype.PNG,
+  watermark: str = "SDV2",
+  jpeg_quality: int = 75,
+  resize_for_social_media: bool = False,
+  strip_rows: int = STRIP_ROWS,
+  max_pixels: int = MAX_PIXELS,
+  engine: Engine = Engine.VECTORIZED,
+  png_compress_level: int = 6,
+  webp_quality: int = 80,
+  webp_lossless: bool = False,
+):
+  """
+  Watermarks img_buffer like apply_watermark and writes it to out in the output format,
+    holding only one strip of intermediate arrays at a time.
+  strip_rows: rows watermarked at once, rounded down to a multiple of 8.
+  max_pixels: largest accepted image, can be raised above apply_watermark's limit.
+  """
+  if jpeg_quality < 0 or jpeg_quality > 100:
+    raise ValueError("jpeg_quality must be between 0 and 100")
+
+  block = 4
+  tile = 2 * block
+  strip_rows = strip_rows // tile * tile
+  if strip_rows <= 0:
+    raise ValueError(f"strip_rows must be at least {tile}")
+
+  img, info = _open_image(img_buffer)
+  if resize_for_social_media and info.format == 'JPEG':
+    # Same decoder scale as apply_watermark, nothing is decoded yet
+    img.draft(img.mode, _social_media_draft_size(info.width, info.height))
+  _check_size(img.size[0] * img.size[1], max_pixels)
+  # Decoded once, the crops of the strips copy rows of it
+  img.load()
+  if resize_for_social_media:
+    img = _resize_for_social_media(img, original_size=(info.width, info.height))
+  width, height = img.size
+
+  if output == Filetype.PNG:
+    writer = PngStripWriter(out, width, height, png_compress_level)
+  elif output == Filetype.JPEG:
+    writer = ImageStripWriter(
+      out, width, height, output, quality=jpeg_quality, subsampling=0)
+  elif output == Filetype.WEBP:
+    writer = ImageStripWriter(
+      out, width, height, output, quality=webp_quality, lossless=webp_lossless)
+  else:
+    raise ValueError(f"Unsupported output format: {output.value}")
+
+  watermarks = np.unpackbits(
+    np.frombuffer(watermark.encode('utf-8', 'replace'), dtype=np.uint8))
+  blocks_per_row = width // block * block // 2 // block
+
+  for top in range(0, height, strip_rows):
+    bottom = min(top + strip_rows, height)
+    strip = img.crop((0, top, width, bottom))
+    if strip.mode != 'RGB':
+      strip = strip.convert('RGB')
+
+    first_block = top // tile * blocks_per_row
+    embed = EmbedMaxDct(
+      list(np.roll(watermarks, -first_block)), block=block, engine=engine)
+    writer.write(embed.encode_rgb(np.asarray(strip)))
+
+  writer.close()
@@ -0,0 +1,98 @@
+import io
+import os
+import tracemalloc
+import unittest
+import numpy as np
+from PIL import Image
+
+from watermark.apply_watermark import apply_watermark, decode_watermark, Filetype
+from watermark.streaming.strip_encoder import encode_strips
+
+
+WATERMARK = "SDV2"
+
+
+def original_image_bytes() -> bytes:
+  with open('../data/original.jpg', 'rb') as f:
+    return f.read()
+
+
+def peppers_image_bytes() -> bytes:
+  with open('../data/peppers.png', 'rb') as f:
+    return f.read()
+
+
+class TestStripEncoder(unittest.TestCase):
+  def test_png_matches_apply_watermark(self):
+    for name, img_bytes in [
+      ("original", original_image_bytes()),
+      ("peppers", peppers_image_bytes()),
+    ]:
+      _, expected_png = apply_watermark(img_bytes, watermark=WATERMARK)
+      expected = np.asarray(Image.open(expected_png))
+
+      # 600 and 1080 rows are not multiples of these, so the last strip is partial
+      for strip_rows in [8, 100, 256]:
+        encoded_png = io.BytesIO()
+        encode_strips(img_bytes, encoded_png, watermark=WATERMARK, strip_rows=strip_rows)
+
+        encoded = np.asarray(Image.open(io.BytesIO(encoded_png.getvalue())))
+        np.testing.assert_array_equal(
+          expected, encoded, f"streamed != full for {name}, {strip_rows} rows")
+
+  def test_jpeg(self):
+    img_bytes = peppers_image_bytes()
+    expected_jpg, _ = apply_watermark(img_bytes, watermark=WATERMARK)
+
+    encoded_jpg = io.BytesIO()
+    encode_strips(img_bytes, encoded_jpg, Filetype.JPEG, watermark=WATERMARK, strip_rows=64)
+    self.assertEqual(expected_jpg.getvalue(), encoded_jpg.getvalue())
+    self.assertEqual(WATERMARK, decode_watermark(encoded_jpg, wm_length=len(WATERMARK) * 8))
+
+  def test_memory_bound(self):
+    with Image.open('../data/peppers.png') as img:
+      img = img.convert('RGB')
+
+    # NumPy reports its buffers to tracemalloc, Pillow's decoded input is not included
+    strip_rows = 64
+    peaks = []
+    for height in [512, 2048]:
+      img_bytes = io.BytesIO()
+      img.resize((768, height)).save(img_bytes, format="png")
+      img_bytes = img_bytes.getvalue()
+
+      # A BytesIO output would be traced as it grows
+      with open(os.devnull, "wb") as sink:
+        tracemalloc.start()
+        try:
+          encode_strips(img_bytes, sink, strip_rows=strip_rows)
+          peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+          tracemalloc.stop()
+
+    self.assertLess(peaks[1], 128 * 768 * strip_rows)
+    # Independent of the image height
+    self.assertLess(peaks[1], 1.1 * peaks[0])
+
+  def test_resize_for_social_media(self):
+    # A JPEG wider than the social media maximum, decoded at a draft scale
+    with Image.open('../data/original.jpg') as img:
+      img = img.convert('RGB').resize((2400, 1600))
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="jpeg")
+    img_bytes = img_bytes.getvalue()
+
+    _, expected_png = apply_watermark(
+      img_bytes, Filetype.JPEG, watermark=WATERMARK, resize_for_social_media=True)
+    encoded_png = io.BytesIO()
+    encode_strips(img_bytes, encoded_png, watermark=WATERMARK, resize_for_social_media=True)
+    np.testing.assert_array_equal(
+      np.asarray(Image.open(expected_png)), np.asarray(Image.open(encoded_png)))
+
+  def test_max_pixels(self):
+    img_bytes = peppers_image_bytes()
+    with self.assertRaises(ValueError):
+      encode_strips(img_bytes, io.BytesIO(), max_pixels=500 * 500)
+    with self.assertRaises(ValueError):
+      encode_strips(img_bytes, io.BytesIO(), Filetype.GIF)
+
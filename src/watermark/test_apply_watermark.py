@@ -5,7 +5,8 @@ from PIL import Image
 import cv2
 from typing import Tuple
 
-from apply_watermark import _bytes_to_nparray, apply_watermark, decode_watermark, Filetype
+from watermark.apply_watermark import _bytes_to_nparray, _social_media_geometry, _jpeg_approximations, apply_watermark, probe_image, apply_watermark_batch, apply_watermark_lazy, decode_watermark, decode_watermark_sampled, Filetype
+from watermark.max_dct.max_dct_encoder import DecodeMaxDct, Z_THRESHOLD
 
 
 WATERMARK = "SDV2"
@@ -47,6 +48,12 @@ def wide_bytes() -> Tuple[bytes, Filetype]:
   return img_bytes, Filetype.JPEG
 
 
+def small_image_bytes() -> Tuple[bytes, Filetype]:
+  img_bytes = io.BytesIO()
+  Image.new('RGB', (64, 64)).save(img_bytes, format=Filetype.PNG.value)
+  return img_bytes.getvalue(), Filetype.PNG
+
+
 def expected_original_np_array():
   img = cv2.imread("../data/original.jpg")
   return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -120,6 +127,160 @@ class TestColorConversion(unittest.TestCase):
       self.assertEqual(WATERMARK, watermark_png,
                        f"watermark != expected for {name}")
 
+  def test_encode_expected(self):
+    # Fixtures written by the float32 pipeline, regenerate them when the encoded pixels
+    # change on purpose
+    _, encoded_png = apply_watermark(peppers_image_bytes()[0], Filetype.PNG, watermark=WATERMARK)
+    np.testing.assert_array_equal(
+      np.asarray(Image.open(io.BytesIO(expected_peppers_encoded_bytes())).convert('RGB')),
+      np.asarray(Image.open(encoded_png).convert('RGB')))
+
+    # JPEG encoders of other libjpeg builds round a little differently
+    encoded_jpg, _ = apply_watermark(original_image_bytes()[0], Filetype.JPEG, watermark=WATERMARK)
+    expected = np.asarray(Image.open(io.BytesIO(expected_original_encoded_bytes())).convert('RGB'))
+    actual = np.asarray(Image.open(encoded_jpg).convert('RGB'))
+    self.assertLessEqual(np.abs(expected.astype(int) - actual).max(), 2)
+
+  def test_encode_batch(self):
+    inputs = [
+      original_image_bytes()[0],
+      small_image_bytes()[0],
+      peppers_image_bytes()[0],
+      original_image_bytes()[0],
+    ]
+    results = apply_watermark_batch(inputs, watermark=WATERMARK)
+
+    self.assertEqual(len(inputs), len(results))
+    self.assertIsInstance(results[1], ValueError)
+
+    for index in [0, 2, 3]:
+      encoded_bytes_jpg, encoded_bytes_png = results[index]
+      expected_png = apply_watermark(inputs[index], watermark=WATERMARK)[1]
+      self.assertTrue(np.array_equal(
+        np.asarray(Image.open(expected_png)),
+        np.asarray(Image.open(encoded_bytes_png))))
+
+      for encoded_bytes in [encoded_bytes_jpg, encoded_bytes_png]:
+        self.assertEqual(WATERMARK, decode_watermark(
+          encoded_bytes, wm_length=len(WATERMARK) * 8))
+
+  def test_encode_lazy(self):
+    img_bytes = peppers_image_bytes()[0]
+    encoded_img = apply_watermark_lazy(img_bytes, watermark=WATERMARK)
+
+    # Nothing is encoded until it is read
+    self.assertEqual({}, encoded_img._encoded)
+    self.assertEqual(WATERMARK, decode_watermark(
+      encoded_img.png, wm_length=len(WATERMARK) * 8))
+    self.assertEqual([Filetype.PNG], list(encoded_img._encoded))
+
+    self.assertEqual(b"RIFF", encoded_img.webp.getvalue()[:4])
+
+  def test_encode_outputs(self):
+    img_bytes = peppers_image_bytes()[0]
+    encoded_bytes_webp, encoded_bytes_png = apply_watermark(
+      img_bytes, watermark=WATERMARK, outputs=[Filetype.WEBP, Filetype.PNG],
+      png_compress_level=1, webp_lossless=True)
+
+    self.assertEqual("WEBP", Image.open(encoded_bytes_webp).format)
+    self.assertEqual("PNG", Image.open(encoded_bytes_png).format)
+    for encoded_bytes in [encoded_bytes_webp, encoded_bytes_png]:
+      self.assertEqual(WATERMARK, decode_watermark(
+        encoded_bytes, wm_length=len(WATERMARK) * 8))
+
+    with self.assertRaises(ValueError):
+      apply_watermark(img_bytes, outputs=[Filetype.GIF])
+
+  def test_decode_fast(self):
+    wm_length = len(WATERMARK) * 8
+    for name, input_data in [
+      ("original", original_image_bytes()),
+      ("peppers", peppers_image_bytes()),
+    ]:
+      for jpeg_quality in [75, 95]:
+        encoded_bytes_jpg, encoded_bytes_png = apply_watermark(
+          input_data[0], input_data[1], jpeg_quality, watermark=WATERMARK)
+
+        decoder = DecodeMaxDct(wm_length=wm_length)
+        full = decoder.decode_rgb(_bytes_to_nparray(encoded_bytes_jpg.getvalue()))
+        fast = decoder.decode_approximations(
+          _jpeg_approximations(encoded_bytes_jpg.getvalue()))
+        np.testing.assert_array_equal(full, fast, f"fast != full for {name}")
+
+        self.assertEqual(WATERMARK, decode_watermark(
+          encoded_bytes_jpg, wm_length=wm_length, fast=True))
+        # Not a JPEG, decoded in full
+        self.assertEqual(WATERMARK, decode_watermark(
+          encoded_bytes_png, wm_length=wm_length, fast=True))
+
+  def test_decode_sampled(self):
+    for name, input_data in [
+      ("original", original_image_bytes()),
+      ("peppers", peppers_image_bytes()),
+    ]:
+      for encoded_bytes in apply_watermark(
+          input_data[0], input_data[1], watermark=WATERMARK):
+        watermark, confidence = decode_watermark_sampled(
+          encoded_bytes, wm_length=len(WATERMARK) * 8)
+        self.assertEqual(WATERMARK, watermark, f"watermark != expected for {name}")
+        self.assertEqual(len(WATERMARK) * 8, len(confidence))
+
+      # Not watermarked
+      _, confidence = decode_watermark_sampled(
+        io.BytesIO(input_data[0]), wm_length=len(WATERMARK) * 8)
+      self.assertLess(confidence.min(), Z_THRESHOLD)
+
+  def test_probe_image(self):
+    info = probe_image(original_image_bytes()[0])
+    self.assertEqual(("JPEG", 1920, 1080, "RGB", 1, 1), (
+      info.format, info.width, info.height, info.mode, info.orientation, info.frames))
+
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    img_bytes = io.BytesIO()
+    Image.new('RGB', (300, 400)).save(img_bytes, format="jpeg", exif=exif.tobytes())
+    self.assertEqual(6, probe_image(img_bytes.getvalue()).orientation)
+
+    img_bytes = io.BytesIO()
+    frames = [Image.new('RGB', (300, 300), (color, 0, 0)) for color in (0, 128, 255)]
+    frames[0].save(img_bytes, format="gif", save_all=True, append_images=frames[1:])
+    info = probe_image(img_bytes.getvalue())
+    self.assertEqual(("GIF", 3), (info.format, info.frames))
+    self.assertTrue(info.animated)
+
+  def test_oversize_jpeg_draft(self):
+    img_bytes = io.BytesIO()
+    Image.open(io.BytesIO(original_image_bytes()[0])).resize((4400, 2400)).save(
+      img_bytes, format="jpeg")
+    img_bytes = img_bytes.getvalue()
+
+    with self.assertRaises(ValueError):
+      _bytes_to_nparray(img_bytes, max_pixels=4_000_000)
+
+    # Decoded at a quarter scale, 1100 x 600, then resized
+    resized = _bytes_to_nparray(img_bytes, True, max_pixels=4_000_000)
+    self.assertEqual((589, 1080, 3), resized.shape)
+
+  def test_social_media_geometry(self):
+    for size, expected_size in [
+      # Tall, cropped then resized
+      ((3024, 4032), (1080, 1350)),
+      # Wide, cropped, resized and cropped again after rounding
+      ((6880, 1776), (1079, 565)),
+      ((1920, 1080), (1080, 607)),
+      ((200, 300), (320, 400)),
+      ((600, 600), (600, 600)),
+    ]:
+      _, actual_size = _social_media_geometry(*size)
+      self.assertEqual(expected_size, actual_size)
+
+    img_bytes = io.BytesIO()
+    Image.new('RGB', (3024, 4032), 'red').save(img_bytes, format="png")
+    resized = _bytes_to_nparray(
+      img_bytes.getvalue(), True, resize_filter=Image.Resampling.BILINEAR)
+    self.assertEqual((1350, 1080, 3), resized.shape)
+    self.assertTrue((resized == [255, 0, 0]).all())
+
   # def test_decode(self):
   #   for encoded_bytes in [
   #     expected_original_encoded_bytes(),
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import watermark
+from watermark.watermarker import Watermarker
+
+
+class TestColdStart(unittest.TestCase):
+  def test_import_is_lazy(self):
+    # A fresh interpreter, this one has loaded everything already
+    statement = (
+      "import logging, sys, watermark; "
+      "assert not {'numpy', 'PIL', 'pywt'} & set(sys.modules), sys.modules.keys(); "
+      "assert not logging.getLogger().handlers; "
+      "watermark.WatermarkEncoder; "
+      "assert 'numpy' in sys.modules")
+    subprocess.run(
+      [sys.executable, "-c", statement], check=True,
+      cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+  def test_apply_watermark_import_is_lazy(self):
+    statement = (
+      "import sys; "
+      "from watermark.apply_watermark import apply_watermark, decode_watermark, Filetype; "
+      "assert not {'numpy', 'PIL'} & set(sys.modules), sys.modules.keys()")
+    subprocess.run(
+      [sys.executable, "-c", statement], check=True,
+      cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+  def test_warm_up(self):
+    watermarker = Watermarker()
+    self.assertGreater(watermark.warm_up(shapes=[(256, 320)], watermarker=watermarker), 0)
+    self.assertEqual(1, len(watermarker._scratch))
+
+    with self.assertRaises(AttributeError):
+      watermark.not_exported
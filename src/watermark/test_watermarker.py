@@ -0,0 +1,84 @@
+import io
+import tracemalloc
+import unittest
+import numpy as np
+from PIL import Image
+import cv2
+
+from watermark.apply_watermark import apply_watermark_lazy, decode_watermark
+from watermark.encoder.watermark_encoder import WatermarkEncoder
+from watermark.watermarker import LRUCache, Watermarker
+
+
+def original_image():
+  img = cv2.imread("../data/original.jpg")
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def peppers_image():
+  img = cv2.imread("../data/peppers.png")
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def peppers_image_bytes() -> bytes:
+  with open('../data/peppers.png', 'rb') as f:
+    return f.read()
+
+
+class TestWatermarker(unittest.TestCase):
+  def test_encode_matches_watermark_encoder(self):
+    watermarker = Watermarker()
+    for _ in range(2):
+      for watermark in ["SDV2", "ab"]:
+        for image in [original_image(), peppers_image()]:
+          expected = WatermarkEncoder(watermark.encode('utf-8')).max_dwt_encode(image)
+          self.assertTrue(np.array_equal(
+            expected, watermarker.encode(image, watermark)))
+
+    self.assertEqual(4, len(watermarker._bit_plans))
+    self.assertEqual(2, len(watermarker._scratch))
+
+  def test_scratch_is_reused(self):
+    watermarker = Watermarker()
+    image = peppers_image()
+
+    first = watermarker.encode(image)
+    scratch = dict(watermarker._scratch[image.shape])
+    second = watermarker.encode(image)
+
+    self.assertTrue(np.array_equal(first, second))
+    for name, array in watermarker._scratch[image.shape].items():
+      self.assertIs(scratch[name], array)
+
+  def test_steady_state_allocations(self):
+    watermarker = Watermarker()
+    image = peppers_image()
+    out = np.empty_like(image)
+    watermarker.encode(image, out=out)
+
+    tracemalloc.start()
+    try:
+      watermarker.encode(image, out=out)
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    # Only the per block arrays of the embedding are allocated, the plain encoder
+    # allocates more than 10 times the size of the image
+    self.assertLess(peak, image.nbytes)
+
+  def test_apply_watermark(self):
+    watermarker = Watermarker()
+    img_bytes = peppers_image_bytes()
+    for _ in range(2):
+      encoded_img = watermarker.apply_watermark(img_bytes)
+      expected = apply_watermark_lazy(img_bytes)
+      self.assertEqual(expected.png.getvalue(), encoded_img.png.getvalue())
+      self.assertEqual("SDV2", decode_watermark(encoded_img.jpeg))
+
+  def test_lru_cache(self):
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"]
+    cache["c"] = 3
+    self.assertEqual(["a", "c"], list(cache))
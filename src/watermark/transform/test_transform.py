@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+
+from watermark.transform.transform import HaarBackend, PywtBackend
+
+
+class TestTransform(unittest.TestCase):
+  def test_haar_matches_pywt(self):
+    pywt_backend = PywtBackend()
+    haar_backend = HaarBackend()
+
+    def embed(ca):
+      ca += 7
+
+    rng = np.random.default_rng(0)
+    for dtype in [np.float32, np.float64]:
+      for shape in [(8, 8), (64, 36), (3, 16, 20)]:
+        x = (rng.random(shape) * 300 - 20).astype(dtype)
+
+        expected = pywt_backend.dwt2(x)
+        actual = haar_backend.dwt2(x)
+        for expected_band, actual_band in zip(
+            [expected[0], *expected[1]], [actual[0], *actual[1]]):
+          np.testing.assert_array_equal(expected_band, actual_band)
+
+        np.testing.assert_array_equal(
+          pywt_backend.approximation(x), haar_backend.approximation(x))
+        np.testing.assert_array_equal(
+          pywt_backend.idwt2(expected), haar_backend.idwt2(actual))
+
+        for swap_details in [False, True]:
+          expected_x = pywt_backend.transform_approximation(x.copy(), embed, swap_details)
+          np.testing.assert_array_equal(
+            expected_x, haar_backend.transform_approximation(x.copy(), embed, swap_details))
+          scratch = np.full(x.size // 2 + 3, np.nan, dtype=dtype)
+          np.testing.assert_array_equal(
+            expected_x, haar_backend.transform_approximation(
+              x.copy(), embed, swap_details, scratch=scratch))
+
+  def test_integer_input(self):
+    x = np.arange(64).reshape(8, 8)
+    self.assertEqual(PywtBackend().dwt2(x)[0].dtype, HaarBackend().dwt2(x)[0].dtype)
+    for x in [x, x.astype(np.uint8), x.astype(np.int16)]:
+      expected = PywtBackend().approximation(x)
+      actual = HaarBackend().approximation(x)
+      self.assertEqual(expected.dtype, actual.dtype)
+      np.testing.assert_array_equal(expected, actual)
+
+    with self.assertRaises(ValueError):
+      HaarBackend().transform_approximation(x, lambda ca: None)
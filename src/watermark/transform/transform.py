@@ -0,0 +1,148 @@
+"""
+Single level 2D Haar transform backends for the max DCT embedder and decoder.
+
+Backends provide
+  dwt2(x) -> (ca, (ch, cv, cd)) and idwt2((ca, (ch, cv, cd))) -> x, as pywt.dwt2 and
+    pywt.idwt2 with 'haar' over the last two axes
+  approximation(x) -> ca, the approximation band alone
+  transform_approximation(x, fn, swap_details, scratch) -> x', the inverse transform of
+    x after fn changed its approximation band in place. scratch is an optional flat
+    array of x's dtype with at least x.size // 2 elements the backend may use instead
+    of allocating.
+
+HaarBackend computes every coefficient with the same float operations in the same
+order as PyWavelets, so both backends give identical results.
+"""
+from enum import Enum
+import numpy as np
+
+
+class Transform(Enum):
+  PYWT = "pywt"
+  HAAR = "haar"
+
+
+class PywtBackend(object):
+  """
+  PyWavelets, imported on first use
+  """
+
+  def dwt2(self, x: np.ndarray):
+    import pywt
+    return pywt.dwt2(x, 'haar')
+
+  def idwt2(self, coeffs) -> np.ndarray:
+    import pywt
+    return pywt.idwt2(coeffs, 'haar')
+
+  def approximation(self, x: np.ndarray) -> np.ndarray:
+    return self.dwt2(x)[0]
+
+  def transform_approximation(self, x: np.ndarray, fn, swap_details: bool = False,
+                              scratch=None) -> np.ndarray:
+    ca, (ch, cv, cd) = self.dwt2(x)
+    fn(ca)
+    if swap_details:
+      ch, cv = cv, ch
+    return self.idwt2((ca, (ch, cv, cd)))
+
+
+class HaarBackend(object):
+  """
+  Haar in NumPy. transform_approximation works in x: the coefficients of every 2x2
+  group replace its pixels, with the approximation at the top left, so no band is
+  allocated separately.
+  """
+
+  def dwt2(self, x: np.ndarray):
+    x = np.array(x, dtype=x.dtype if x.dtype.kind == 'f' else np.float64)
+    self._forward(x)
+    return x[..., 0::2, 0::2], (x[..., 1::2, 0::2], x[..., 0::2, 1::2], x[..., 1::2, 1::2])
+
+  def idwt2(self, coeffs) -> np.ndarray:
+    ca, (ch, cv, cd) = coeffs
+    x = np.empty(ca.shape[:-2] + (2 * ca.shape[-2], 2 * ca.shape[-1]), dtype=ca.dtype)
+    x[..., 0::2, 0::2] = ca
+    x[..., 1::2, 0::2] = ch
+    x[..., 0::2, 1::2] = cv
+    x[..., 1::2, 1::2] = cd
+    self._inverse(x)
+    return x
+
+  def approximation(self, x: np.ndarray) -> np.ndarray:
+    # Computed in float64 for other than float input, as dwt2
+    if x.dtype.kind != 'f':
+      x = x.astype(np.float64)
+    s = x.dtype.type(np.sqrt(0.5))
+    low = s * x[..., 1::2, :] + s * x[..., 0::2, :]
+    return s * low[..., 1::2] + s * low[..., 0::2]
+
+  def transform_approximation(self, x: np.ndarray, fn, swap_details: bool = False,
+                              scratch=None) -> np.ndarray:
+    """
+    x: float array, overwritten with the result
+    """
+    if x.dtype.kind != 'f':
+      raise ValueError(f"transform_approximation works in place, x must be float, not {x.dtype}")
+    if scratch is None:
+      scratch = np.empty(x.size // 2, dtype=x.dtype)
+    self._forward(x, scratch)
+    fn(x[..., 0::2, 0::2])
+    if swap_details:
+      ch = _scratch_view(scratch, x[..., 1::2, 0::2])
+      ch[...] = x[..., 1::2, 0::2]
+      x[..., 1::2, 0::2] = x[..., 0::2, 1::2]
+      x[..., 0::2, 1::2] = ch
+    self._inverse(x, scratch)
+    return x
+
+  @staticmethod
+  def _forward(x: np.ndarray, scratch=None):
+    # low = s * odd + s * even, high = (-s) * odd + s * even, along axis -2 then -1
+    s = x.dtype.type(np.sqrt(0.5))
+    for axis in [-2, -1]:
+      even = _every_other(x, axis, 0)
+      odd = _every_other(x, axis, 1)
+      scaled_odd = np.multiply(odd, s, out=_scratch_view(scratch, odd))
+      scaled_even = np.multiply(even, s, out=even)
+      np.subtract(scaled_even, scaled_odd, out=odd)
+      np.add(scaled_odd, scaled_even, out=even)
+
+  @staticmethod
+  def _inverse(x: np.ndarray, scratch=None):
+    # even = s * low + s * high, odd = s * low + (-s) * high, along axis -1 then -2
+    s = x.dtype.type(np.sqrt(0.5))
+    for axis in [-1, -2]:
+      low = _every_other(x, axis, 0)
+      high = _every_other(x, axis, 1)
+      scaled_high = np.multiply(high, s, out=_scratch_view(scratch, high))
+      scaled_low = np.multiply(low, s, out=low)
+      np.subtract(scaled_low, scaled_high, out=high)
+      np.add(scaled_low, scaled_high, out=low)
+
+
+def _scratch_view(scratch, like: np.ndarray):
+  """
+  The start of the flat scratch array shaped like like, or None without scratch
+  """
+  if scratch is None:
+    return None
+  return scratch[:like.size].reshape(like.shape)
+
+
+def _every_other(x: np.ndarray, axis: int, start: int) -> np.ndarray:
+  if axis == -2:
+    return x[..., start::2, :]
+  return x[..., start::2]
+
+
+def backend(transform):
+  """
+  Backend for a Transform, other objects are returned as they are, so any object
+  with the backend methods can be used
+  """
+  if transform == Transform.PYWT:
+    return PywtBackend()
+  if transform == Transform.HAAR:
+    return HaarBackend()
+  return transform
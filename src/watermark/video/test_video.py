@@ -0,0 +1,104 @@
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+
+from watermark.encoder.watermark_encoder import WatermarkDecoder
+from watermark.max_dct.max_dct_encoder import Z_THRESHOLD
+from watermark.video.video import (
+  ChromaRange, FfmpegWriter, YuvFrame, encode_frames, ffmpeg_available, ffmpeg_reader,
+  read_image_sequence, read_yuv420p, verify_frames, write_image_sequence, write_yuv420p)
+
+
+WATERMARK = "SDV2"
+WIDTH, HEIGHT = 640, 360
+
+
+def frame_images(count: int = 4):
+  with Image.open('../data/original.jpg') as img:
+    img = img.convert('RGB').resize((WIDTH, HEIGHT))
+  return [img.rotate(angle) for angle in range(0, 5 * count, 5)]
+
+
+def limited_range(frame: YuvFrame) -> YuvFrame:
+  y = np.rint(frame.y * (219 / 255) + 16).astype(np.uint8)
+  u, v = (np.rint((plane - 128.0) * (224 / 255) + 128).astype(np.uint8)
+          for plane in (frame.u, frame.v))
+  return YuvFrame(y, u, v, ChromaRange.LIMITED)
+
+
+class TestVideo(unittest.TestCase):
+  def test_image_sequence(self):
+    with tempfile.TemporaryDirectory() as directory:
+      paths = []
+      for index, img in enumerate(frame_images()):
+        paths.append(os.path.join(directory, f"in_{index}.png"))
+        img.save(paths[-1])
+
+      pattern = os.path.join(directory, "out_{}.png")
+      encoded = encode_frames(read_image_sequence(paths), WATERMARK, workers=2)
+      self.assertEqual(4, write_image_sequence(encoded, pattern))
+
+      # The frames decode as images too
+      decoder = WatermarkDecoder(len(WATERMARK) * 8)
+      for index in range(4):
+        rgb = np.asarray(Image.open(pattern.format(index)))
+        self.assertEqual(WATERMARK, decoder.decode(rgb).decode('utf-8'))
+
+  def test_yuv420p(self):
+    frames = [limited_range(YuvFrame.from_image(img)) for img in frame_images()]
+    raw = io.BytesIO()
+    self.assertEqual(4, write_yuv420p(encode_frames(frames, WATERMARK), raw))
+    self.assertEqual(4 * WIDTH * HEIGHT * 3 // 2, raw.tell())
+
+    raw.seek(0)
+    watermark, confidence = verify_frames(
+      read_yuv420p(raw, WIDTH, HEIGHT), len(WATERMARK) * 8, frame_step=2)
+    self.assertEqual(WATERMARK, watermark.decode('utf-8'))
+    self.assertEqual((32,), confidence.shape)
+    self.assertGreaterEqual(confidence.min(), Z_THRESHOLD)
+
+    raw.seek(0)
+    frame = next(read_yuv420p(raw, WIDTH, HEIGHT))
+    decoder = WatermarkDecoder(len(WATERMARK) * 8)
+    self.assertEqual(WATERMARK, decoder.decode(np.asarray(frame.to_image())).decode('utf-8'))
+
+  def test_verify_unwatermarked(self):
+    rng = np.random.default_rng(0)
+    for images in [
+      frame_images(),
+      # Repeating a frame must not make its score more confident
+      frame_images(1) * 16,
+      [Image.new('RGB', (WIDTH, HEIGHT), (128, 128, 128))] * 16,
+      [Image.fromarray(rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8))] * 4,
+    ]:
+      _, confidence = verify_frames(
+        (YuvFrame.from_image(img) for img in images), len(WATERMARK) * 8)
+      self.assertLess(confidence.min(), Z_THRESHOLD)
+
+  def test_in_flight(self):
+    frame = YuvFrame.from_image(frame_images(1)[0])
+    read = []
+
+    def source():
+      for index in range(20):
+        read.append(index)
+        yield frame
+
+    for written, _ in enumerate(encode_frames(source(), workers=2, max_in_flight=3)):
+      self.assertLessEqual(len(read) - written, 3)
+    self.assertEqual(20, len(read))
+
+  @unittest.skipUnless(ffmpeg_available(), "ffmpeg is not installed")
+  def test_ffmpeg(self):
+    frames = [YuvFrame.from_image(img) for img in frame_images()]
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "clip.mkv")
+      with FfmpegWriter(path, WIDTH, HEIGHT) as writer:
+        writer.write(encode_frames(frames, WATERMARK))
+
+      watermark, _ = verify_frames(
+        ffmpeg_reader(path, WIDTH, HEIGHT, ChromaRange.FULL), len(WATERMARK) * 8)
+      self.assertEqual(WATERMARK, watermark.decode('utf-8'))
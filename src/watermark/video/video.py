@@ -0,0 +1,359 @@
+"""
+Streaming watermarking of video frames in YUV 4:2:0.
+
+Frames flow through generators: a source yields YuvFrames, encode_frames watermarks
+them on a thread pool with at most max_in_flight frames pending and yields them in
+order as they finish, and a sink writes each one out. Only max_in_flight frames are
+held at once, whatever the length of the clip.
+
+Sources and sinks:
+  read_yuv420p / write_yuv420p: raw yuv420p streams, e.g. ffmpeg -f rawvideo.
+  read_image_sequence / write_image_sequence: one image file per frame.
+  ffmpeg_reader / FfmpegWriter: any format ffmpeg can read or write, through pipes.
+
+Only the U plane is watermarked, as by EmbedMaxDct. The encoder subsamples U to 4:2:0
+before its DWT, so every chroma sample covers a 2x2 pixel block and the Haar
+approximation band of U is twice the 4:2:0 chroma plane. Frames are watermarked on
+that plane directly, without converting them to RGB and back or computing a DWT.
+"""
+import itertools
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import BinaryIO, Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from ..color_conversion.color_conversion import COMPUTE_DTYPE, RGB_TO_YUV
+from ..max_dct.max_dct_encoder import DecodeMaxDct, EmbedMaxDct, Z_THRESHOLD, vote_z_scores
+
+# Scale of the U channel in EmbedMaxDct and DecodeMaxDct
+SCALE = 36
+
+# Frames decoded, being watermarked or waiting to be written at once, per worker
+IN_FLIGHT_PER_WORKER = 2
+
+# Frames verify_frames reads before it may stop
+MIN_FRAMES = 8
+
+
+class ChromaRange(Enum):
+  # Chroma spans 0-255, as in JPEG and Pillow's YCbCr
+  FULL = "full"
+  # Chroma spans 16-240, as in most video, ffmpeg's "tv" range
+  LIMITED = "limited"
+
+
+def _u_per_chroma(chroma_range: ChromaRange) -> float:
+  """
+  Change of the U channel of rgb_to_yuv per unit of chroma (Cb)
+  """
+  # U = 0.436 * (B - Y) / (1 - 0.114) and full range Cb = 0.5 * (B - Y) / (1 - 0.114)
+  u_per_chroma = RGB_TO_YUV[2, 1] / 0.5
+  if chroma_range == ChromaRange.LIMITED:
+    u_per_chroma *= 255 / 224
+  return u_per_chroma
+
+
+class YuvFrame(object):
+  """
+  A frame as uint8 planes: y is (height, width), u and v are the 4:2:0 chroma planes,
+  ((height + 1) // 2, (width + 1) // 2).
+  """
+
+  def __init__(self, y: np.ndarray, u: np.ndarray, v: np.ndarray,
+               chroma_range: ChromaRange = ChromaRange.LIMITED):
+    self.y = y
+    self.u = u
+    self.v = v
+    self.chroma_range = chroma_range
+
+  @property
+  def width(self) -> int:
+    return self.y.shape[1]
+
+  @property
+  def height(self) -> int:
+    return self.y.shape[0]
+
+  @classmethod
+  def from_image(cls, img: Image.Image) -> "YuvFrame":
+    """
+    Converts with Pillow's full range YCbCr, chroma subsampled by averaging 2x2 blocks
+    """
+    y, cb, cr = (np.asarray(plane) for plane in img.convert('YCbCr').split())
+    return cls(y, _subsample(cb), _subsample(cr), ChromaRange.FULL)
+
+  def to_image(self) -> Image.Image:
+    """
+    RGB image of the frame, chroma upsampled by repeating every sample over its 2x2 block
+    """
+    planes = [self.y] + [
+      np.ascontiguousarray(_upsample(plane)[:self.height, :self.width])
+      for plane in (self.u, self.v)]
+    if self.chroma_range == ChromaRange.LIMITED:
+      planes = _full_range(planes)
+    img = Image.merge('YCbCr', [Image.fromarray(plane, 'L') for plane in planes])
+    return img.convert('RGB')
+
+
+def _subsample(plane: np.ndarray) -> np.ndarray:
+  if plane.shape[0] % 2 or plane.shape[1] % 2:
+    plane = np.pad(plane, ((0, plane.shape[0] % 2), (0, plane.shape[1] % 2)), mode='edge')
+  total = plane[0::2, 0::2].astype(np.uint16) + plane[0::2, 1::2]
+  total += plane[1::2, 0::2]
+  total += plane[1::2, 1::2]
+  total += 2
+  return (total // 4).astype(np.uint8)
+
+
+def _upsample(plane: np.ndarray) -> np.ndarray:
+  return np.repeat(np.repeat(plane, 2, axis=0), 2, axis=1)
+
+
+def _full_range(planes):
+  """
+  Limited range Y, U, V planes stretched to full range
+  """
+  y = np.clip((planes[0].astype(np.float32) - 16) * (255 / 219), 0, 255)
+  chroma = [np.clip((plane.astype(np.float32) - 128) * (255 / 224) + 128, 0, 255)
+            for plane in planes[1:]]
+  return [np.rint(plane).astype(np.uint8) for plane in [y] + chroma]
+
+
+def read_yuv420p(file: BinaryIO, width: int, height: int,
+                 chroma_range: ChromaRange = ChromaRange.LIMITED) -> Iterator[YuvFrame]:
+  """
+  Frames of a raw yuv420p stream, until it ends. A truncated last frame is dropped.
+  """
+  chroma_shape = ((height + 1) // 2, (width + 1) // 2)
+  y_size = width * height
+  chroma_size = chroma_shape[0] * chroma_shape[1]
+  frame_size = y_size + 2 * chroma_size
+
+  while True:
+    data = file.read(frame_size)
+    if len(data) < frame_size:
+      return
+    planes = np.frombuffer(data, dtype=np.uint8)
+    yield YuvFrame(
+      planes[:y_size].reshape(height, width),
+      planes[y_size:y_size + chroma_size].reshape(chroma_shape),
+      planes[y_size + chroma_size:].reshape(chroma_shape),
+      chroma_range)
+
+
+def write_yuv420p(frames: Iterable[YuvFrame], file: BinaryIO) -> int:
+  """
+  Writes frames as a raw yuv420p stream, returns the number of frames
+  """
+  count = 0
+  for frame in frames:
+    for plane in (frame.y, frame.u, frame.v):
+      file.write(np.ascontiguousarray(plane).data)
+    count += 1
+  return count
+
+
+def read_image_sequence(paths: Iterable[str]) -> Iterator[YuvFrame]:
+  """
+  Frames of a sequence of image files, converted to full range YUV 4:2:0
+  """
+  for path in paths:
+    with Image.open(path) as img:
+      yield YuvFrame.from_image(img)
+
+
+def write_image_sequence(frames: Iterable[YuvFrame], pattern: str, **save_options) -> int:
+  """
+  Writes every frame to the image file pattern.format(index), e.g. "frame_{:05d}.png".
+  Returns the number of frames.
+  """
+  count = 0
+  for index, frame in enumerate(frames):
+    frame.to_image().save(pattern.format(index), **save_options)
+    count += 1
+  return count
+
+
+def ffmpeg_available(ffmpeg: str = "ffmpeg") -> bool:
+  return shutil.which(ffmpeg) is not None
+
+
+def probe_video(path: str, ffprobe: str = "ffprobe") -> Tuple[int, int, float]:
+  """
+  Width, height and frame rate of the first video stream of path
+  """
+  result = subprocess.run(
+    [ffprobe, "-v", "error", "-select_streams", "v:0",
+     "-show_entries", "stream=width,height,r_frame_rate", "-of", "csv=p=0", path],
+    capture_output=True, text=True, check=True)
+  width, height, rate = result.stdout.strip().split(",")
+  numerator, _, denominator = rate.partition("/")
+  return int(width), int(height), int(numerator) / int(denominator or 1)
+
+
+def ffmpeg_reader(path: str, width: int, height: int,
+                  chroma_range: ChromaRange = ChromaRange.LIMITED,
+                  ffmpeg: str = "ffmpeg") -> Iterator[YuvFrame]:
+  """
+  Frames of any video ffmpeg can decode, converted by ffmpeg to yuv420p and read from
+  a pipe. width and height are the size of the video, see probe_video.
+  """
+  process = subprocess.Popen(
+    [ffmpeg, "-v", "error", "-i", path, "-f", "rawvideo", "-pix_fmt", "yuv420p", "-"],
+    stdout=subprocess.PIPE)
+  try:
+    yield from read_yuv420p(process.stdout, width, height, chroma_range)
+  finally:
+    process.stdout.close()
+    process.kill()
+    process.wait()
+
+
+class FfmpegWriter(object):
+  """
+  Context manager writing frames to any video ffmpeg can encode, through a pipe:
+
+    with FfmpegWriter("out.mkv", width, height, fps) as writer:
+      writer.write(frames)
+
+  output_args: ffmpeg output options. The default, lossless FFV1, keeps the watermark;
+    lossy codecs may not.
+  """
+
+  def __init__(self, path: str, width: int, height: int, fps: float = 25,
+               output_args: Sequence[str] = ("-c:v", "ffv1"), ffmpeg: str = "ffmpeg"):
+    self._command = [
+      ffmpeg, "-v", "error", "-y", "-f", "rawvideo", "-pix_fmt", "yuv420p",
+      "-s", f"{width}x{height}", "-r", str(fps), "-i", "-", *output_args, path]
+    self._process = None
+
+  def __enter__(self):
+    self._process = subprocess.Popen(self._command, stdin=subprocess.PIPE)
+    return self
+
+  def write(self, frames: Iterable[YuvFrame]) -> int:
+    return write_yuv420p(frames, self._process.stdin)
+
+  def __exit__(self, *exc):
+    self._process.stdin.close()
+    if self._process.wait() != 0 and exc[0] is None:
+      raise RuntimeError(f"ffmpeg exited with status {self._process.returncode}")
+
+
+def _u_approximation(chroma: np.ndarray, chroma_range: ChromaRange) -> np.ndarray:
+  """
+  Haar approximation band of the U channel the encoder watermarks, from a 4:2:0
+  chroma plane. Like EmbedMaxDct, only whole 4x4 blocks of it are used.
+  """
+  block = 4
+  rows = chroma.shape[0] // block * block
+  columns = chroma.shape[1] // block * block
+  u_per_chroma = COMPUTE_DTYPE(_u_per_chroma(chroma_range))
+  # 2 * (u_per_chroma * (chroma - 128) + 127.5)
+  approximation = chroma[:rows, :columns].astype(COMPUTE_DTYPE)
+  approximation -= COMPUTE_DTYPE(128)
+  approximation *= 2 * u_per_chroma
+  approximation += COMPUTE_DTYPE(2 * 127.5)
+  return approximation
+
+
+def _embed_frame(frame: YuvFrame, embed: EmbedMaxDct) -> YuvFrame:
+  approximation = _u_approximation(frame.u, frame.chroma_range)
+  delta = approximation.copy()
+  embed.encode_frame(delta, SCALE)
+  delta -= approximation
+  # Back to chroma units, the approximation is twice the chroma plane
+  delta *= COMPUTE_DTYPE(0.5 / _u_per_chroma(frame.chroma_range))
+
+  rows, columns = delta.shape
+  u = frame.u.copy()
+  region = u[:rows, :columns]
+  np.rint(delta + region, out=delta)
+  np.clip(delta, 0, 255, out=delta)
+  region[...] = delta
+  return YuvFrame(frame.y, u, frame.v, frame.chroma_range)
+
+
+def encode_frames(
+  frames: Iterable[YuvFrame],
+  watermark: str = "SDV2",
+  workers: Optional[int] = None,
+  max_in_flight: Optional[int] = None,
+) -> Iterator[YuvFrame]:
+  """
+  Watermarks frames on a pool of workers threads, the number of CPUs by default, and
+    yields them in input order. Every frame gets the full watermark, as an image would.
+  max_in_flight: most frames read from frames and not yet yielded,
+    IN_FLIGHT_PER_WORKER * workers by default.
+  """
+  workers = workers or os.cpu_count() or 1
+  max_in_flight = max_in_flight or IN_FLIGHT_PER_WORKER * workers
+  embed = EmbedMaxDct(
+    list(np.unpackbits(np.frombuffer(watermark.encode('utf-8', 'replace'), dtype=np.uint8))),
+    bit_plans={})
+
+  frames = iter(frames)
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    pending = deque()
+    while True:
+      # A frame is only read once there is room for it
+      if len(pending) == max_in_flight:
+        yield pending.popleft().result()
+      frame = next(frames, None)
+      if frame is None:
+        break
+      if frame.width * frame.height < 256 * 256:
+        raise ValueError("Frames are too small. Should be larger than 256x256 ")
+      pending.append(executor.submit(_embed_frame, frame, embed))
+    while pending:
+      yield pending.popleft().result()
+
+
+def verify_frames(
+  frames: Iterable[YuvFrame],
+  wm_length: int = 32,
+  frame_step: int = 1,
+  max_frames: Optional[int] = None,
+  z_threshold: float = Z_THRESHOLD,
+  min_frames: int = MIN_FRAMES,
+) -> Tuple[bytes, np.ndarray]:
+  """
+  Decodes the watermark from the votes of the blocks of every frame_step-th frame, up
+  to max_frames of them.
+  The z-score of a bit in one frame is computed as in DecodeMaxDct.decode_rgb_sampled.
+  Consecutive frames are near copies of each other, so the z-scores of the frames are
+  averaged rather than their votes pooled, and repeating a frame does not make its
+  score more confident. Stops reading frames once min_frames are read and the averaged
+  score of every bit is at least z_threshold.
+  Returns the watermark and the averaged |z| of every bit.
+  """
+  decoder = DecodeMaxDct(wm_length=wm_length)
+  sums = np.zeros(wm_length)
+  counts = np.zeros(wm_length, dtype=np.int64)
+  z_sum = np.zeros(wm_length)
+  z = np.zeros(wm_length)
+
+  read = 0
+  for frame in itertools.islice(frames, 0, max_frames and max_frames * frame_step, frame_step):
+    frame_sums = np.zeros(wm_length)
+    frame_counts = np.zeros(wm_length, dtype=np.int64)
+    decoder.vote_approximations(
+      [None, _u_approximation(frame.u, frame.chroma_range)], frame_sums, frame_counts)
+    sums += frame_sums
+    counts += frame_counts
+    z_sum += vote_z_scores(frame_sums, frame_counts)
+    read += 1
+
+    z = np.abs(z_sum / read)
+    if read >= min_frames and np.all(z >= z_threshold):
+      break
+
+  avgScores = np.full(wm_length, np.nan)
+  np.divide(sums, counts, out=avgScores, where=counts > 0)
+  return np.packbits(avgScores * 255 > 127).tobytes(), z
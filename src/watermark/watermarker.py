@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import numpy as np
+
+from .apply_watermark import WatermarkedImage, _bytes_to_nparray
+from .color_conversion.color_conversion import COMPUTE_DTYPE
+from .max_dct.max_dct_encoder import EmbedMaxDct, Engine
+
+
+class LRUCache(OrderedDict):
+  """
+  Dict that drops its least recently used entries beyond maxsize
+  """
+
+  def __init__(self, maxsize: int = 32):
+    super().__init__()
+    self._maxsize = maxsize
+
+  def __getitem__(self, key):
+    value = super().__getitem__(key)
+    self.move_to_end(key)
+    return value
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self.move_to_end(key)
+    while len(self) > self._maxsize:
+      self.popitem(last=False)
+
+
+class Watermarker(object):
+  """
+  Long lived encoder for serving many requests.
+
+  Keeps the unpacked bits of recent watermarks, the bit of every block per
+  (watermark, band shape) and the intermediate arrays of recent image shapes, so
+  requests at common resolutions reuse them instead of allocating.
+
+  Scratch arrays are reused between calls, so one Watermarker must not be used from
+  several threads at once. Use one per thread or worker.
+  """
+
+  def __init__(
+    self,
+    engine: Engine = Engine.VECTORIZED,
+    dtype=COMPUTE_DTYPE,
+    max_bit_plans: int = 32,
+    max_scratch_shapes: int = 4,
+  ):
+    self._engine = engine
+    self._dtype = dtype
+    self._embedders = LRUCache(max_bit_plans)
+    self._bit_plans = LRUCache(max_bit_plans)
+    self._scratch = LRUCache(max_scratch_shapes)
+
+  def encode(self, rgb: np.ndarray, watermark: str = "SDV2", out=None) -> np.ndarray:
+    """
+    Same result as WatermarkEncoder(watermark.encode('utf-8', 'replace')).max_dwt_encode(rgb).
+    out: optional uint8 array shaped like rgb to write the result to.
+    """
+    rows, columns, _ = rgb.shape[-3:]
+    if rows * columns < 256 * 256:
+      raise RuntimeError(
+          'image too small, should be larger than 256x256')
+
+    if rgb.shape not in self._scratch:
+      self._scratch[rgb.shape] = {}
+    scratch = self._scratch[rgb.shape]
+
+    if out is None:
+      # The result is handed out, so it is the one array that is not reused
+      out = np.empty(rgb.shape, dtype=np.uint8)
+    return self._embedder(watermark).encode_rgb(rgb, out=out, scratch=scratch)
+
+  def apply_watermark(
+    self,
+    img_buffer: bytes,
+    watermark: str = "SDV2",
+    jpeg_quality: int = 75,
+    resize_for_social_media: bool = False,
+    **output_options,
+  ) -> WatermarkedImage:
+    """
+    Same as apply_watermark.apply_watermark_lazy
+    """
+    if jpeg_quality < 0 or jpeg_quality > 100:
+      raise ValueError("jpeg_quality must be between 0 and 100")
+
+    img = _bytes_to_nparray(img_buffer, resize_for_social_media)
+
+    scratch = self._scratch.get(img.shape)
+    out = None if scratch is None else scratch.get("out")
+    if out is None or out.shape != img.shape:
+      out = np.empty(img.shape, dtype=np.uint8)
+
+    encoded_img = WatermarkedImage(
+      self.encode(img, watermark, out=out), jpeg_quality=jpeg_quality, **output_options)
+    # WatermarkedImage copies the pixels, so the output array can be reused too
+    self._scratch[img.shape]["out"] = out
+    return encoded_img
+
+  def _embedder(self, watermark: str) -> EmbedMaxDct:
+    if watermark not in self._embedders:
+      seq = np.frombuffer(watermark.encode('utf-8', 'replace'), dtype=np.uint8)
+      self._embedders[watermark] = EmbedMaxDct(
+        list(np.unpackbits(seq)), engine=self._engine, dtype=self._dtype,
+        bit_plans=self._bit_plans)
+    return self._embedders[watermark]
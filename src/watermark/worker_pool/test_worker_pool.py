@@ -0,0 +1,82 @@
+import asyncio
+import io
+import unittest
+from multiprocessing import resource_tracker, shared_memory
+from unittest import mock
+import numpy as np
+from PIL import Image
+
+from watermark.apply_watermark import apply_watermark
+from watermark.worker_pool.worker_pool import WatermarkPool, _attach
+
+
+WATERMARK = "SDV2"
+
+
+def original_image_bytes() -> bytes:
+  with open('../data/original.jpg', 'rb') as f:
+    return f.read()
+
+
+def peppers_image_bytes() -> bytes:
+  with open('../data/peppers.png', 'rb') as f:
+    return f.read()
+
+
+def small_image_bytes() -> bytes:
+  img_bytes = io.BytesIO()
+  Image.new('RGB', (64, 64)).save(img_bytes, format="png")
+  return img_bytes.getvalue()
+
+
+class TestWatermarkPool(unittest.TestCase):
+  def test_encode_decode(self):
+    async def run():
+      async with WatermarkPool(workers=2, max_pending=1) as pool:
+        inputs = [original_image_bytes(), peppers_image_bytes()]
+        encoded = await asyncio.gather(
+          *[pool.encode(img_bytes, watermark=WATERMARK) for img_bytes in inputs])
+
+        decoded = await asyncio.gather(
+          *[pool.decode(buffer, wm_length=len(WATERMARK) * 8)
+            for pair in encoded for buffer in pair])
+        return inputs, encoded, decoded
+
+    inputs, encoded, decoded = asyncio.run(run())
+
+    self.assertEqual([WATERMARK] * 4, decoded)
+    for img_bytes, (_, encoded_png) in zip(inputs, encoded):
+      expected_png = apply_watermark(img_bytes, watermark=WATERMARK)[1]
+      self.assertTrue(np.array_equal(
+        np.asarray(Image.open(expected_png)), np.asarray(Image.open(encoded_png))))
+
+  def test_encode_error(self):
+    async def run():
+      with WatermarkPool(workers=1) as pool:
+        await pool.encode(small_image_bytes())
+
+    with self.assertRaises(ValueError):
+      asyncio.run(run())
+
+  def test_attach_untracked(self):
+    shm = shared_memory.SharedMemory(create=True, size=16)
+    try:
+      # Only the parent that unlinks the memory keeps it registered
+      with mock.patch.object(resource_tracker, "register") as register, \
+           mock.patch.object(resource_tracker, "unregister") as unregister:
+        _attach(shm.name).close()
+      self.assertEqual(register.call_count, unregister.call_count)
+    finally:
+      shm.close()
+      shm.unlink()
+
+  def test_event_loops(self):
+    async def decode_twice(pool, img_bytes):
+      return await asyncio.gather(*[
+        pool.decode(io.BytesIO(img_bytes), wm_length=len(WATERMARK) * 8) for _ in range(2)])
+
+    encoded = apply_watermark(peppers_image_bytes(), watermark=WATERMARK)[1].getvalue()
+    with WatermarkPool(workers=1, max_pending=1) as pool:
+      # Every asyncio.run has its own loop
+      for _ in range(2):
+        self.assertEqual([WATERMARK] * 2, asyncio.run(decode_twice(pool, encoded)))
@@ -0,0 +1,152 @@
+"""
+Process pool facade around apply_watermark and decode_watermark.
+
+The watermarking loops are CPU bound and hold the GIL, so requests are spread over
+worker processes. Images are decoded in the parent and handed to the workers through
+shared memory instead of pickling the pixel arrays, only the compressed results
+travel back.
+"""
+import asyncio
+import io
+import multiprocessing
+import sys
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..apply_watermark import DEFAULT_OUTPUTS, Filetype, WatermarkedImage, _bytes_to_nparray
+from ..encoder.watermark_encoder import WatermarkEncoder, WatermarkDecoder
+
+# Before Python 3.13 attaching to shared memory always registers it with the tracker
+_ATTACH_TRACKS = sys.version_info < (3, 13)
+
+
+class WatermarkPool(object):
+  """
+  workers: number of worker processes, defaults to the number of CPUs.
+  max_pending: maximum number of requests decoded and in flight at once. Further
+    callers wait for a slot, which bounds the memory held by shared arrays.
+  """
+
+  def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None):
+    self._workers = workers or multiprocessing.cpu_count()
+    self._max_pending = max_pending or 2 * self._workers
+    self._executor = ProcessPoolExecutor(
+      max_workers=self._workers, mp_context=multiprocessing.get_context("spawn"))
+    # Semaphores are bound to the event loop they are first used in
+    self._pending = weakref.WeakKeyDictionary()
+
+  async def encode(
+    self,
+    img_buffer: bytes,
+    file_type: Filetype = Filetype.PNG,
+    jpeg_quality: int = 75,
+    watermark: str = "SDV2",
+    resize_for_social_media: bool = False,
+    outputs: Sequence[Filetype] = DEFAULT_OUTPUTS,
+    **output_options,
+  ) -> Tuple[io.BytesIO, ...]:
+    """
+    Same arguments and result as apply_watermark
+    """
+    if jpeg_quality < 0 or jpeg_quality > 100:
+      raise ValueError("jpeg_quality must be between 0 and 100")
+
+    encoded = await self._submit(
+      img_buffer, resize_for_social_media, _encode_in_worker,
+      jpeg_quality, watermark, tuple(outputs), output_options)
+    return tuple(io.BytesIO(img_bytes) for img_bytes in encoded)
+
+  async def decode(self, encoded_img_buffer: io.BytesIO, wm_length=32) -> str:
+    """
+    Same arguments and result as decode_watermark
+    """
+    return await self._submit(
+      encoded_img_buffer.getvalue(), False, _decode_in_worker, wm_length)
+
+  async def _submit(self, img_buffer: bytes, resize_for_social_media: bool, fn, *args):
+    loop = asyncio.get_running_loop()
+    pending = self._pending.get(loop)
+    if pending is None:
+      pending = self._pending[loop] = asyncio.Semaphore(self._max_pending)
+
+    async with pending:
+      # Pillow releases the GIL while decoding, so a thread is enough here
+      img = await loop.run_in_executor(
+        None, _bytes_to_nparray, img_buffer, resize_for_social_media)
+
+      shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+      try:
+        shared = np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)
+        shared[...] = img
+        del shared
+
+        return await loop.run_in_executor(
+          self._executor, fn, shm.name, img.shape, img.dtype.str, *args)
+      finally:
+        shm.close()
+        if _ATTACH_TRACKS:
+          # Spawned workers share this process' tracker, so the worker unregistering
+          # also dropped the registration that unlink removes
+          resource_tracker.register(shm._name, "shared_memory")
+        shm.unlink()
+
+  def close(self):
+    self._executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+def _attach(shm_name: str) -> shared_memory.SharedMemory:
+  """
+  Attaches the shared memory of the parent without leaving it registered with a
+    resource tracker. The parent unlinks it, a tracker of the worker would unlink it
+    again or warn about a leak when the worker exits.
+  """
+  if _ATTACH_TRACKS:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+  return shared_memory.SharedMemory(name=shm_name, track=False)
+
+
+def _encode_in_worker(shm_name: str, shape, dtype: str, jpeg_quality: int, watermark: str,
+                      outputs: Tuple[Filetype, ...], output_options: dict):
+  shm = _attach(shm_name)
+  img = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+  try:
+    wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'))
+    encoded_img = wm_encoder.max_dwt_encode(img)
+  finally:
+    del img
+    shm.close()
+
+  encoded_img = WatermarkedImage(
+    encoded_img, jpeg_quality=jpeg_quality, **output_options)
+  return tuple(encoded_img.get(output).getvalue() for output in outputs)
+
+
+def _decode_in_worker(shm_name: str, shape, dtype: str, wm_length: int):
+  shm = _attach(shm_name)
+  img = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+  try:
+    wm_decoder = WatermarkDecoder(wm_length=wm_length)
+    watermark = wm_decoder.decode(img)
+  finally:
+    del img
+    shm.close()
+
+  return watermark.decode('utf-8', 'replace')